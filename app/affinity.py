@@ -0,0 +1,73 @@
+import glob
+import os
+import re
+
+# NUMA node cpu lists, see numa_nodes
+NODE_CPULISTS = '/sys/devices/system/node/node*/cpulist'
+
+
+def parse_cpulist(text):
+    """
+    :param text: kernel cpu list, e.g. "0-3,8-11".
+    :return: list of cpu numbers.
+    """
+    cpus = []
+    for item in text.strip().split(','):
+        if not item:
+            continue
+        first, _, last = item.partition('-')
+        cpus += range(int(first), int(last or first) + 1)
+    return cpus
+
+
+def numa_nodes():
+    """
+    :return: list of cpu sets of the NUMA nodes, in node order, or an empty
+    list if the topology is not available.
+    """
+    def node_number(path):
+        return int(re.search(r'node(\d+)', path).group(1))
+
+    nodes = []
+    for path in sorted(glob.glob(NODE_CPULISTS), key=node_number):
+        with open(path) as fd:
+            cpus = set(parse_cpulist(fd.read()))
+        if cpus:
+            nodes.append(cpus)
+    return nodes
+
+
+def allowed_cpus(ncpus=None):
+    """
+    :param ncpus: optional number of cpus to take.
+    :return: list of the cpus this process may run on, grouped by NUMA node,
+    so that neighbouring cpus in the list share a node.
+    """
+    allowed = os.sched_getaffinity(0)
+    ordered = []
+    for node in numa_nodes():
+        ordered += sorted(node & allowed)
+    ordered += sorted(allowed.difference(ordered))
+    return ordered[:ncpus] if ncpus else ordered
+
+
+def partition(cpus, parts):
+    """
+    splits a list of cpus into contiguous, disjoint sets of near equal size.
+    With cpus from allowed_cpus, each set lies within a NUMA node whenever
+    the number of sets is a multiple of the number of nodes.
+    :param cpus: list of cpus.
+    :param parts: number of sets.
+    :return: list of cpu lists.  With fewer cpus than sets, sets of one cpu
+    are shared round robin.
+    """
+    if parts >= len(cpus):
+        return [[cpus[i % len(cpus)]] for i in range(parts)]
+    size, extra = divmod(len(cpus), parts)
+    sets = []
+    start = 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        sets.append(cpus[start:end])
+        start = end
+    return sets
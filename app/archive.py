@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+__doc__ = \
+"""Writes the files and logs folders of a pipeline session to tar archives
+for transfer.  Members are streamed through multi-threaded zstd (or pigz /
+gzip where zstd is not installed) straight into the target directory, and
+members which are already compressed, e.g. .nii.gz and .mgz, are written to
+a separate uncompressed tar instead of being compressed twice.  A sha256sum
+compatible manifest of every member is written alongside the archives.
+"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tarfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+import cli
+
+# members with these extensions are stored without compression
+COMPRESSED = ('.gz', '.mgz', '.zst', '.bz2', '.xz', '.zip', '.png', '.jpg',
+              '.jpeg', '.gif')
+
+
+def _cli(argv=None):
+    """
+    command line interface
+    :param argv: optional list of arguments, default is sys.argv.
+    :return:
+    """
+    return cli.run(generate_parser, archive_session, argv)
+
+
+def generate_parser(parser=None):
+    """
+    Generates the command line parser for this program.
+    :param parser: optional subparser for wrapping this program as a submodule.
+    :return: ArgumentParser for this script/module
+    """
+    parser = cli.make_parser(__doc__, parser)
+    parser.add_argument(
+        '--files', required=True,
+        help='Path to the session "files" folder.'
+    )
+    parser.add_argument(
+        '--logs', required=True,
+        help='Path to the session "logs" folder.'
+    )
+    parser.add_argument(
+        '--target', required=True,
+        help='Directory to write archives and manifest to.'
+    )
+    parser.add_argument(
+        '--name', required=True,
+        help='Basename of the archives, e.g. sub-01_ses-01.'
+    )
+    parser.add_argument(
+        '--split', choices=['none', 'modality'], default='none',
+        help='Write one archive, or one archive per modality (anat, func, '
+             'summary, logs) concurrently. Default: none'
+    )
+    parser.add_argument(
+        '--threads', type=int,
+        default=int(os.environ.get('OMP_NUM_THREADS', 1)),
+        help='Number of compression threads. Default: OMP_NUM_THREADS'
+    )
+    parser.add_argument(
+        '--exclude', action='append', default=[],
+        help='Path to leave out of the archives, e.g. the log folder of the '
+             'running stage. Option can be repeated.'
+    )
+
+    return parser
+
+
+def archive_session(files, logs, target, name, split='none', threads=1,
+                    exclude=()):
+    """
+    writes the session archives and manifest.
+    :param files: session files folder.
+    :param logs: session logs folder.
+    :param target: output directory, created if needed.
+    :param name: basename of the archives.
+    :param split: "none" or "modality".
+    :param threads: number of compression threads.
+    :param exclude: paths to leave out.
+    :return: path to the manifest.
+    """
+    os.makedirs(target, exist_ok=True)
+    exclude = {os.path.normpath(x) for x in exclude}
+    parts = {}
+    for root, prefix in ((files, 'files'), (logs, 'logs')):
+        for path, arcname in _walk(root, prefix, exclude):
+            group = get_group(arcname) if split == 'modality' else None
+            stored = path.endswith(COMPRESSED)
+            parts.setdefault((group, stored), []).append((path, arcname))
+
+    compressor = _get_compressor()
+    jobs = []
+    for (group, stored), members in sorted(
+            parts.items(), key=lambda x: (x[0][0] or '', x[0][1])):
+        basename = name if group is None else '%s.%s' % (name, group)
+        if stored:
+            jobs.append((members, os.path.join(
+                target, basename + '.stored.tar'), None))
+        else:
+            jobs.append((members, os.path.join(
+                target, basename + '.tar' + compressor[0]), compressor[1]))
+
+    # divide compression threads between concurrent archives
+    compressed_jobs = sum(1 for j in jobs if j[2] is not None) or 1
+    job_threads = max(1, threads // compressed_jobs)
+    with ThreadPoolExecutor(max_workers=len(jobs) or 1) as pool:
+        results = pool.map(lambda j: write_tar(*j, threads=job_threads),
+                           jobs)
+        checksums = [c for result in results for c in result]
+
+    manifest = os.path.join(target, name + '.sha256')
+    with open(manifest + '.partial', 'w') as fd:
+        for arcname, checksum in sorted(checksums):
+            fd.write('%s  %s\n' % (checksum, arcname))
+    os.replace(manifest + '.partial', manifest)
+    return manifest
+
+
+def get_group(arcname):
+    """
+    :param arcname: member name relative to the session folder.
+    :return: modality group of the member: anat, func, summary or logs.
+    """
+    parts = arcname.split('/')
+    if parts[0] == 'logs':
+        return 'logs'
+    top = parts[1] if len(parts) > 1 else ''
+    if top.startswith(('summary', 'executivesummary')):
+        return 'summary'
+    if top.startswith(('task-', 'ses-')) or \
+            (top == 'MNINonLinear' and len(parts) > 2 and
+             parts[2] == 'Results'):
+        return 'func'
+    return 'anat'
+
+
+def write_tar(members, filename, compressor=None, threads=1):
+    """
+    streams members into a tar file, through a compressor command if given.
+    The archive is written under a temporary name and renamed once complete.
+    :param members: list of (path, arcname).
+    :param filename: archive filename.
+    :param compressor: command writing stdin compressed to stdout, formatted
+    with the number of threads, or None to write an uncompressed tar.
+    :param threads: number of compression threads.
+    :return: list of (arcname, sha256) for regular file members.
+    """
+    partial = filename + '.partial'
+    checksums = []
+    with open(partial, 'wb') as out:
+        if compressor:
+            proc = subprocess.Popen(
+                [x.format(threads=threads) for x in compressor],
+                stdin=subprocess.PIPE, stdout=out)
+            stream = proc.stdin
+        else:
+            proc = None
+            stream = out
+        with tarfile.open(fileobj=stream, mode='w|',
+                          format=tarfile.PAX_FORMAT) as tar:
+            for path, arcname in members:
+                info = tar.gettarinfo(path, arcname)
+                if info.isreg():
+                    with open(path, 'rb') as fd:
+                        reader = _HashingReader(fd)
+                        tar.addfile(info, reader)
+                    checksums.append((arcname, reader.hexdigest()))
+                else:
+                    tar.addfile(info)
+        if proc is not None:
+            proc.stdin.close()
+            if proc.wait() != 0:
+                raise RuntimeError('%s exited with code %s' % (
+                    compressor[0], proc.returncode))
+    os.replace(partial, filename)
+    return checksums
+
+
+def _walk(root, prefix, exclude):
+    # yields (path, arcname) of files, links and empty directories
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in sorted(dirnames) if os.path.normpath(
+            os.path.join(dirpath, d)) not in exclude]
+        rel = os.path.relpath(dirpath, root)
+        arcdir = prefix if rel == '.' else '%s/%s' % (prefix, rel)
+        if not dirnames and not filenames:
+            yield dirpath, arcdir
+        for name in sorted(filenames) + [d for d in dirnames if os.path.islink(
+                os.path.join(dirpath, d))]:
+            path = os.path.join(dirpath, name)
+            if os.path.normpath(path) not in exclude:
+                yield path, '%s/%s' % (arcdir, name)
+
+
+def _get_compressor():
+    """
+    :return: (archive extension, compression command) of the fastest
+    available multi-threaded compressor.
+    """
+    if shutil.which('zstd'):
+        return '.zst', ['zstd', '-q', '-T{threads}', '-c']
+    if shutil.which('pigz'):
+        return '.gz', ['pigz', '-p', '{threads}', '-c']
+    return '.gz', ['gzip', '-c']
+
+
+class _HashingReader(object):
+    """file wrapper computing the sha256 of the bytes read through it."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fd.read(size)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+if __name__ == '__main__':
+    _cli()
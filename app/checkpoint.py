@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+__doc__ = \
+"""Runs one step of a pipeline script unless an identical invocation already
+completed, as recorded in a ledger file.  Stages place wrappers calling this
+script in front of expensive commands, e.g. recon-all, so that a rerun of the
+pipeline script after a failure or preemption resumes after the last
+completed step.  Options which only set the number of threads are ignored
+when comparing invocations.
+
+With --status-log, an interrupted recon-all invocation is itself resumed:
+the steps it completed, according to the recon-all status log, are skipped
+with their "-no<step>" flags when it runs again.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+
+import cli
+
+# options followed by a thread count, and flags, which do not change results
+THREAD_OPTIONS = ('-openmp', '-threads', '-itkthreads')
+THREAD_FLAGS = ('-parallel',)
+
+# recon-all status log markers of the steps which can be skipped, and the
+# step's flag.  Markers of FreeSurfer 5.3 and 6.
+STEP_FLAGS = {
+    'MotionCor': 'motioncor',
+    'Talairach': 'talairach',
+    'Nu Intensity Correction': 'nuintensitycor',
+    'Intensity Normalization': 'normalization',
+    'Skull Stripping': 'skullstrip',
+    'EM Registration': 'gcareg',
+    'CA Normalize': 'canorm',
+    'CA Reg': 'careg',
+    'SubCort Seg': 'calabel',
+    'Intensity Normalization2': 'normalization2',
+    'Mask BFS': 'maskbfs',
+    'WM Segmentation': 'segmentation',
+    'Fill': 'fill',
+    'Tessellate': 'tessellate',
+    'Smooth1': 'smooth1',
+    'Inflation1': 'inflate1',
+    'QSphere': 'qsphere',
+    'Fix Topology Copy': 'fix',
+    'Fix Topology': 'fix',
+    'Make White Surf': 'white',
+    'Smooth2': 'smooth2',
+    'Inflation2': 'inflate2',
+    'Curv .H and .K': 'curvHK',
+    'Curvature Stats': 'curvstats',
+    'Sphere': 'sphere',
+    'Surf Reg': 'surfreg',
+    'Jacobian white': 'jacobian_white',
+    'AvgCurv': 'avgcurv',
+    'Cortical Parc': 'cortparc',
+    'Make Pial Surf': 'pial',
+    'Surf Volume': 'surfvolume',
+    'Cortical ribbon mask': 'cortribbon',
+    'Parcellation Stats': 'parcstats',
+    'Cortical Parc 2': 'cortparc2',
+    'Parcellation Stats 2': 'parcstats2',
+    'Cortical Parc 3': 'cortparc3',
+    'Parcellation Stats 3': 'parcstats3',
+    'WM/GM Contrast': 'pctsurfcon',
+    'Relabel Hypointensities': 'hyporelabel',
+    'AParc-to-ASeg': 'aparc2aseg',
+    'AParc-to-ASeg aparc': 'aparc2aseg',
+    'AParc-to-ASeg a2009s': 'aparc2aseg',
+    'AParc-to-ASeg DKTatlas': 'aparc2aseg',
+    'APas-to-ASeg': 'apas2aseg',
+    'ASeg Stats': 'segstats',
+    'WMParc': 'wmparc',
+    'BA Labels': 'balabels',
+    'BA_exvivo Labels': 'balabels',
+}
+# "#@# <step> [lh|rh] <date>" line of the status log
+_MARKER = re.compile(r'#@# (?P<name>.+?)(?: (?P<hemi>lh|rh))?'
+                     r' (?:Mon|Tue|Wed|Thu|Fri|Sat|Sun) ')
+
+
+def _cli(argv=None):
+    """
+    command line interface
+    :param argv: optional list of arguments, default is sys.argv.
+    :return:
+    """
+    return cli.run(generate_parser, run_step, argv, errors=(ValueError,))
+
+
+def generate_parser(parser=None):
+    """
+    Generates the command line parser for this program.
+    :param parser: optional subparser for wrapping this program as a submodule.
+    :return: ArgumentParser for this script/module
+    """
+    parser = cli.make_parser(__doc__, parser)
+    parser.add_argument(
+        '--ledger', required=True,
+        help='File listing completed invocations.'
+    )
+    parser.add_argument(
+        '--status-log', metavar='LOG',
+        help='recon-all-status.log of the recon-all run by the step, to '
+             'resume an interrupted invocation after its completed steps.'
+    )
+    parser.add_argument(
+        '--resume-state', metavar='FILE',
+        help='File recording the status log offset and completed steps of '
+             'interrupted invocations. Required with --status-log.'
+    )
+    parser.add_argument(
+        'command', nargs=argparse.REMAINDER,
+        help='Command and arguments of the step.'
+    )
+
+    return parser
+
+
+def wrapper_script(ledger, target, extra_args=(), status_log=None,
+                   resume_state=None):
+    """
+    :param ledger: ledger file.
+    :param target: command the wrapper stands in for.
+    :param extra_args: arguments appended to every invocation.
+    :param status_log: recon-all status log, see run_step.
+    :param resume_state: resume state file, see run_step.
+    :return: text of a shell script running target through this script.
+    """
+    options = ['--ledger', ledger]
+    if status_log:
+        options += ['--status-log', status_log,
+                    '--resume-state', resume_state]
+    return '#!/bin/sh\nexec %s %s %s -- %s "$@"%s\n' % (
+        shlex.quote(sys.executable), shlex.quote(os.path.realpath(__file__)),
+        ' '.join(shlex.quote(x) for x in options), shlex.quote(target),
+        ''.join(' ' + shlex.quote(x) for x in extra_args))
+
+
+def step_key(command):
+    """
+    :param command: list of command and arguments.
+    :return: identifier of the invocation, ignoring thread options.
+    """
+    args = []
+    skip = False
+    for arg in command:
+        if skip:
+            skip = False
+        elif arg in THREAD_OPTIONS:
+            skip = True
+        elif arg not in THREAD_FLAGS:
+            args.append(arg)
+    return hashlib.sha256('\0'.join(args).encode()).hexdigest()
+
+
+def read_ledger(ledger):
+    """
+    :param ledger: ledger file.
+    :return: set of keys of completed invocations.
+    """
+    if not os.path.exists(ledger):
+        return set()
+    with open(ledger) as fd:
+        return {line.split('\t')[0] for line in fd if line.strip()}
+
+
+def read_markers(status_log, offset=0):
+    """
+    :param status_log: recon-all status log.
+    :param offset: byte offset at which an invocation started.
+    :return: list of (name, hemisphere) of the steps started since offset,
+    in order.  The hemisphere is lh, rh, or None for steps of the volume.
+    """
+    markers = []
+    if not os.path.exists(status_log):
+        return markers
+    with open(status_log, 'rb') as fd:
+        fd.seek(offset)
+        for line in fd.read().decode(errors='replace').splitlines():
+            match = _MARKER.match(line)
+            if match:
+                markers.append((match.group('name'), match.group('hemi')))
+    return markers
+
+
+def completed_steps(markers):
+    """
+    :param markers: steps started by one invocation of recon-all, see
+    read_markers.
+    :return: set of (flag, hemisphere) of the steps which completed, as
+    a later step of the same hemisphere, or of the volume, started.  Both
+    hemispheres run at once with -parallel, so a step of one says nothing
+    about the other.  A flag with several markers completed once all of
+    them did.
+    """
+    complete, incomplete = set(), set()
+    for i, (name, hemi) in enumerate(markers):
+        flag = STEP_FLAGS.get(name)
+        if flag is None:
+            continue
+        if any(hemi is None or later is None or later == hemi
+               for _, later in markers[i + 1:]):
+            complete.add((flag, hemi))
+        else:
+            incomplete.add((flag, hemi))
+    return complete - incomplete
+
+
+def resume_command(command, done, imported):
+    """
+    :param command: list of recon-all and its arguments.
+    :param done: set of (flag, hemisphere) of completed steps.
+    :param imported: the input volumes were imported, so "-i" inputs are
+    dropped, as recon-all refuses them for an existing subject.
+    :return: command skipping the completed steps, volume steps once done
+    and hemisphere steps once done for both.
+    """
+    flags = {flag for flag, hemi in done
+             if hemi is None or (flag, 'rh' if hemi == 'lh' else 'lh') in done}
+    args = []
+    skip = False
+    for arg in command:
+        if skip:
+            skip = False
+        elif imported and arg == '-i':
+            skip = True
+        else:
+            args.append(arg)
+    order = list(dict.fromkeys(STEP_FLAGS.values()))
+    return args + ['-no' + flag for flag in sorted(flags, key=order.index)]
+
+
+def _read_state(resume_state):
+    if not os.path.exists(resume_state):
+        return {}
+    with open(resume_state) as fd:
+        return json.load(fd)
+
+
+def _write_state(resume_state, state):
+    tmp = resume_state + '.tmp'
+    with open(tmp, 'w') as fd:
+        json.dump(state, fd, indent=4)
+    os.replace(tmp, resume_state)
+
+
+def run_step(ledger, command, status_log=None, resume_state=None):
+    """
+    runs command unless it completed before, recording it on success.  With
+    a status log, the steps an interrupted invocation completed are skipped.
+    :param ledger: ledger file, written once its folder exists.
+    :param command: list of command and arguments.
+    :param status_log: recon-all status log written by command.
+    :param resume_state: file recording, per invocation which has not
+    completed, the status log offset at which its last attempt started and
+    the steps completed by earlier attempts.
+    :return: exit status of the command, 0 if it was skipped.
+    """
+    if command and command[0] == '--':
+        command = command[1:]
+    if status_log and not resume_state:
+        raise ValueError('--status-log requires --resume-state')
+    key = step_key(command)
+    if key in read_ledger(ledger):
+        print('checkpoint: skipping completed step: %s' % ' '.join(command))
+        sys.stdout.flush()
+        return 0
+    if status_log:
+        state = _read_state(resume_state)
+        entry = state.get(key)
+        done, imported = set(), False
+        if entry:
+            markers = read_markers(status_log, entry['offset'])
+            done = {tuple(x) for x in entry['done']}
+            done |= completed_steps(markers)
+            imported = entry['imported'] or bool(markers)
+            command = resume_command(command, done, imported)
+            print('checkpoint: resuming interrupted step: %s' %
+                  ' '.join(command))
+            sys.stdout.flush()
+            # left behind by the interrupted run, recon-all refuses to
+            # start while they exist
+            for path in glob.glob(os.path.join(
+                    os.path.dirname(status_log), 'IsRunning.*')):
+                os.remove(path)
+        offset = os.path.getsize(status_log) \
+            if os.path.exists(status_log) else 0
+        state[key] = {'offset': offset, 'imported': imported,
+                      'done': sorted(done, key=lambda x: (x[0], x[1] or ''))}
+        _write_state(resume_state, state)
+    result = subprocess.call(command)
+    if result == 0 and os.path.isdir(os.path.dirname(ledger)):
+        with open(ledger, 'a') as fd:
+            fd.write('%s\t%s\n' % (key, ' '.join(command)))
+        if status_log:
+            state = _read_state(resume_state)
+            state.pop(key, None)
+            _write_state(resume_state, state)
+    return result
+
+
+if __name__ == '__main__':
+    sys.exit(_cli())
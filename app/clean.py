@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+__doc__ = \
+"""Removes non-critical outputs of a processed session, as a drop-in for the
+DCAN CustomClean cleaning script.  The cleaning JSON is the CustomClean
+template: a list of paths relative to the session "files" folder, which may
+use the glob wildcards "*", "?" and "[...]" within a path component.  As in
+glob, wildcards do not match names starting with ".".  A matched folder is
+removed with its contents.  Cleaning is refused if it would remove every
+file of the session.
+
+The patterns are compiled once, and each top-level folder is walked and
+cleaned concurrently.  A record of removed files and freed bytes is written
+to custom_clean_success_record.txt in the session folder.
+"""
+
+import json
+import os
+import re
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+
+import cli
+
+RECORD = 'custom_clean_success_record.txt'
+
+
+def _cli(argv=None):
+    """
+    command line interface
+    :param argv: optional list of arguments, default is sys.argv.
+    :return:
+    """
+    return cli.run(generate_parser, clean, argv, errors=(ValueError,))
+
+
+def generate_parser(parser=None):
+    """
+    Generates the command line parser for this program.
+    :param parser: optional subparser for wrapping this program as a submodule.
+    :return: ArgumentParser for this script/module
+    """
+    parser = cli.make_parser(__doc__, parser)
+    parser.add_argument(
+        '--dir', required=True, dest='root',
+        help='Session "files" folder to clean.'
+    )
+    parser.add_argument(
+        '--json', required=True, dest='cleaning_json',
+        help='Cleaning JSON.'
+    )
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='Report what would be removed without removing anything.'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=8,
+        help='Number of folders walked and cleaned concurrently. '
+             'Default: %(default)s'
+    )
+
+    return parser
+
+
+def load_patterns(cleaning_json):
+    """
+    :param cleaning_json: path to the CustomClean template.
+    :return: compiled pattern matching the paths to remove.
+    """
+    with open(cleaning_json) as fd:
+        try:
+            spec = json.load(fd)
+        except ValueError as e:
+            raise ValueError('%s is not valid JSON: %s' % (cleaning_json, e))
+    if not isinstance(spec, list) or \
+            not all(isinstance(x, str) for x in spec):
+        raise ValueError('%s is not a CustomClean template, which is a JSON '
+                         'list of paths relative to the session files '
+                         'folder' % cleaning_json)
+    return compile_patterns(spec)
+
+
+def compile_patterns(patterns):
+    """
+    :param patterns: list of relative path patterns.
+    :return: one regular expression matching any of the patterns, which
+    matches nothing if there are none.
+    """
+    if not patterns:
+        return re.compile(r'(?!)')
+    return re.compile('|'.join('(?:%s)' % _translate(p) for p in patterns))
+
+
+def _translate(pattern):
+    pattern = pattern.strip()
+    if pattern.startswith('./'):
+        pattern = pattern[2:]
+    components = []
+    for component in pattern.rstrip('/').split('/'):
+        expr = ''
+        if component[:1] in ('*', '?', '['):
+            # as in glob, wildcards do not match hidden names
+            expr = r'(?!\.)'
+        for token in re.split(r'(\*|\?|\[!?\]?[^]]*\])', component):
+            if token == '*':
+                expr += '[^/]*'
+            elif token == '?':
+                expr += '[^/]'
+            elif len(token) > 2 and token[0] == '[' and token[-1] == ']':
+                chars = token[1:-1]
+                negate = chars.startswith('!')
+                if negate:
+                    chars = chars[1:]
+                elif chars.startswith('^'):
+                    chars = '\\' + chars
+                expr += '[%s%s]' % ('^/' if negate else '',
+                                    chars.replace('\\', '\\\\'))
+            else:
+                expr += re.escape(token)
+        components.append(expr)
+    return '/'.join(components) + r'\Z'
+
+
+def clean(root, cleaning_json, dry_run=False, workers=8):
+    """
+    removes the files and folders matching a cleaning JSON.
+    :param root: session "files" folder.
+    :param cleaning_json: path to the cleaning JSON.
+    :param dry_run: only report.
+    :param workers: number of concurrent walks.
+    :return: tuple of number of removed files and freed bytes.
+    """
+    remove = load_patterns(cleaning_json)
+    with os.scandir(root) as it:
+        tops = sorted(it, key=lambda x: x.name)
+
+    def scan(entry):
+        return _scan(entry, entry.name, remove, False)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(scan, tops))
+        files = [f for result in results for f in result[0]]
+        folders = [d for result in results for d in result[1]]
+        if files and not any(result[2] for result in results):
+            raise ValueError('%s would remove every file in %s, refusing to '
+                             'clean' % (cleaning_json, root))
+        freed = sum(size for _, size in files)
+        for path, size in files:
+            print('%s %s (%s bytes)' % (
+                'would remove' if dry_run else 'removing', path, size))
+        if not dry_run:
+            # files in batches per worker, then the emptied folders
+            batches = [files[i::workers] for i in range(workers)]
+            list(pool.map(_remove_files, batches))
+            list(pool.map(lambda d: shutil.rmtree(d, ignore_errors=True),
+                          folders))
+
+    summary = '%s files, %.2f GB %s' % (
+        len(files), freed / 1024 ** 3,
+        'would be freed' if dry_run else 'freed')
+    print(summary)
+    if not dry_run:
+        with open(os.path.join(root, RECORD), 'w') as fd:
+            for path, size in files:
+                fd.write('%s\t%s\n' % (os.path.relpath(path, root), size))
+            fd.write('# %s\n' % summary)
+    return len(files), freed
+
+
+def _scan(entry, rel, remove, inherited):
+    """
+    :return: tuple of (path, size) of files to remove, folders to remove as
+    a whole, and whether any file under entry remains.
+    """
+    matched = inherited or bool(remove.match(rel))
+    if not entry.is_dir(follow_symlinks=False):
+        if matched:
+            return [(entry.path, entry.stat(follow_symlinks=False).st_size)], \
+                [], False
+        return [], [], True
+    files, folders, remains = [], [], False
+    with os.scandir(entry.path) as it:
+        for child in it:
+            child_files, child_folders, child_remains = _scan(
+                child, rel + '/' + child.name, remove, matched)
+            files += child_files
+            folders += child_folders
+            remains = remains or child_remains
+    if matched:
+        # the folder goes as a whole
+        return files, [entry.path], False
+    return files, folders, remains
+
+
+def _remove_files(batch):
+    for path, _ in batch:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+if __name__ == '__main__':
+    _cli()
@@ -0,0 +1,41 @@
+"""
+command line plumbing shared by the scripts of this package, each of which
+defines a generate_parser(parser=None) and a function taking the parsed
+arguments as keywords.
+"""
+
+import argparse
+
+
+def make_parser(description, parser=None, **kwargs):
+    """
+    :param description: module docstring of the program.
+    :param parser: optional subparser for wrapping a program as a submodule.
+    :param kwargs: further arguments of a new ArgumentParser, e.g. prog.
+    :return: parser, or a new ArgumentParser for the program.
+    """
+    if not parser:
+        parser = argparse.ArgumentParser(
+            description=description,
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            **kwargs
+        )
+    return parser
+
+
+def run(generate_parser, func, argv=None, errors=()):
+    """
+    parses the command line and calls func with the arguments as keywords.
+    :param generate_parser: generate_parser function of the program.
+    :param func: function run by the program.
+    :param argv: optional list of arguments, default is sys.argv.
+    :param errors: exception types reported as an error of the program
+    instead of a traceback.
+    :return: return value of func.
+    """
+    parser = generate_parser()
+    args = parser.parse_args(argv)
+    try:
+        return func(**vars(args))
+    except errors as e:
+        parser.exit(1, '%s: error: %s\n' % (parser.prog, e))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+__doc__ = \
+"""Replaces byte-identical files under an output root, e.g. template derived
+files which every session copies, with hard links or reflinks to a single
+copy.  Candidates are grouped by size, then by a hash of their first block,
+then by a hash of their full contents.  Optionally, a content-addressed store
+keeps one copy of every deduplicated file, so that files of sessions
+processed later are linked to it as well.
+
+Hard linked files share their contents: only run this on sessions which are
+no longer being processed, or use reflinks where the file system supports
+them (e.g. XFS, Btrfs), which are copied on write.
+"""
+
+import fcntl
+import hashlib
+import os
+import shutil
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import cli
+
+# linux ioctl cloning one file's extents into another
+FICLONE = 0x40049409
+
+
+def _cli(argv=None):
+    """
+    command line interface
+    :param argv: optional list of arguments, default is sys.argv.
+    :return:
+    """
+    return cli.run(generate_parser, dedupe, argv)
+
+
+def generate_parser(parser=None):
+    """
+    Generates the command line parser for this program.
+    :param parser: optional subparser for wrapping this program as a submodule.
+    :return: ArgumentParser for this script/module
+    """
+    parser = cli.make_parser(__doc__, parser,
+                             prog='abcd-hcp-pipeline dedupe',
+                             usage='%(prog)s output_dir [OPTIONS]')
+    parser.add_argument(
+        'root', metavar='output_dir',
+        help='Output root to deduplicate, e.g. the pipeline output_dir.'
+    )
+    parser.add_argument(
+        '--mode', choices=['hardlink', 'reflink'], default='hardlink',
+        help='How to share identical contents. Default: hardlink'
+    )
+    parser.add_argument(
+        '--store', metavar='DIR',
+        help='Content-addressed store on the same file system. Duplicates '
+             'are linked to a copy in the store, and files of later '
+             'sessions are linked to it even without a second copy under '
+             'output_dir.'
+    )
+    parser.add_argument(
+        '--min-size', type=int, default=64 * 1024, metavar='BYTES',
+        help='Ignore files smaller than this. Default: %(default)s'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=8,
+        help='Number of files hashed concurrently. Default: %(default)s'
+    )
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='Report what would be linked without changing any file.'
+    )
+
+    return parser
+
+
+def dedupe(root, mode='hardlink', store=None, min_size=64 * 1024, workers=8,
+           dry_run=False):
+    """
+    links identical files under root to one copy.
+    :param root: directory to deduplicate.
+    :param mode: "hardlink" or "reflink".
+    :param store: optional content-addressed store directory.
+    :param min_size: minimum file size in bytes.
+    :param workers: number of concurrent hashes.
+    :param dry_run: only report.
+    :return: tuple of number of files linked and bytes saved.
+    """
+    stored = {}
+    if store:
+        os.makedirs(store, exist_ok=True)
+        stored = _read_store(store)
+    store_sizes = {size for size, _ in stored}
+
+    # group by size, one entry per inode
+    by_size = defaultdict(dict)
+    for path, st in _walk(root, min_size):
+        by_size[(st.st_dev, st.st_size)].setdefault(st.st_ino, path)
+    candidates = {k: list(v.values()) for k, v in by_size.items()
+                  if len(v) > 1 or k[1] in store_sizes}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # split by the hash of the first block, then of the whole file
+        by_head = defaultdict(list)
+        paths = [p for group in candidates.values() for p in group]
+        keys = [k for k, group in candidates.items() for _ in group]
+        for key, path, digest in zip(keys, paths, pool.map(
+                lambda p: file_hash(p, first_block=True), paths)):
+            by_head[key + (digest,)].append(path)
+        by_hash = defaultdict(list)
+        items = [(k[1], p) for k, group in by_head.items() for p in group
+                 if len(group) > 1 or k[1] in store_sizes]
+        for (size, path), digest in zip(items, pool.map(
+                lambda x: file_hash(x[1]), items)):
+            by_hash[(size, digest)].append(path)
+
+    linked = saved = 0
+    for (size, digest), group in sorted(by_hash.items()):
+        source = stored.get((size, digest))
+        if source is None:
+            source, group = group[0], group[1:]
+            if store and group:
+                # first time these contents are seen twice, add to the store
+                stored_copy = os.path.join(store, digest[:2], digest)
+                print('storing %s as %s' % (source, stored_copy))
+                if not dry_run:
+                    os.makedirs(os.path.dirname(stored_copy), exist_ok=True)
+                    _link(source, stored_copy, mode)
+                    source = stored_copy
+        for path in group:
+            if _same_inode(source, path):
+                continue
+            print('linking %s to %s' % (path, source))
+            if not dry_run:
+                try:
+                    _link(source, path, mode)
+                except OSError as e:
+                    print('WARNING: could not link %s: %s' % (path, e))
+                    continue
+            linked += 1
+            saved += size
+    print('linked %s files, %.2f GB saved' % (linked, saved / 1024 ** 3))
+    return linked, saved
+
+
+def file_hash(path, first_block=False, blocksize=1 << 20):
+    """
+    :param path: file to hash.
+    :param first_block: only hash the first block.
+    :return: hex digest of the contents.
+    """
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as fd:
+        for block in iter(lambda: fd.read(blocksize), b''):
+            digest.update(block)
+            if first_block:
+                break
+    return digest.hexdigest()
+
+
+def _walk(root, min_size):
+    # yields (path, stat) of regular files, not following links
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    if st.st_size >= min_size:
+                        yield entry.path, st
+
+
+def _read_store(store):
+    # (size, digest): path of every object in the store
+    stored = {}
+    for path, st in _walk(store, 0):
+        stored[(st.st_size, os.path.basename(path))] = path
+    return stored
+
+
+def _same_inode(a, b):
+    sa, sb = os.stat(a), os.stat(b)
+    return (sa.st_dev, sa.st_ino) == (sb.st_dev, sb.st_ino)
+
+
+def _link(source, path, mode):
+    """
+    atomically replaces path (if it exists) with a hard link or reflink of
+    source, keeping the metadata of path for reflinks.
+    """
+    tmp = '%s.dedupe-%s' % (path, os.getpid())
+    if mode == 'hardlink':
+        os.link(source, tmp)
+    else:
+        with open(source, 'rb') as src, open(tmp, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        shutil.copystat(path if os.path.exists(path) else source, tmp)
+    os.replace(tmp, path)
+
+
+if __name__ == '__main__':
+    _cli()
@@ -1,16 +1,28 @@
 import os
 import re
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from itertools import product
 
+import checkpoint
+
+from affinity import allowed_cpus, partition
 from pipelines import Stage
-from helpers import get_fmriname, get_taskname
+from storage import shadow_scripts
+
+# parcellation folder: list of label name, dlabel file pairs, indexed once
+# per process, see ABCDTask.get_parcels
+_parcel_index = {}
 
 
 class ABCDTask(Stage):
 
     script = '{HCPPIPEDIR}/TaskfMRIAnalysis/TaskfMRIAnalysis.sh'
 
+    depends_on = ('DCANBOLDProcessing',)
+
+    image_dirs_spec = ['{path}/MNINonLinear/Results']
+
     spec = '--path={path} ' \
            '--subject={subject} ' \
            '--lvl1tasks={lvl1tasks} ' \
@@ -30,42 +42,192 @@ class ABCDTask(Stage):
 
     smoothing_list = [2, 5]
 
+    # the level 1 analysis of each run is a separate job.  The level 2 job
+    # of a task calls TaskfMRIAnalysis.sh for all of its runs, which skips
+    # the level 1 analyses already completed through a checkpoint wrapper
+    # of this script in HCPPIPEDIR_tfMRIAnalysis.
+    level1_script = 'TaskfMRILevel1.sh'
+
+    # level 1 analyses run as separate jobs, see make_wrappers
+    level1_jobs = True
+
+    @property
+    def ledger(self):
+        return os.path.join(self._get_log_dir(), 'level1_checkpoints.txt')
+
     @property
     def args(self):
-        self.kwargs['vba'] = 'NO'
-        self.kwargs['confound'] = 'censor.txt'
-        self.kwargs['temporalfilter'] = 200
         parcels = [('NONE', 'NONE')] #  self.get_parcels()
         task_d = self.get_tasklist()
 
         # construct task fmri permutations
         for parcel, smoothing, task in \
                 product(parcels, self.smoothing_list, list(task_d.items())):
-            self.kwargs['fmriname'] = task[0] + '_s%s' % smoothing
-            self.kwargs['parcellation'] = parcel[0]
-            self.kwargs['parcellationfile'] = parcel[1]
-            self.kwargs['finalsmoothingFWHM'] = smoothing
-            self.kwargs['lvl1tasks'] = '@'.join(task[1])
-            self.kwargs['lvl1fsfs'] = '@'.join(task[1])
-            self.kwargs['lvl2task'] = task[0]
-            self.kwargs['lvl2fsf'] = task[0]
-            self.kwargs['regname'] = "NONE"
-
-            kw = {k: (v if v is not None else "NONE")
-                  for k, v in self.kwargs.items()}
-            yield self.spec.format(**kw)
+            yield self._format_args(parcel, smoothing, task[1], task[0])
+
+    def _format_args(self, parcel, smoothing, lvl1tasks, lvl2task):
+        self.kwargs['vba'] = 'NO'
+        self.kwargs['confound'] = 'censor.txt'
+        self.kwargs['temporalfilter'] = 200
+        self.kwargs['fmriname'] = (lvl2task if lvl2task != 'NONE' else
+                                   lvl1tasks[0]) + '_s%s' % smoothing
+        self.kwargs['parcellation'] = parcel[0]
+        self.kwargs['parcellationfile'] = parcel[1]
+        self.kwargs['finalsmoothingFWHM'] = smoothing
+        self.kwargs['lvl1tasks'] = '@'.join(lvl1tasks)
+        self.kwargs['lvl1fsfs'] = '@'.join(lvl1tasks)
+        self.kwargs['lvl2task'] = lvl2task
+        self.kwargs['lvl2fsf'] = lvl2task
+        self.kwargs['regname'] = "NONE"
+
+        kw = {k: (v if v is not None else "NONE")
+              for k, v in self.kwargs.items()}
+        return self.spec.format(**kw)
 
     def cmdline(self):
         script = self.script.format(**os.environ)
         for argset in self.args:
             yield ' '.join((script, argset))
 
+    def get_jobs(self):
+        """
+        splits the task fmri permutations into a level 1 job per run and a
+        level 2 job per task, parcellation and smoothing, which requires
+        the level 1 jobs of its group.  Without separate level 1 jobs, each
+        level 2 job runs its own level 1 analyses.
+        :return: list of jobs, as dicts of name, level, group, cost, i.e.
+        frames to analyse, command line, and the names of the jobs it
+        requires.
+        """
+        script = self.script.format(**os.environ)
+        parcels = [('NONE', 'NONE')] #  self.get_parcels()
+        frames = self.get_frames()
+        jobs = []
+        for parcel, smoothing, task in product(
+                parcels, self.smoothing_list,
+                sorted(self.get_tasklist().items())):
+            group = (parcel[0], smoothing, task[0])
+            level1 = []
+            for run in task[1] if self.level1_jobs else []:
+                args = self._format_args(parcel, smoothing, [run], 'NONE')
+                level1.append(self.kwargs['fmriname'])
+                jobs.append({'name': self.kwargs['fmriname'], 'level': 1,
+                             'group': group, 'cost': frames.get(run, 0),
+                             'cmd': ' '.join((script, args)),
+                             'requires': []})
+            args = self._format_args(parcel, smoothing, task[1], task[0])
+            jobs.append({'name': self.kwargs['fmriname'], 'level': 2,
+                         'group': group,
+                         'cost': sum(frames.get(r, 0) for r in task[1]),
+                         'cmd': ' '.join((script, args)),
+                         'requires': level1})
+        return jobs
+
+    def get_frames(self):
+        """
+        :return: dictionary of fmri name: number of frames of the run.
+        """
+        return {run.fmriname: run.frames for run in self.config.get_runs()
+                if run.frames is not None}
+
+    def run(self, ncpus=1):
+        """
+        runs the task fmri jobs, the most frames first.  Level 2 jobs start
+        as soon as the level 1 jobs of their runs complete, ahead of the
+        remaining level 1 jobs.
+        :param ncpus: number of concurrent jobs.
+        :return: None
+        """
+        self.ncpus = ncpus
+        if self.pin_cpus and not self.cpus:
+            self.cpus = allowed_cpus(ncpus)
+        start = self.recompress_start()
+        # checkpoints of an earlier run
+        if os.path.exists(self.ledger):
+            os.remove(self.ledger)
+        self.setup()
+        result = self._schedule(self.get_jobs(), ncpus)
+        self.recompress_outputs(ncpus, start)
+        self.teardown(result)
+
+    def _schedule(self, jobs, ncpus):
+        log_dir = self._get_log_dir()
+        # level 2 first, then by cost
+        pending = sorted(jobs, key=lambda x: (x['level'], x['cost']),
+                         reverse=True)
+        waiting = {}
+        for job in jobs:
+            if job['level'] == 1:
+                waiting[job['group']] = waiting.get(job['group'], 0) + 1
+        results = []
+        running = {}
+        # cpus of each concurrent job, if pinned
+        slots = partition(self.cpus, max(1, ncpus)) if self.pin_cpus and \
+            self.cpus else [None] * max(1, ncpus)
+        with ThreadPoolExecutor(max_workers=max(1, ncpus)) as pool:
+            while pending or running:
+                ready = [job for job in pending if job['level'] == 1 or
+                         not waiting.get(job['group'])]
+                for job in ready[:len(slots)]:
+                    pending.remove(job)
+                    job['cpus'] = slots.pop()
+                    out_log = os.path.join(log_dir, job['name'] + '.out')
+                    err_log = os.path.join(log_dir, job['name'] + '.err')
+                    kwargs = {'cpus': job['cpus']} if job['cpus'] else {}
+                    running[pool.submit(self.call, job['cmd'], out_log,
+                                        err_log, **kwargs)] = job
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    job = running.pop(future)
+                    slots.append(job['cpus'])
+                    results.append(future.result())
+                    if job['level'] != 1:
+                        continue
+                    if results[-1] == 0:
+                        waiting[job['group']] -= 1
+                    else:
+                        print('%s failed, skipping level 2 analysis of %s' %
+                              (job['name'], job['group'][2]))
+                        pending = [x for x in pending
+                                   if x['group'] != job['group']]
+        return results
+
+    def make_wrappers(self):
+        """
+        shadows HCPPIPEDIR_tfMRIAnalysis with a checkpoint wrapper of the
+        level 1 script, through which level 1 analyses run as separate jobs.
+        :return: None
+        """
+        if not self.call_active:
+            return
+        task_scripts = os.environ.get('HCPPIPEDIR_tfMRIAnalysis')
+        if not task_scripts or not os.path.isfile(
+                os.path.join(task_scripts, self.level1_script)):
+            print('WARNING: %s not found in HCPPIPEDIR_tfMRIAnalysis, level '
+                  '1 analyses run within their level 2 job.' %
+                  self.level1_script)
+            self.level1_jobs = False
+            return
+        self.level1_jobs = True
+        self.env['HCPPIPEDIR_tfMRIAnalysis'] = shadow_scripts(
+            task_scripts,
+            os.path.join(self._get_log_dir(), 'checkpoint_scripts'),
+            {self.level1_script: checkpoint.wrapper_script(
+                self.ledger, os.path.join(task_scripts, self.level1_script))})
+
     def setup(self):
         """
         run task fmri prep
         :return:
         """
         super(__class__, self).setup()
+        for cmd in self.setup_commands():
+            print(cmd[0])
+            result = self.call(*cmd)
+
+    def setup_commands(self):
         # construct command line call
         setup_script = '%s/tfMRI.py' % \
                        os.environ['ABCDTASKPREPDIR']
@@ -84,53 +246,57 @@ class ABCDTask(Stage):
             software_version = 'NA'
         cmd = ' '.join((setup_script, arg1, arg2, arg3, arg4, make,
                         software_version))
-        print(cmd)
 
         log_dir = self._get_log_dir()
         out_log = os.path.join(log_dir, self.__class__.__name__ + '_setup.out')
         err_log = os.path.join(log_dir, self.__class__.__name__ + '_setup.err')
-        result = self.call(cmd, out_log, err_log)
+        return [(cmd, out_log, err_log)]
 
     def get_tasklist(self):
         """
 
         :return: dictionary of task basename: list of task names (with number)
         """
-        tasks = self.config.get_bids('func')
-        fmri_names = [get_fmriname(t) for t in tasks]
-
         # filter out resting state data
         pattern = re.compile(r'^((?!rest).)*$')
-        is_task = [pattern.match(t) is not None for t in fmri_names]
-        fmri_names = [t for i, t in enumerate(fmri_names) if is_task[i]]
-        task_names = list(set(
-            get_taskname(t) for i, t in enumerate(tasks) if is_task[i]
-        ))
+        runs = [run for run in self.config.get_runs()
+                if pattern.match(run.fmriname) is not None]
         task_dictionary = {}
-        for name in task_names:
-            task_dictionary[name] = [t for t in fmri_names if name in t]
+        for run in runs:
+            task_dictionary.setdefault(run.task, []).append(run.fmriname)
         return task_dictionary
 
     def get_parcels(self):
         """
         returns a list of label name, filename pairs for the labels in the
-        dcan bold proc folder.
+        dcan bold proc folder.  The folder is indexed once per process.
         """
         parcellation_folder = '%s/templates/parcellations' % \
                               os.environ['DCANBOLDPROCDIR']
-        walker = list(os.walk(parcellation_folder))
-        # find all folders which contain a space subdirectory
-        candidates = [x for x in walker if 'fsLR' == os.path.basename(x[0])]
-        # check that the proper dlabel files can be found.
-        parcels = []
-        for x in candidates:
-            label_name = os.path.basename(os.path.dirname(x[0]))
-            if '%s.32k_fs_LR.dlabel.nii' % label_name in x[2]:
-                parcels.append((
-                    label_name,
-                    os.path.join(
-                        x[0], '%s.32k_fs_LR.dlabel.nii' % label_name)
-                ))
-            else:
-                print('%s is a bad label file directory' % label_name)
-        return parcels
+        if parcellation_folder not in _parcel_index:
+            _parcel_index[parcellation_folder] = _index_parcels(
+                parcellation_folder)
+        return list(_parcel_index[parcellation_folder])
+
+
+def _index_parcels(parcellation_folder):
+    """
+    :param parcellation_folder: folder searched for fsLR label files.
+    :return: list of label name, dlabel file pairs.
+    """
+    walker = list(os.walk(parcellation_folder))
+    # find all folders which contain a space subdirectory
+    candidates = [x for x in walker if 'fsLR' == os.path.basename(x[0])]
+    # check that the proper dlabel files can be found.
+    parcels = []
+    for x in candidates:
+        label_name = os.path.basename(os.path.dirname(x[0]))
+        if '%s.32k_fs_LR.dlabel.nii' % label_name in x[2]:
+            parcels.append((
+                label_name,
+                os.path.join(
+                    x[0], '%s.32k_fs_LR.dlabel.nii' % label_name)
+            ))
+        else:
+            print('%s is a bad label file directory' % label_name)
+    return parcels
@@ -5,6 +5,12 @@ from itertools import product
 
 from bids.layout import BIDSLayout
 
+# bids entities of functional filenames, see get_fmriname
+_session_expr = re.compile(r'.*(ses-(?!None)[^_]+_).*')
+_task_expr = re.compile(r'.*(task-[^_]+_).*')
+_run_expr = re.compile(r'.*(run-[0-9]+).*')
+_taskname_expr = re.compile(r'.*(task-[^_]+).*')
+
 
 def read_bids_dataset(bids_input, subject_list=None, session_list=None, collect_on_subject=False):
     """
@@ -117,6 +123,22 @@ def set_anatomicals(layout, subject, sessions):
     return spec, types
 
 
+def share_anatomicals(bids_data, reference):
+    """
+    Returns bids data of a session using the anatomical (T1w, T2w) data of
+    a reference session of the same subject, for sessions without their own.
+    :param bids_data: session spec yielded from read_bids_dataset.
+    :param reference: reference session spec.
+    """
+    shared = dict(bids_data)
+    for key in ('t1w', 't1w_metadata', 't2w', 't2w_metadata'):
+        shared[key] = reference[key]
+    shared['types'] = (bids_data['types'] - {'T1w', 'T2w'}).union(
+        reference['types'].intersection({'T1w', 'T2w'}))
+    shared['anat_session'] = reference['session']
+    return shared
+
+
 def set_functionals(layout, subject, sessions):
     """
     Returns dictionary of functional (bold) filepaths and associated metadata,
@@ -324,14 +346,9 @@ def get_fmriname(filename):
     # original filename, so get this as 3 pieces.
     name = os.path.basename(filename)
 
-    expr = re.compile(r'.*(ses-(?!None)[^_]+_).*')
-    session = expr.match(name)
-
-    expr = re.compile(r'.*(task-[^_]+_).*')
-    taskname = expr.match(name)
-
-    expr = re.compile(r'.*(run-[0-9]+).*')
-    run = expr.match(name)
+    session = _session_expr.match(name)
+    taskname = _task_expr.match(name)
+    run = _run_expr.match(name)
 
     if session:
         fmriname = session.group(1) + taskname.group(1)
@@ -353,8 +370,7 @@ def get_taskname(filename):
     :return: name of task, e.g. "task-nback"
     """
     name = os.path.basename(filename)
-    expr = re.compile(r'.*(task-[^_]+).*')
-    task = expr.match(name)
+    task = _taskname_expr.match(name)
     taskname = task.group(1)
     return taskname
 
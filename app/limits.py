@@ -0,0 +1,250 @@
+import os
+import shlex
+import shutil
+import tempfile
+import threading
+
+# cgroup v2 unified hierarchy
+CGROUP_ROOT = '/sys/fs/cgroup'
+# limits accepted by parse_limits and CommandLimits, with their types
+LIMITS = {'memory_gb': float, 'nice': int, 'private_tmp': bool}
+# messages of commands which failed to allocate memory under RLIMIT_AS
+ALLOCATION_ERRORS = (b'std::bad_alloc', b'MemoryError',
+                     b'Cannot allocate memory', b'out of memory',
+                     b'Out of memory')
+
+
+def parse_limits(text):
+    """
+    :param text: comma separated limits, e.g. "memory_gb:8,nice:10,private_tmp".
+    :return: dict of limits.
+    """
+    limits = {}
+    for item in text.split(','):
+        name, _, value = item.strip().partition(':')
+        if name not in LIMITS:
+            raise ValueError('"%s" is not a supported limit, use one of %s' %
+                             (name, ', '.join(sorted(LIMITS))))
+        if LIMITS[name] is bool:
+            limits[name] = value.lower() not in ('0', 'false', 'no')
+            continue
+        try:
+            limits[name] = LIMITS[name](value)
+        except ValueError:
+            raise ValueError('%s needs a number, e.g. "%s:8", not "%s"' %
+                             (name, name, item.strip()))
+    return limits
+
+
+class LimitKill(int):
+    """
+    exit status of a command killed by one of its resource limits.  Compares
+    equal to the exit status, the limit is in "limit".
+    """
+
+    def __new__(cls, value, limit):
+        obj = super(__class__, cls).__new__(cls, value)
+        obj.limit = limit
+        return obj
+
+    def __reduce__(self):
+        # keeps the limit when returned from a pool worker
+        return self.__class__, (int(self), self.limit)
+
+
+class CommandLimits(object):
+    """
+    Limits the resources of a single command: a memory cap, enforced by a
+    cgroup v2 group of its own where the cgroup of this process is delegated
+    to it, see _cgroup_parent, and by RLIMIT_AS otherwise, a nice level, and
+    a private TMPDIR which is removed once the command exits.  Used as a
+    context manager around the subprocess, whose command line is wrapped to
+    apply the limits, see _call.
+    """
+
+    def __init__(self, memory_gb=None, nice=None, private_tmp=False,
+                 tmp_root=None):
+        """
+        :param memory_gb: memory cap of the command and its children (GB).
+        :param nice: niceness added to the command.
+        :param private_tmp: run with a TMPDIR of its own.
+        :param tmp_root: directory in which the private TMPDIR is created.
+        Default is the system temporary directory.
+        """
+        self.memory = int(memory_gb * 1024 ** 3) if memory_gb else None
+        self.nice = nice
+        self.private_tmp = private_tmp
+        self.tmp_root = tmp_root
+        self.cgroup = None
+        self.tmpdir = None
+        # environment variables of the command
+        self.env = {}
+
+    def __bool__(self):
+        return bool(self.memory or self.nice or self.private_tmp)
+
+    def __enter__(self):
+        if self.memory:
+            self.cgroup = _make_cgroup(self.memory)
+        if self.private_tmp:
+            if self.tmp_root:
+                os.makedirs(self.tmp_root, exist_ok=True)
+            self.tmpdir = tempfile.mkdtemp(prefix='tmp-', dir=self.tmp_root)
+            self.env = {'TMPDIR': self.tmpdir, 'TMP': self.tmpdir,
+                        'TEMP': self.tmpdir}
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+        if self.cgroup:
+            try:
+                os.rmdir(self.cgroup)
+            except OSError:
+                # processes the command left behind still hold it
+                pass
+
+    def wrap(self, args):
+        """
+        :param args: command and arguments.
+        :return: command line of a shell which applies the limits to itself,
+        then executes the command, so that they are inherited by everything
+        it starts.  Limits are not applied between fork and exec, which is
+        unsafe in a threaded process.
+        """
+        steps = []
+        if self.cgroup:
+            steps.append('echo $$ > %s' % shlex.quote(
+                os.path.join(self.cgroup, 'cgroup.procs')))
+        elif self.memory:
+            steps.append('ulimit -v %d' % (self.memory // 1024))
+        if self.nice:
+            steps.append('exec nice -n %d "$@"' % self.nice)
+        else:
+            steps.append('exec "$@"')
+        return ['sh', '-c', ' && '.join(steps), 'sh'] + list(args)
+
+    def check(self, result, err_log):
+        """
+        :param result: exit status of the command.
+        :param err_log: stderr log of the command.
+        :return: result, as a LimitKill if the command was killed by its
+        memory limit: the cgroup's oom killer fired or, under RLIMIT_AS, the
+        command failed to allocate memory.
+        """
+        if result == 0 or not self.memory:
+            return result
+        if self.cgroup:
+            killed = _oom_kills(self.cgroup) > 0
+        else:
+            killed = _tail_contains(err_log, ALLOCATION_ERRORS)
+        return LimitKill(result, 'memory') if killed else result
+
+
+def _own_cgroup():
+    # cgroup v2 path of this process, None on a v1 or hybrid hierarchy
+    try:
+        with open('/proc/self/cgroup') as fd:
+            for line in fd:
+                hierarchy, _, path = line.strip().split(':', 2)
+                if hierarchy == '0':
+                    return os.path.join(CGROUP_ROOT, path.lstrip('/'))
+    except OSError:
+        pass
+    return None
+
+
+# cgroup which holds the cgroups of the commands, see _cgroup_parent
+_parent = {}
+_parent_lock = threading.Lock()
+
+
+def _cgroup_parent():
+    """
+    enables memory control for the children of this process's cgroup, once
+    per process.  A cgroup other than the root may only enable controllers
+    for its children while it holds no processes, so the processes of the
+    cgroup are first moved into a leaf, "pipeline", next to which the
+    cgroups of the commands are created.
+    :return: path of the cgroup in which to create the cgroups of the
+    commands, or None if this process's cgroup is not delegated to it or
+    has no memory controller.
+    """
+    with _parent_lock:
+        if 'path' in _parent:
+            return _parent['path']
+        _parent['path'] = None
+        own = _own_cgroup()
+        if own is None or not all(
+                os.access(os.path.join(own, name), os.W_OK)
+                for name in ('cgroup.procs', 'cgroup.subtree_control')):
+            return None
+        try:
+            with open(os.path.join(own, 'cgroup.controllers')) as fd:
+                if 'memory' not in fd.read().split():
+                    return None
+            subtree_control = os.path.join(own, 'cgroup.subtree_control')
+            with open(subtree_control) as fd:
+                enabled = fd.read().split()
+            if 'memory' not in enabled:
+                leaf = os.path.join(own, 'pipeline')
+                os.makedirs(leaf, exist_ok=True)
+                with open(os.path.join(own, 'cgroup.procs')) as fd:
+                    pids = fd.read().split()
+                for pid in pids:
+                    try:
+                        with open(os.path.join(leaf, 'cgroup.procs'),
+                                  'w') as fd:
+                            fd.write(pid)
+                    except OSError:
+                        # exited, or a kernel thread of the root cgroup
+                        pass
+                with open(subtree_control, 'w') as fd:
+                    fd.write('+memory')
+        except OSError:
+            return None
+        _parent['path'] = own
+        return own
+
+
+def _make_cgroup(memory):
+    """
+    :param memory: memory.max of the new cgroup (bytes).
+    :return: path of a new cgroup for a command, or None if cgroup v2
+    memory control is not available to this process.
+    """
+    parent = _cgroup_parent()
+    if parent is None:
+        return None
+    path = None
+    try:
+        path = tempfile.mkdtemp(prefix='hcp-', dir=parent)
+        with open(os.path.join(path, 'memory.max'), 'w') as fd:
+            fd.write(str(memory))
+    except OSError:
+        if path:
+            os.rmdir(path)
+        return None
+    return path
+
+
+def _oom_kills(cgroup):
+    try:
+        with open(os.path.join(cgroup, 'memory.events')) as fd:
+            for line in fd:
+                name, value = line.split()
+                if name == 'oom_kill':
+                    return int(value)
+    except OSError:
+        pass
+    return 0
+
+
+def _tail_contains(path, messages, size=64 * 1024):
+    try:
+        with open(path, 'rb') as fd:
+            fd.seek(max(0, os.fstat(fd.fileno()).st_size - size))
+            tail = fd.read()
+    except OSError:
+        return False
+    return any(message in tail for message in messages)
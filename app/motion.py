@@ -0,0 +1,34 @@
+import numpy as np
+
+
+def framewise_displacement(movement_regressors, brain_radius=50.):
+    """
+    computes the framewise displacement of a BOLD run.
+    :param movement_regressors: HCP Movement_Regressors.txt, the first six
+    columns of which are x, y, z translations in mm and rotations in degrees.
+    :param brain_radius: radius in mm converting rotations to displacement.
+    :return: array of displacement per frame in mm, 0 for the first frame.
+    """
+    motion = np.loadtxt(movement_regressors, ndmin=2)[:, :6]
+    motion[:, 3:] = np.deg2rad(motion[:, 3:]) * brain_radius
+    fd = np.zeros(len(motion))
+    fd[1:] = np.abs(np.diff(motion, axis=0)).sum(axis=1)
+    return fd
+
+
+def count_usable_frames(fd, fd_threshold, skip_frames=0, contiguous_frames=5):
+    """
+    counts the frames below the displacement threshold which are part of a
+    sequence of at least contiguous_frames usable frames.
+    :param fd: array of framewise displacement.
+    :param fd_threshold: maximum displacement of a usable frame.
+    :param skip_frames: number of initial frames which are never usable.
+    :param contiguous_frames: minimum length of a sequence of usable frames.
+    :return: number of usable frames.
+    """
+    usable = fd <= fd_threshold
+    usable[:skip_frames] = False
+    # starts and ends of sequences of usable frames
+    edges = np.diff(np.concatenate(([0], usable.astype(np.int8), [0])))
+    lengths = np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)
+    return int(lengths[lengths >= contiguous_frames].sum())
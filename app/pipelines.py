@@ -1,12 +1,41 @@
+import glob
 import inspect
 import json
 import multiprocessing as mp
+import re
+import shlex
+import shutil
+import socket
+import sqlite3
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
 
 import os
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from types import MappingProxyType
+
+import checkpoint
+
+from affinity import allowed_cpus, partition
 from helpers import (get_fmriname, get_readoutdir, get_realdwelltime,
                      get_relpath, get_taskname, ijk_to_xyz)
+from limits import CommandLimits, LimitKill
+from motion import count_usable_frames, framewise_displacement
+from storage import (InputCache, compress_file, nifti_header,
+                     file_system_time, reaper, recompress_images,
+                     restore_writable, scan_paths, shadow_scripts,
+                     verify_files, write_script)
+
+# anatomical output folders which other sessions link to, see
+# --anat-from-session, and the file in the reference session's "files"
+# folder listing those sessions.  Per run results are not shared.
+SHARED_ANAT_FOLDERS = ('T1w', 'T2w', 'MNINonLinear')
+SHARED_ANAT_MARKER = '.anat_shared'
 
 
 class ParameterSettings(object):
@@ -90,6 +119,12 @@ class ParameterSettings(object):
     skip_seconds = 5
     # cont frames
     contiguous_frames = 5
+    # runs with fewer usable frames after FMRIVolume are skipped, see
+    # set_min_usable_frames
+    min_usable_frames = None
+
+    # formatted parameters shared by all stages, see get_params
+    _snapshot = None
 
     def __init__(self, bids_data, output_directory):
         """
@@ -199,7 +234,11 @@ class ParameterSettings(object):
         #self.deriv = '/'.join(deriv_root)
 
         # @ input files @ #
-        session_root = '/'.join(self.t1w[0].split('/')[:-2])
+        if self.bids_data.get('anat_session') and self.bids_data['func']:
+            # anatomicals of another session, see share_anatomicals
+            session_root = '/'.join(self.bids_data['func'][0].split('/')[:-2])
+        else:
+            session_root = '/'.join(self.t1w[0].split('/')[:-2])
         self.unproc = os.path.join(session_root, 'func')
 
         bids_input_root = '/'.join(session_root.split('/')[:-2])
@@ -208,14 +247,40 @@ class ParameterSettings(object):
         # print command for HCP
         self.printcom = ''
 
+        # dataset-wide status index, see StatusIndex
+        self.status_index = None
+
+        # FSLOUTPUTTYPE per stage name, default inherits the environment
+        self.fsloutputtype = {}
+        # per stage subprocess limits, see set_resource_limits
+        self.resource_limits = {}
+
+        # decompressed input copies, see set_input_cache
+        self.input_cache = None
+        self.input_cache_gb = None
+
+        # table of BOLD runs, see get_runs
+        self._runs = None
+
     def __getitem__(self, item):
         # item getter
-        return self._params()[item]
+        return self.get_params()[item]
 
     def __setitem__(self, key, value):
         # item setter
         setattr(self, key, value)
 
+    def __getstate__(self):
+        # the snapshot cannot be pickled, workers format their own
+        return dict(self.__dict__, _snapshot=None)
+
+    def __setattr__(self, key, value):
+        # parameters changed, e.g. by a setter, are formatted again by the
+        # next get_params
+        super(__class__, self).__setattr__(key, value)
+        if not key.startswith('_'):
+            super(__class__, self).__setattr__('_snapshot', None)
+
     def _params(self):
         """
         gets all class parameters which do not start with an underscore.
@@ -238,11 +303,28 @@ class ParameterSettings(object):
 
     def get_params(self):
         """
-        formats and returns instance variables.
-        :return: dictionary of instance variable names and values
+        formats and returns instance variables.  The formatted parameters
+        are computed once, until a parameter changes, and shared by all
+        stages, which copy them.
+        :return: read-only dictionary of instance variable names and values
         """
-        self._format()
-        return self._params()
+        if self._snapshot is None:
+            self._format()
+            self._snapshot = MappingProxyType(self._params())
+        return self._snapshot
+
+    def record(self):
+        """
+        writes the parameters and the expected outputs table a run of the
+        session starts with to its log folder, as parameters.json and
+        pipeline_expected_outputs.json.  Only for runs which run stages, so
+        that previews leave the record of the last run alone.
+        :return: None
+        """
+        _write_record(os.path.join(self.logs, 'parameters.json'),
+                      dict(self.get_params()))
+        _write_record(os.path.join(self.logs, 'pipeline_expected_outputs.json'),
+                      get_expected_outputs_table())
 
     def get_bids(self, *args):
         """
@@ -256,6 +338,69 @@ class ParameterSettings(object):
             val = val[arg]
         return val
 
+    def get_runs(self):
+        """
+        table of the BOLD runs of the session, built once for all stages.
+        :return: list of BoldRun, in the order of the functional bids data.
+        """
+        if self._runs is None:
+            self._runs = self._build_runs()
+        return self._runs
+
+    def _build_runs(self):
+        # IntendedFor target to spin echo index, per direction
+        intended = {}
+        joined = {}
+        for direction in ('positive', 'negative'):
+            metadata = self.bids_data.get('fmap_metadata', {})
+            metadata = metadata.get(direction, []) \
+                if isinstance(metadata, dict) else []
+            intended[direction] = {}
+            for idx, sefm in enumerate(metadata):
+                for target in sefm.get('IntendedFor', []):
+                    intended[direction].setdefault(target, idx)
+            joined[direction] = [' '.join(sefm.get('IntendedFor', []))
+                                 for sefm in metadata]
+
+        runs = []
+        for fmri, meta in zip(self.bids_data['func'],
+                              self.bids_data['func_metadata']):
+            sefmaps = None
+            if 'epi' in self.bids_data['types']:
+                relpath = get_relpath(fmri)
+                sefmaps = []
+                for direction in ('positive', 'negative'):
+                    idx = intended[direction].get(relpath)
+                    if idx is None:
+                        # e.g. bids URIs, which contain the relative path
+                        idx = next((i for i, x in enumerate(joined[direction])
+                                    if relpath in x), None)
+                    if idx is None:
+                        if len(joined[direction]) > 1:
+                            print('WARNING: the intended %s spin echo for '
+                                  '%s is not explicitly defined in the '
+                                  'sidecar json.' % (direction, relpath))
+                        idx = 0
+                    sefmaps.append(idx)
+                sefmaps = tuple(sefmaps)
+            pe_dir = meta.get('PhaseEncodingDirection')
+            try:
+                header = nifti_header(fmri)
+            except (OSError, EOFError):
+                # missing or unreadable, e.g. not yet staged
+                header = None
+            if header is None:
+                frames = None
+            else:
+                frames = header[0][4] if header[0][0] >= 4 else 1
+            runs.append(BoldRun(
+                fmri=fmri, fmriname=get_fmriname(fmri),
+                task=get_taskname(fmri),
+                pe_dir=ijk_to_xyz(pe_dir) if pe_dir else None,
+                sefmaps=sefmaps, frames=frames,
+                tr=meta.get('RepetitionTime')))
+        return runs
+
     def set_anat_only(self, anat_only=False):
         if anat_only:
             # Assume there is no 'func' data...
@@ -278,6 +423,116 @@ class ParameterSettings(object):
         if value:
             self.dcmethod = value
 
+    def set_scratch(self, path, bids_data=None):
+        """
+        run stages in a node-local copy of the session, see ScratchSpace.
+        :param path: replacement for the "files" output folder.
+        :param bids_data: bids data struct pointing at staged input copies.
+        :return: None
+        """
+        self.path = path
+        if bids_data is not None:
+            self.bids_data = bids_data
+            self._runs = None
+            self.t1w = bids_data['t1w']
+            if self.useT2 == 'true':
+                self.t2w = bids_data['t2w']
+            if self.dcmethod == 'FIELDMAP':
+                self.fmapmag = bids_data['fmap']['magnitude1']
+                self.fmapphase = bids_data['fmap']['phasediff']
+
+    def set_fsloutputtype(self, stage_name, output_type):
+        """
+        set FSLOUTPUTTYPE for a stage's subprocesses.  With NIFTI,
+        intermediates are written uncompressed and the images the stage
+        wrote are compressed once it completes, see
+        Stage.recompress_outputs.
+        :param stage_name: stage class name, e.g. FMRIVolume.
+        :param output_type: NIFTI_GZ or NIFTI.
+        :return: None
+        """
+        self.fsloutputtype = dict(self.fsloutputtype,
+                                  **{stage_name: output_type})
+
+    def set_resource_limits(self, stage_name, **limits):
+        """
+        limit the resources of each of a stage's subprocesses, see
+        CommandLimits.
+        :param stage_name: stage class name, or "all" for every stage.
+        :param limits: any of memory_gb, nice and private_tmp.
+        :return: None
+        """
+        limits = dict(self.resource_limits.get(stage_name, {}), **limits)
+        self.resource_limits = dict(self.resource_limits,
+                                    **{stage_name: limits})
+
+    def set_status_index(self, output_dir):
+        """
+        mirror stage status updates into the dataset-wide status index.
+        :param output_dir: root output directory shared by all sessions.
+        :return: None
+        """
+        self.status_index = os.path.join(output_dir, StatusIndex.name)
+
+    def set_input_cache(self, cache_dir, max_gb=50):
+        """
+        read gzipped BOLD and field map inputs from uncompressed copies in a
+        cache shared between sessions, see InputCache.
+        :param cache_dir: cache directory.
+        :param max_gb: size of the cache (GB).
+        :return: None
+        """
+        self.input_cache = cache_dir
+        self.input_cache_gb = max_gb
+
+    def set_min_usable_frames(self, frames):
+        """
+        skip BOLD runs with fewer usable frames, by fd_threshold and
+        contiguous_frames, in the stages following FMRIVolume.
+        :param frames: minimum number of usable frames.
+        :return: None
+        """
+        self.min_usable_frames = frames
+
+    def exclude_func(self, fmri):
+        """
+        removes a BOLD run from the runs processed by the following stages.
+        :param fmri: functional filename.
+        :return: None
+        """
+        idx = self.bids_data['func'].index(fmri)
+        self.bids_data = dict(self.bids_data)
+        for key in ('func', 'func_metadata'):
+            self.bids_data[key] = self.bids_data[key][:idx] + \
+                self.bids_data[key][idx + 1:]
+        if self._runs is not None:
+            self._runs = [run for run in self._runs if run.fmri != fmri]
+
+
+class BoldRun(object):
+    """
+    Parameters of a BOLD run read from its filename, sidecar and header,
+    see ParameterSettings.get_runs.
+
+    fmri: functional bids nifti.
+    fmriname: output name of the run, see get_fmriname.
+    task: task name, see get_taskname.
+    pe_dir: phase encoding direction, x, y, z, x-, y- or z-, or None.
+    sefmaps: indices of the positive and negative spin echo field maps
+    intended for the run, or None without spin echo field maps.
+    frames: number of volumes, None if the header could not be read.
+    tr: repetition time (s).
+    """
+    __slots__ = ('fmri', 'fmriname', 'task', 'pe_dir', 'sefmaps', 'frames',
+                 'tr')
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+    def __repr__(self):
+        return 'BoldRun(%s)' % self.fmriname
+
 
 class Status(object):
     """Status provides and updates node status information.
@@ -297,12 +552,17 @@ class Status(object):
         'succeeded': 1,
     }
 
-    def __init__(self, folder_path):
+    def __init__(self, folder_path, index=None, key=None):
         """
         param folder_path (str): absolute path to the Stage's bookkeeping
             (e.g. /output/sub/ses/processing_logs/PipelineStage)
+        param index (StatusIndex): optional dataset-wide index which
+            receives a copy of every update.
+        param key (tuple): (subject, session, stage) row of the index.
         """
         self.file_path = os.path.join(folder_path, Status.name)
+        self.index = index
+        self.key = key
 
         defaults = {
             'num_runs': 0,
@@ -332,6 +592,8 @@ class Status(object):
         """
         with open(self.file_path, 'w') as fd:
             json.dump(contents, fd, indent=4)
+        if self.index is not None:
+            self.index.update(*self.key, **contents)
 
     def increment_run(self):
         # tic runs up, should be called on stage start.
@@ -370,6 +632,304 @@ class Status(object):
                                        Status.states['unchecked'])
 
 
+class StatusIndex(object):
+    """StatusIndex keeps a dataset-wide record of every Status update.
+
+    Each process appends one JSON line per update to a journal of its own,
+    {host}-{pid}.jsonl in the index folder, so that no file is written by
+    sessions on different nodes: a shared sqlite database is not safe on
+    the NFS and Lustre file systems outputs usually live on.  Queries run
+    on an in-memory sqlite database, with one row per (subject, session,
+    stage), so progress of a whole dataset can be queried without opening
+    each status.json.  The database is loaded from a snapshot in the index
+    folder, brought up to date with the journal lines appended since, by
+    journal offset, and written back as a new snapshot which replaces the
+    old one, so that sqlite never locks or writes a shared file.  Failures
+    to write the journal are reported but never interrupt a stage.
+    """
+    name = 'status_index'
+    snapshot = 'index.sqlite'
+    # version of the snapshot schema, older snapshots are rebuilt
+    version = 1
+    schema = """
+        CREATE TABLE status (
+            subject TEXT NOT NULL,
+            session TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            node_status INTEGER NOT NULL,
+            num_runs INTEGER NOT NULL DEFAULT 0,
+            comment TEXT NOT NULL DEFAULT '',
+            last_failure TEXT NOT NULL DEFAULT '',
+            failed REAL NOT NULL DEFAULT 0,
+            host TEXT NOT NULL DEFAULT '',
+            updated REAL NOT NULL,
+            PRIMARY KEY (subject, session, stage)
+        );
+        CREATE TABLE journals (
+            name TEXT PRIMARY KEY,
+            offset INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, folder_path):
+        """
+        :param folder_path: path to the folder of journals, created by the
+        first update.
+        """
+        self.folder_path = folder_path
+        # up to date index, see _database
+        self._conn = None
+
+    def __getstate__(self):
+        # stages are pickled into pool workers, which never query
+        return dict(self.__dict__, _conn=None)
+
+    def update(self, subject, session, stage, node_status, num_runs=0,
+               comment='', updated=None, **kwargs):
+        """
+        record the status of a single stage of a session.
+        :param subject: participant label.
+        :param session: session label.
+        :param stage: stage class name.
+        :param node_status: one of Status.states.
+        :param num_runs: number of times the stage was started.
+        :param comment: status comment, e.g. failure reason.
+        :param updated: time of the update, default is now.
+        :return: None
+        """
+        host = socket.gethostname()
+        line = json.dumps({
+            'subject': subject, 'session': session, 'stage': stage,
+            'node_status': node_status, 'num_runs': num_runs,
+            'comment': comment, 'host': host,
+            'updated': time.time() if updated is None else updated})
+        journal = os.path.join(self.folder_path,
+                               '%s-%s.jsonl' % (host, os.getpid()))
+        try:
+            os.makedirs(self.folder_path, exist_ok=True)
+            with _journal_lock, open(journal, 'a') as fd:
+                fd.write(line + '\n')
+        except OSError as e:
+            print('WARNING: could not update status index %s: %s' %
+                  (journal, e))
+        self._conn = None
+
+    def rebuild(self, output_dir):
+        """
+        record every status.json under output_dir in the index, e.g. for
+        sessions which were run before the index existed.
+        :param output_dir: root output directory shared by all sessions.
+        :return: number of status files indexed.
+        """
+        pattern = os.path.join(output_dir, 'sub-*', 'ses-*', 'logs', '*',
+                               Status.name)
+        count = 0
+        for status_file in glob.iglob(pattern):
+            parts = status_file.split(os.sep)
+            stage, session, subject = parts[-2], parts[-4], parts[-5]
+            with open(status_file) as fd:
+                contents = json.load(fd)
+            self.update(subject[len('sub-'):], session[len('ses-'):], stage,
+                        updated=os.path.getmtime(status_file), **contents)
+            count += 1
+        return count
+
+    def _database(self):
+        """
+        :return: in-memory sqlite connection holding the latest status of
+        each stage, as of the last query or update of this instance.
+        """
+        if self._conn is None:
+            conn = sqlite3.connect(':memory:')
+            conn.create_function('REGEXP', 2, _regexp)
+            if not self._load(conn):
+                conn.close()
+                conn = sqlite3.connect(':memory:')
+                conn.create_function('REGEXP', 2, _regexp)
+                conn.executescript(self.schema)
+                conn.execute('PRAGMA user_version = %d' % self.version)
+            if self._catch_up(conn):
+                conn.commit()
+                self._save(conn)
+            self._conn = conn
+        return self._conn
+
+    def _load(self, conn):
+        """
+        copies the snapshot into conn.  It is opened as immutable, so that
+        sqlite reads it without locks, and is only ever replaced, never
+        modified.
+        :return: True if a snapshot of the current schema was loaded.
+        """
+        path = os.path.join(self.folder_path, self.snapshot)
+        if not os.path.exists(path):
+            return False
+        try:
+            snapshot = sqlite3.connect(
+                'file:%s?immutable=1' % urllib.parse.quote(path), uri=True)
+            try:
+                snapshot.backup(conn)
+            finally:
+                snapshot.close()
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+        except sqlite3.Error:
+            return False
+        return version == self.version
+
+    def _catch_up(self, conn):
+        """
+        applies the journal lines appended since the offsets stored in
+        conn.  A partly written last line is left for the next query.
+        :return: True if conn was updated.
+        """
+        offsets = dict(conn.execute('SELECT name, offset FROM journals'))
+        updated = False
+        records = []
+        for journal in glob.iglob(os.path.join(self.folder_path, '*.jsonl')):
+            name = os.path.basename(journal)
+            offset = offsets.get(name, 0)
+            try:
+                with open(journal, 'rb') as fd:
+                    if os.fstat(fd.fileno()).st_size < offset:
+                        # replaced, its lines apply again without harm
+                        offset = 0
+                    fd.seek(offset)
+                    data = fd.read()
+            except OSError:
+                continue
+            end = data.rfind(b'\n') + 1
+            if not end:
+                continue
+            for line in data[:end].decode(errors='replace').splitlines():
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+            offsets[name] = offset + end
+            conn.execute('INSERT OR REPLACE INTO journals (name, offset) '
+                         'VALUES (?, ?)', (name, offsets[name]))
+            updated = True
+        self._apply(conn, records)
+        return updated
+
+    @staticmethod
+    def _apply(conn, records):
+        """
+        merges status records into conn, in any order: the latest record
+        of a stage gives its status, and its latest failure record its last
+        failure.
+        :param conn: sqlite connection.
+        :param records: list of journal records.
+        :return: None
+        """
+        latest = {}
+        failures = {}
+        for record in records:
+            key = (record['subject'], record['session'], record['stage'])
+            if key not in latest or \
+                    record['updated'] >= latest[key]['updated']:
+                latest[key] = record
+            if record['node_status'] == Status.states['failed'] and (
+                    key not in failures or
+                    record['updated'] >= failures[key]['updated']):
+                failures[key] = record
+        where = 'WHERE subject = ? AND session = ? AND stage = ?'
+        for key, record in latest.items():
+            row = conn.execute('SELECT updated, last_failure, failed FROM '
+                               'status ' + where, key).fetchone()
+            updated, last_failure, failed = row or (None, '', 0)
+            failure = failures.get(key)
+            if failure and failure['updated'] >= failed:
+                last_failure, failed = failure['comment'], failure['updated']
+            if updated is not None and updated > record['updated']:
+                conn.execute('UPDATE status SET last_failure = ?, failed = ? '
+                             + where, (last_failure, failed) + key)
+                continue
+            conn.execute(
+                'INSERT OR REPLACE INTO status (subject, session, stage, '
+                'node_status, num_runs, comment, last_failure, failed, host, '
+                'updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                key + (record['node_status'], record.get('num_runs', 0),
+                       record.get('comment', ''), last_failure, failed,
+                       record.get('host', ''), record['updated']))
+
+    def _save(self, conn):
+        """
+        replaces the snapshot with the contents of conn.  The database is
+        written to local temporary storage, then copied next to the
+        snapshot and renamed over it.  Concurrent queries each write a
+        complete snapshot, the last one replaces the others.
+        :return: None
+        """
+        path = os.path.join(self.folder_path, self.snapshot)
+        tmp = '%s.%s-%s' % (path, socket.gethostname(), os.getpid())
+        fd, local = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        try:
+            copy = sqlite3.connect(local)
+            try:
+                conn.backup(copy)
+            finally:
+                copy.close()
+            shutil.copyfile(local, tmp)
+            os.replace(tmp, path)
+        except (OSError, sqlite3.Error) as e:
+            print('WARNING: could not save status index %s: %s' % (path, e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        finally:
+            os.remove(local)
+
+    def _query(self, sql, params, subjects=None, sessions=None):
+        """
+        runs a query with optional participant and session filters.  The
+        sql must contain a "{where}" placeholder following its own WHERE.
+        """
+        where = ''
+        params = list(params)
+        for column, values in (('subject', subjects), ('session', sessions)):
+            if values:
+                where += ' AND %s IN (%s)' % (column,
+                                              ', '.join('?' * len(values)))
+                params += list(values)
+        return self._database().execute(sql.format(where=where),
+                                        params).fetchall()
+
+    def stage_counts(self, subjects=None, sessions=None):
+        """
+        :return: list of (stage, node_status, count) rows.
+        """
+        return self._query(
+            'SELECT stage, node_status, COUNT(*) FROM status WHERE 1 {where} '
+            'GROUP BY stage, node_status', (), subjects, sessions)
+
+    def running(self, subjects=None, sessions=None):
+        """
+        :return: list of (subject, session, stage, host, updated) rows for
+        stages which have started but not finished.
+        """
+        return self._query(
+            'SELECT subject, session, stage, host, updated FROM status '
+            'WHERE node_status = ? {where} ORDER BY updated',
+            (Status.states['incomplete'],), subjects, sessions)
+
+    def failures(self, pattern='', subjects=None, sessions=None):
+        """
+        :param pattern: regular expression searched for in the last failure
+        comment of each stage.
+        :return: list of (subject, session, stage, node_status, last_failure)
+        rows.
+        """
+        # raises re.error on an invalid pattern, not an sqlite error
+        re.compile(pattern)
+        return self._query(
+            'SELECT subject, session, stage, node_status, last_failure '
+            'FROM status WHERE last_failure != \'\' '
+            'AND REGEXP(?, last_failure) {where} '
+            'ORDER BY subject, session, stage',
+            (pattern,), subjects, sessions)
+
+
 class Stage(object):
     """
     Base abstract class for pipeline stages.
@@ -399,18 +959,51 @@ class Stage(object):
     check_expected_outputs_active = True
     remove_expected_outputs_active = True
     ignore_expected_outputs = False
+    check_output_integrity = False
+    fast_rerun = False
+    pin_cpus = False
+
+    # directories holding only outputs of this stage, moved to trash as a
+    # whole on rerun when fast_rerun is active.  Formatted like the
+    # expected outputs, per run paths may use {fmriname}.
+    output_dirs_spec = []
+
+    # directories in which this stage writes images, searched for
+    # uncompressed images when it runs with an FSLOUTPUTTYPE of NIFTI, see
+    # recompress_outputs.  Formatted like output_dirs_spec.
+    image_dirs_spec = []
+    # gzip level of the recompressed images, fast rather than small
+    recompress_level = 1
+
+    # writes the anatomical outputs in SHARED_ANAT_FOLDERS
+    writes_anatomicals = False
+
+    # class names of the stages whose outputs this stage reads.  Stages run
+    # once all of their dependencies which are part of the run succeeded,
+    # concurrently with other stages which are ready, see run_stages.
+    depends_on = ()
 
     def __init__(self, config):
         """
         :param config: instance of ParameterSettings
         """
         self.config = config
-        self.kwargs = config.get_params()
-        self.status = Status(self._get_log_dir())
-        here = os.path.dirname(os.path.realpath(__file__))
-        with open(os.path.join(here, 'pipeline_expected_outputs.json')) as fd:
-            jso = json.load(fd)
-            self.expected_outputs_spec = jso[self.__class__.__name__]
+        self.kwargs = dict(config.get_params())
+        # environment variables set for this stage's subprocesses
+        self.env = {}
+        # cores available to the running stage, set by run
+        self.ncpus = 1
+        # cpus the running stage is pinned to, see activate_cpu_pinning
+        self.cpus = None
+        if self.kwargs['status_index']:
+            index = StatusIndex(self.kwargs['status_index'])
+            key = (self.kwargs['subject'], str(self.kwargs['session']),
+                   self.__class__.__name__)
+            self.status = Status(self._get_log_dir(), index, key)
+        else:
+            self.status = Status(self._get_log_dir())
+        self.expected_outputs_spec = list(
+            get_expected_outputs_table()[self.__class__.__name__])
 
     def __str__(self):
         cmdline = self.cmdline()
@@ -442,6 +1035,23 @@ class Stage(object):
         # stages will not terminate even if missing expected outputs
         cls.ignore_expected_outputs = True
 
+    @classmethod
+    def activate_fast_rerun(cls):
+        # stages move earlier output directories to trash instead of
+        # deleting them before running.
+        cls.fast_rerun = True
+
+    @classmethod
+    def activate_cpu_pinning(cls):
+        # concurrent commands run on disjoint sets of cpus, each with as
+        # many threads as cpus.
+        cls.pin_cpus = True
+
+    @classmethod
+    def activate_check_output_integrity(cls):
+        # expected outputs must also be non-empty, valid images
+        cls.check_output_integrity = True
+
     def _get_log_dir(self):
         """
         returns the subject's log directory for this stage
@@ -452,22 +1062,32 @@ class Stage(object):
             os.makedirs(log_dir)
         return log_dir
 
-    def check_expected_outputs(self):
+    def check_expected_outputs(self, record=True):
         """
-        checks the existence of the expected outputs for this stage.
+        checks the existence, and optionally the integrity, of the expected
+        outputs for this stage.
+        :param record: store the report in the stage status.
         :return: True if all outputs exist, else False.
         """
         if not self.check_expected_outputs_active:
             return True
 
         outputs = self.get_expected_outputs()
-        checklist = [os.path.exists(p) for p in outputs]
-        if not all(checklist):
-            print('missing expected outputs from %s' %
-                  self.__class__.__name__)
-            dne_list = [f for i, f in enumerate(outputs) if not checklist[i]]
-            for f in dne_list:
+        report = verify_files(outputs, integrity=self.check_output_integrity)
+        if record:
+            self.status['expected_outputs'] = report
+        name = self.__class__.__name__
+        if report['missing']:
+            print('missing expected outputs from %s' % name)
+            for f in report['missing']:
                 print('file not found: %s' % f)
+        if report['empty'] or report['invalid']:
+            print('damaged expected outputs from %s' % name)
+            for f in report['empty']:
+                print('file is empty: %s' % f)
+            for f, reason in report['invalid']:
+                print('file is invalid (%s): %s' % (reason, f))
+        if report['missing'] or report['empty'] or report['invalid']:
             if not self.ignore_expected_outputs:
                 return False
 
@@ -496,17 +1116,25 @@ class Stage(object):
 
     def remove_expected_outputs(self):
         """
-        removes expected outputs for this stage if they exist.
+        removes expected outputs for this stage if they exist.  If
+        fast_rerun is active, the stage's output directories are first moved
+        to trash and deleted in the background.
         :return: None
         """
-        if not self.remove_expected_outputs:
+        if not self.remove_expected_outputs_active:
             return
-        outputs = self.get_expected_outputs()
-        checklist = [os.path.isfile(p) for p in outputs]
-        if any(checklist):
+        if self.fast_rerun and self.output_dirs_spec:
+            trash_root = os.path.join(
+                os.path.dirname(self.kwargs['path']), '.trash')
+            reaper.trash(_format_paths(self.output_dirs_spec, self.kwargs,
+                                       self.config.get_runs()),
+                         trash_root)
+        entries = scan_paths(self.get_expected_outputs())
+        rm_list = [f for f, entry in entries.items()
+                   if entry is not None and entry.is_file()]
+        if rm_list:
             print('found outputs from an earlier run of %s' %
                   self.__class__.__name__)
-            rm_list = [f for i, f in enumerate(outputs) if checklist[i]]
             for f in rm_list:
                 print('removing %s' % f)
                 os.remove(f)
@@ -517,7 +1145,40 @@ class Stage(object):
         :return: None
         """
         self.status.update_start_run()
+        self.release_shared_anatomicals()
         self.remove_expected_outputs()
+        self.make_wrappers()
+
+    def make_wrappers(self):
+        """
+        writes the wrapper scripts through which this stage's commands run,
+        setting the environment and script of the commands to use them.
+        Called by setup, and by CommandGraph for the exported commands.
+        Override where a stage wraps parts of its scripts.
+        :return: None
+        """
+        pass
+
+    def release_shared_anatomicals(self):
+        """
+        gives write permission back to the anatomical outputs of this
+        session before an anatomical stage rewrites them, where other
+        sessions linked to them read-only.  Those sessions see the new
+        outputs.
+        :return: None
+        """
+        marker = os.path.join(self.kwargs['path'], SHARED_ANAT_MARKER)
+        if not (self.writes_anatomicals and self.call_active and
+                os.path.exists(marker)):
+            return
+        with open(marker) as fd:
+            sessions = fd.read().splitlines()
+        print('WARNING: rerunning %s, whose outputs are linked into %s' %
+              (self.__class__.__name__, ', '.join(sessions)))
+        for folder in SHARED_ANAT_FOLDERS:
+            restore_writable(os.path.join(self.kwargs['path'], folder),
+                             exclude=('Results',))
+        os.remove(marker)
 
     def teardown(self, result=0):
         """
@@ -526,10 +1187,20 @@ class Stage(object):
         script.
         :return: None
         """
+        kills = [r.limit for r in (result if isinstance(result, list)
+                                   else [result])
+                 if isinstance(r, LimitKill)]
+        if self._get_resource_limits():
+            self.status['limit_kills'] = len(kills)
         if isinstance(result, list) and all(v == 0 for v in result):
             result = 0
         if result == 0:
             self.status.update_success()
+        elif kills:
+            self.status.update_failure(
+                'stage killed by its %s limit, exit code %s' %
+                (' and '.join(sorted(set(kills))), result)
+            )
         else:
             self.status.update_failure(
                 'stage terminated with exit code %s' % result
@@ -577,32 +1248,145 @@ class Stage(object):
         for multithreaded computation.
         :return: None
         """
+        self.ncpus = ncpus
+        if self.pin_cpus and not self.cpus:
+            self.cpus = allowed_cpus(ncpus)
+        start = self.recompress_start()
         self.setup()
+        cmdlist = self.get_commands()
         # a generator cmdline supports parallel execution
         if inspect.isgeneratorfunction(self.cmdline):
-            cmdlist = []
-            for cmd in self.cmdline():
-                log_dir = self._get_log_dir()
-                out_log = os.path.join(log_dir,
-                                       self.kwargs['fmriname'] + '.out')
-                err_log = os.path.join(log_dir,
-                                       self.kwargs['fmriname'] + '.err')
-                cmdlist.append((cmd, out_log, err_log))
-            with mp.Pool(processes=ncpus) as pool:
+            processes = ncpus
+            if self.pin_cpus:
+                # fewer commands than cores run with more threads each
+                processes = max(1, min(ncpus, len(cmdlist)))
+            with self._pool(processes) as pool:
                 result = pool.starmap(self.call, cmdlist)
         else:
-            cmd = self.cmdline()
-            log_dir = self._get_log_dir()
-            out_log = os.path.join(log_dir, self.__class__.__name__ + '.out')
-            err_log = os.path.join(log_dir, self.__class__.__name__ + '.err')
-            result = self.call(cmd, out_log, err_log, num_threads=ncpus)
+            result = self.call(*cmdlist[0], num_threads=ncpus)
+        self.recompress_outputs(ncpus, start)
         self.teardown(result)
 
+    def _pool(self, processes):
+        """
+        :param processes: number of worker processes.
+        :return: process pool, whose workers take the runtime settings of
+        this process and are each pinned to a disjoint subset of the stage's
+        cpus if pinning is active.
+        """
+        sets = None
+        if self.pin_cpus and self.cpus:
+            sets = _mp_context.Queue()
+            for cpus in partition(self.cpus, processes):
+                sets.put(cpus)
+        return _mp_context.Pool(processes=processes, initializer=_init_worker,
+                                initargs=(_runtime_settings(), sets))
+
+    def get_commands(self):
+        """
+        :return: list of command, out log, err log of the main script, one
+        per concurrent execution if cmdline is a generator.
+        """
+        log_dir = self._get_log_dir()
+        if not inspect.isgeneratorfunction(self.cmdline):
+            name = self.__class__.__name__
+            return [(self.cmdline(), os.path.join(log_dir, name + '.out'),
+                     os.path.join(log_dir, name + '.err'))]
+        cmdlist = []
+        for cmd in self.cmdline():
+            out_log = os.path.join(log_dir, self.kwargs['fmriname'] + '.out')
+            err_log = os.path.join(log_dir, self.kwargs['fmriname'] + '.err')
+            cmdlist.append((cmd, out_log, err_log))
+        return cmdlist
+
+    def get_jobs(self):
+        """
+        :return: list of jobs of the main script, as dicts of name, whose
+        logs are <name>.out and <name>.err in the stage's log directory,
+        command line, and the names of the jobs it requires.  Override
+        where jobs depend on each other, see ABCDTask.
+        """
+        return [{'name': os.path.basename(out_log)[:-len('.out')],
+                 'cmd': cmd, 'requires': []}
+                for cmd, out_log, _ in self.get_commands()]
+
+    def setup_commands(self):
+        """
+        :return: list of command, out log, err log run by setup, before the
+        main script.  Override along with setup.
+        """
+        return []
+
+    def teardown_commands(self):
+        """
+        :return: list of command, out log, err log run by teardown, after
+        the main script, concurrently.  Override along with teardown.
+        """
+        return []
+
+    def recompress_start(self):
+        """
+        :return: time from which uncompressed images count as written by
+        this stage, None unless it runs with an FSLOUTPUTTYPE of NIFTI.
+        """
+        if self._get_fsloutputtype() != 'NIFTI' or not self.call_active:
+            return None
+        os.makedirs(self.kwargs['path'], exist_ok=True)
+        return file_system_time(self.kwargs['path'])
+
+    def recompress_outputs(self, ncpus=1, since=None):
+        """
+        gzips the nifti images which this stage wrote uncompressed because
+        it ran with an FSLOUTPUTTYPE of NIFTI: the expected .nii.gz outputs,
+        and every .nii image modified since the stage started in its
+        image directories.  Outputs expected as .nii and cifti images stay
+        uncompressed.
+        :param ncpus: number of compression threads.
+        :param since: start of the stage, see recompress_start.
+        :return: None
+        """
+        if self._get_fsloutputtype() != 'NIFTI' or not self.call_active:
+            return
+        compressed = recompress_images(
+            self.get_expected_outputs(), self.get_image_dirs(), since,
+            workers=ncpus, level=self.recompress_level)
+        if compressed:
+            print('compressed %s outputs of %s' %
+                  (len(compressed), self.__class__.__name__))
+
+    def get_image_dirs(self):
+        """
+        :return: formatted list of the directories in which this stage
+        writes images, see image_dirs_spec.
+        """
+        return _format_paths(self.image_dirs_spec, self.kwargs,
+                             self.config.get_runs())
+
+    def _get_fsloutputtype(self):
+        return self.kwargs['fsloutputtype'].get(self.__class__.__name__)
+
+    def _get_resource_limits(self):
+        limits = self.kwargs['resource_limits']
+        return dict(limits.get('all', {}),
+                    **limits.get(self.__class__.__name__, {}))
+
     def call(self, *args, **kwargs):
         """
         runs command if call is active.
         """
         if self.call_active:
+            kwargs.setdefault('fsloutputtype', self._get_fsloutputtype())
+            kwargs.setdefault('extra_env', self.env)
+            if self.pin_cpus:
+                kwargs.setdefault('cpus', _worker_cpus or self.cpus)
+            limits = self._get_resource_limits()
+            if limits:
+                # private temporary directories go next to the session
+                # "files" folder, on scratch if it is used.
+                kwargs.setdefault('limits', limits)
+                kwargs.setdefault('tmp_root', os.path.join(
+                    os.path.dirname(self.kwargs['path']), 'tmp',
+                    self.__class__.__name__))
             return _call(*args, **kwargs)
         else:
             return 0  # "success"
@@ -612,6 +1396,10 @@ class PreFreeSurfer(Stage):
 
     script = '{HCPPIPEDIR}/PreFreeSurfer/PreFreeSurferPipeline.sh'
 
+    writes_anatomicals = True
+
+    image_dirs_spec = ['{path}/T1w', '{path}/T2w', '{path}/MNINonLinear']
+
     spec = ' --path={path}' \
            ' --subject={subject}' \
            ' --t1={t1}' \
@@ -696,6 +1484,14 @@ class FreeSurfer(Stage):
 
     script = '{HCPPIPEDIR}/FreeSurfer/FreeSurferPipeline.sh'
 
+    depends_on = ('PreFreeSurfer',)
+
+    output_dirs_spec = ['{path}/T1w/{subject}']
+
+    writes_anatomicals = True
+
+    image_dirs_spec = ['{path}/T1w']
+
     spec = ' --subject={subject}' \
            ' --subjectDIR={freesurferdir}' \
            ' --t1={t1_restore}' \
@@ -704,6 +1500,19 @@ class FreeSurfer(Stage):
            ' --useT2={useT2}' \
            ' --printcom={printcom}'
 
+    # expensive steps of FreeSurferPipeline.sh which are skipped on resume
+    # once completed: recon-all, found on the PATH, and these scripts in
+    # HCPPIPEDIR_FS.
+    checkpoint_scripts = ['FreeSurferHiresWhite.sh', 'FreeSurferHiresPial.sh']
+
+    # run recon-all with both hemispheres in parallel, each multithreaded.
+    parallel_recon = False
+
+    # recon-all calls of FreeSurferPipeline.sh, see _make_parallel_script
+    recon_all_call = re.compile(
+        r'^[ \t]*(?:\$\{?FREESURFER_HOME\}?/bin/)?recon-all(?=[ \t])',
+        re.MULTILINE)
+
     def __init__(self, config):
         super(__class__, self).__init__(config)
         self.kwargs['freesurferdir'] = os.path.join(
@@ -714,6 +1523,116 @@ class FreeSurfer(Stage):
             self.kwargs['freesurferdir'], 'T1w_acpc_dc_restore_brain.nii.gz')
         self.kwargs['t2_restore'] = os.path.join(
             self.kwargs['freesurferdir'], 'T2w_acpc_dc_restore.nii.gz')
+        self.scripts_dir = os.path.join(
+            self.kwargs['freesurferdir'], self.kwargs['subject'], 'scripts')
+        self.ledger = os.path.join(self.scripts_dir, 'pipeline_checkpoints.txt')
+        self.status_log = os.path.join(self.scripts_dir,
+                                       'recon-all-status.log')
+        # steps completed by interrupted recon-all invocations
+        self.resume_state = os.path.join(self._get_log_dir(),
+                                         'recon_all_resume.json')
+
+    @classmethod
+    def activate_parallel_recon(cls):
+        # recon-all runs hemispheres in parallel with openmp threads
+        cls.parallel_recon = True
+
+    def resumable(self):
+        """
+        FreeSurfer can resume if an earlier run failed or was interrupted
+        once recon-all started.
+        :return: True if the next run should resume.
+        """
+        return self.status['node_status'] in (
+            Status.states['failed'], Status.states['incomplete']) and \
+            os.path.exists(self.status_log) and (
+            os.path.exists(self.ledger) or os.path.exists(self.resume_state))
+
+    def last_completed_step(self):
+        """
+        :return: last step started by recon-all according to its status log.
+        """
+        step = None
+        with open(self.status_log) as fd:
+            for line in fd:
+                if line.startswith('#@# '):
+                    step = line[len('#@# '):].strip()
+        return step
+
+    def setup(self):
+        """
+        resumes after the last completed step of an earlier run, else clears
+        earlier outputs.  Places checkpoint wrappers in front of recon-all,
+        which skip completed recon-all invocations and the completed steps
+        of an interrupted one, and in front of the hires scripts.  With
+        parallel recon, runs a copy of the pipeline script passing the
+        parallel options to recon-all.
+        :return: None
+        """
+        if self.resumable():
+            print('resuming FreeSurfer, recon-all last ran: %s' %
+                  self.last_completed_step())
+            self.status.update_start_run()
+            self.release_shared_anatomicals()
+            self.make_wrappers()
+        else:
+            for path in (self.ledger, self.resume_state):
+                if os.path.exists(path):
+                    os.remove(path)
+            super(__class__, self).setup()
+
+    def make_wrappers(self):
+        if not self.call_active:
+            return
+        self._make_checkpoint_wrappers()
+        if self.parallel_recon and self.ncpus > 1:
+            self._make_parallel_script()
+
+    def _make_parallel_script(self):
+        """
+        runs a copy of FreeSurferPipeline.sh whose recon-all calls pass the
+        parallel recon options: half of the cores per hemisphere, as
+        recon-all's -parallel mode processes both at once.
+        :return: None
+        """
+        recon_all_args = ['-parallel', '-openmp', str(self.ncpus // 2)]
+        pipeline = FreeSurfer.script.format(**os.environ)
+        if not os.path.isfile(pipeline):
+            return
+        with open(pipeline) as fd:
+            contents = fd.read()
+        if not self.recon_all_call.search(contents):
+            print('WARNING: recon-all call not found in %s, FreeSurfer runs '
+                  'without parallel recon.' % pipeline)
+            return
+        contents = self.recon_all_call.sub(
+            lambda m: ' '.join([m.group(0)] + recon_all_args), contents)
+        shadow_dir = shadow_scripts(
+            os.path.dirname(pipeline),
+            os.path.join(self._get_log_dir(), 'parallel_scripts'),
+            {os.path.basename(pipeline): contents})
+        self.script = os.path.join(shadow_dir, os.path.basename(pipeline))
+
+    def _make_checkpoint_wrappers(self):
+        bin_dir = os.path.join(self._get_log_dir(), 'checkpoint_bin')
+        shutil.rmtree(bin_dir, ignore_errors=True)
+        os.makedirs(bin_dir)
+        recon_all = shutil.which('recon-all')
+        if recon_all:
+            write_script(os.path.join(bin_dir, 'recon-all'),
+                         checkpoint.wrapper_script(
+                             self.ledger, recon_all,
+                             status_log=self.status_log,
+                             resume_state=self.resume_state))
+            self.env['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        fs_scripts = os.environ.get('HCPPIPEDIR_FS')
+        if fs_scripts and os.path.isdir(fs_scripts):
+            self.env['HCPPIPEDIR_FS'] = shadow_scripts(
+                fs_scripts,
+                os.path.join(self._get_log_dir(), 'checkpoint_scripts'),
+                {name: checkpoint.wrapper_script(
+                    self.ledger, os.path.join(fs_scripts, name))
+                 for name in self.checkpoint_scripts})
 
     @property
     def args(self):
@@ -724,6 +1643,12 @@ class PostFreeSurfer(Stage):
 
     script = '{HCPPIPEDIR}/PostFreeSurfer/PostFreeSurferPipeline.sh'
 
+    depends_on = ('FreeSurfer',)
+
+    writes_anatomicals = True
+
+    image_dirs_spec = ['{path}/T1w', '{path}/MNINonLinear']
+
     spec = ' --path={path}' \
            ' --subject={subject}' \
            ' --surfatlasdir={surfatlasdir}' \
@@ -764,6 +1689,13 @@ class FMRIVolume(Stage):
 
     script = '{HCPPIPEDIR}/fMRIVolume/GenericfMRIVolumeProcessingPipeline.sh'
 
+    depends_on = ('PostFreeSurfer',)
+
+    output_dirs_spec = ['{path}/{fmriname}',
+                        '{path}/MNINonLinear/Results/{fmriname}']
+
+    image_dirs_spec = output_dirs_spec
+
     spec = ' --path={path}' \
            ' --subject={subject}' \
            ' --fmriname={fmriname}' \
@@ -786,8 +1718,20 @@ class FMRIVolume(Stage):
            ' --mctype={mctype}' \
            ' --useT2={useT2}'
 
+    # topup call of TopupPreprocessingAll.sh, routed through topup_cache.py
+    topup_call = re.compile(r'\$\{?FSLDIR\}?/bin/topup\b')
+
+    # inputs which are read from the input cache, if any
+    cached_inputs = ('fmritcs', 'sephasepos', 'sephaseneg', 'fmapmag',
+                     'fmapphase')
+
     def __init__(self, config):
         super(__class__, self).__init__(config)
+        self.topup_cache = os.path.join(self.kwargs['path'], 'TopupCache')
+        # input filename to uncompressed copy
+        self.cached = {}
+        # holds the cached inputs while the stage runs
+        self.input_cache = None
 
     def __str__(self):
         string = ''
@@ -795,51 +1739,151 @@ class FMRIVolume(Stage):
             string += ' \\\n    '.join(cmd.split()) + '\n'
         return string
 
-    def _get_intended_sefmaps(self):
+    def setup(self):
         """
-        search for IntendedFor field from sidecar json to determine
-        appropriate field map pair, else give the first spin echo pair.
-        :return: pair of spin echo filenames, positive then negative
+        in addition, shares topup field estimation between runs using the
+        same spin echo pair.
+        :return: None
         """
-        intended_idx = {}
-        for direction in ['positive', 'negative']:
-            for idx, sefm in enumerate(self.config.get_bids('fmap_metadata',
-                                                            direction)):
-                intended_targets = sefm.get('IntendedFor', [])
-                if get_relpath(self.kwargs['fmritcs']) in ' '.join(
-                        intended_targets):
-                    intended_idx[direction] = idx
-                    break
-            else:
-                if idx != 0:
-                    print('WARNING: the intended %s spin echo for anatomical '
-                          'distortion correction is not explicitly defined in '
-                          'the sidecar json.' % direction)
-                intended_idx[direction] = 0
+        super(__class__, self).setup()
+        if self.kwargs['input_cache'] and self.call_active:
+            self._cache_inputs()
 
-        return self.config.get_bids('fmap', 'positive', intended_idx[
-            'positive']), \
-               self.config.get_bids('fmap', 'negative',
-                                    intended_idx['negative'])
+    def make_wrappers(self):
+        if self.kwargs['dcmethod'] != 'TOPUP' or not self.call_active:
+            return
+        groups = self._get_topup_groups()
+        if any(len(runs) > 1 for runs in groups.values()):
+            for (pos, neg, unwarpdir), runs in groups.items():
+                print('topup field of %s, %s (%s) estimated once for: %s'
+                      % (os.path.basename(pos), os.path.basename(neg),
+                         unwarpdir, ', '.join(runs)))
+            self._make_topup_wrapper()
+
+    def teardown(self, result=0):
+        """
+        in addition, skips runs with too much motion in the following stages,
+        and releases the cached inputs.
+        :param result:
+        :return: None
+        """
+        try:
+            super(__class__, self).teardown(result)
+            self.exclude_high_motion_runs()
+        finally:
+            if self.input_cache:
+                self.input_cache.release()
+
+    def exclude_high_motion_runs(self):
+        """
+        counts the usable frames of each run from its motion parameters,
+        excluding runs with fewer than min_usable_frames from the following
+        stages.  Excluded runs are stored in the stage status.
+        :return: None
+        """
+        if not self.kwargs['min_usable_frames'] or not self.call_active:
+            return
+        excluded = {}
+        for run in self.config.get_runs():
+            regressors = os.path.join(self.kwargs['path'], 'MNINonLinear',
+                                      'Results', run.fmriname,
+                                      'Movement_Regressors.txt')
+            if not os.path.exists(regressors):
+                continue
+            fd = framewise_displacement(regressors,
+                                        self.kwargs['brain_radius'])
+            skip_frames = int(round(self.kwargs['skip_seconds'] / run.tr))
+            usable = count_usable_frames(fd, self.kwargs['fd_threshold'],
+                                         skip_frames,
+                                         self.kwargs['contiguous_frames'])
+            if usable < self.kwargs['min_usable_frames']:
+                print('WARNING: %s has %s usable frames, skipping it in the '
+                      'following stages.' % (run.fmriname, usable))
+                excluded[run] = usable
+        for run in excluded:
+            self.config.exclude_func(run.fmri)
+        self.status['excluded_runs'] = {
+            run.fmriname: usable for run, usable in excluded.items()}
+
+    def _cache_inputs(self):
+        inputs = list(self.config.get_bids('func'))
+        if self.kwargs['dcmethod'] == 'TOPUP':
+            inputs += self.config.get_bids('fmap', 'positive') + \
+                self.config.get_bids('fmap', 'negative')
+        elif self.kwargs['dcmethod'] == 'FIELDMAP':
+            for key in ('fmapmag', 'fmapphase'):
+                value = self.kwargs[key]
+                inputs += value if isinstance(value, list) else [value]
+        print('decompressing inputs to %s' % self.kwargs['input_cache'])
+        self.input_cache = InputCache(self.kwargs['input_cache'],
+                                      self.kwargs['input_cache_gb'])
+        self.cached = self.input_cache.get_all(
+            [x for x in inputs if isinstance(x, str)])
+
+    def _get_topup_groups(self):
+        """
+        :return: dict of (SEPhasePos, SEPhaseNeg, unwarpdir) to the names of
+        the runs which use them.
+        """
+        groups = {}
+        for run in self.config.get_runs():
+            key = self._get_intended_sefmaps(run) + (run.pe_dir,)
+            groups.setdefault(key, []).append(run.fmriname)
+        return groups
+
+    def _make_topup_wrapper(self):
+        global_scripts = os.environ.get('HCPPIPEDIR_Global')
+        topup_script = os.path.join(global_scripts or '',
+                                    'TopupPreprocessingAll.sh')
+        if not os.path.isfile(topup_script):
+            return
+        with open(topup_script) as fd:
+            contents = fd.read()
+        if not self.topup_call.search(contents):
+            print('WARNING: topup call not found in %s, each run estimates '
+                  'its own field.' % topup_script)
+            return
+        topup_cache = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), 'topup_cache.py')
+        contents = self.topup_call.sub(lambda m: ' '.join(
+            (shlex.quote(sys.executable), shlex.quote(topup_cache),
+             '--cache', shlex.quote(self.topup_cache), '--', m.group(0))),
+            contents)
+        self.env['HCPPIPEDIR_Global'] = shadow_scripts(
+            global_scripts, os.path.join(self._get_log_dir(), 'topup_scripts'),
+            {'TopupPreprocessingAll.sh': contents})
+
+    def _get_intended_sefmaps(self, run):
+        """
+        the field map pair given by the IntendedFor field from sidecar json,
+        else the first spin echo pair, see ParameterSettings.get_runs.
+        :param run: BoldRun.
+        :return: pair of spin echo filenames, positive then negative
+        """
+        return self.config.get_bids('fmap', 'positive', run.sefmaps[0]), \
+            self.config.get_bids('fmap', 'negative', run.sefmaps[1])
 
     @property
     def args(self):
-        for fmri, meta in zip(self.config.get_bids('func'), 
-                              self.config.get_bids('func_metadata')):
+        for run in self.config.get_runs():
             # set ts parameters
-            self.kwargs['fmritcs'] = fmri
-            self.kwargs['fmriname'] = get_fmriname(fmri)
+            self.kwargs['fmritcs'] = run.fmri
+            self.kwargs['fmriname'] = run.fmriname
             self.kwargs['fmriscout'] = None  # not implemented
             if self.kwargs['dcmethod'] == 'TOPUP':
-                self.kwargs['seunwarpdir'] = ijk_to_xyz(
-                    meta['PhaseEncodingDirection'])
+                self.kwargs['seunwarpdir'] = run.pe_dir
                 self.kwargs['sephasepos'], self.kwargs['sephaseneg'] = \
-                    self._get_intended_sefmaps()
+                    self._get_intended_sefmaps(run)
             else:
                 self.kwargs['sephasepos'] = self.kwargs['sephaseneg'] = None
             # None to NONE
             kw = {k: (v if v is not None else "NONE")
                   for k, v in self.kwargs.items()}
+            for k in self.cached_inputs:
+                if isinstance(kw[k], str):
+                    kw[k] = self.cached.get(kw[k], kw[k])
+                elif isinstance(kw[k], list):
+                    kw[k] = [self.cached.get(x, x) for x in kw[k]]
             yield self.spec.format(**kw)
 
     def cmdline(self):
@@ -852,6 +1896,11 @@ class FMRISurface(Stage):
 
     script = '{HCPPIPEDIR}/fMRISurface/GenericfMRISurfaceProcessingPipeline.sh'
 
+    depends_on = ('FMRIVolume',)
+
+    image_dirs_spec = ['{path}/{fmriname}',
+                       '{path}/MNINonLinear/Results/{fmriname}']
+
     spec = ' --path={path}' \
            ' --subject={subject}' \
            ' --fmriname={fmriname}' \
@@ -872,8 +1921,8 @@ class FMRISurface(Stage):
 
     @property
     def args(self):
-        for fmri in self.config.get_bids('func'):
-            self.kwargs['fmriname'] = get_fmriname(fmri)
+        for run in self.config.get_runs():
+            self.kwargs['fmriname'] = run.fmriname
             yield self.spec.format(**self.kwargs)
 
     def cmdline(self):
@@ -886,6 +1935,10 @@ class DCANBOLDProcessing(Stage):
 
     script = '{DCANBOLDPROCDIR}/dcan_bold_proc.py'
 
+    depends_on = ('FMRISurface',)
+
+    image_dirs_spec = ['{path}/MNINonLinear/Results']
+
     spec = ' --subject={subject}' \
            ' --output-folder={path}' \
            ' --task={fmriname}' \
@@ -918,6 +1971,10 @@ class DCANBOLDProcessing(Stage):
         :return:
         """
         super(__class__, self).setup()
+        for cmd in self.setup_commands():
+            result = self.call(*cmd)
+
+    def setup_commands(self):
         script = self.script.format(**os.environ)
         args = self.spec.format(**self.kwargs)
         cmd = ' '.join((script, args))
@@ -925,38 +1982,51 @@ class DCANBOLDProcessing(Stage):
         log_dir = self._get_log_dir()
         out_log = os.path.join(log_dir, self.__class__.__name__ + '_setup.out')
         err_log = os.path.join(log_dir, self.__class__.__name__ + '_setup.err')
-        result = self.call(cmd, out_log, err_log)
+        return [(cmd, out_log, err_log)]
 
     def teardown(self, result=0):
         """
-        concatenate dtseries, parcellate, create grayplots.
+        concatenate dtseries, parcellate, create grayplots.  Each task set
+        is torn down by its own command, concurrently.
         :param result:
         :return:
         """
-        fmris = [get_fmriname(fmri) for fmri in self.config.get_bids('func')]
-        fmrisets = list(set([get_taskname(fmri)
-                              for fmri in self.config.get_bids('func')]))
+        fmrisets = sorted(set(run.task for run in self.config.get_runs()))
+        cmdlist = self.teardown_commands()
+
+        if len(cmdlist) > 1:
+            with self._pool(min(self.ncpus, len(cmdlist))) as pool:
+                result = pool.starmap(self.call, cmdlist)
+        else:
+            result = [self.call(*cmd) for cmd in cmdlist]
+        self.status['teardown'] = dict(zip(fmrisets, result))
+
+        super(__class__, self).teardown(result)
+
+    def teardown_commands(self):
+        fmris = [run.fmriname for run in self.config.get_runs()]
+        fmrisets = sorted(set(run.task for run in self.config.get_runs()))
 
         script = self.script.format(**os.environ)
         args = self.spec.format(**self.kwargs)
-        cmd = ' '.join((script, args))
-        cmd += ' --teardown'
-
+        log_dir = self._get_log_dir()
+        cmdlist = []
         for fmriset in fmrisets:
             fmrilist = sorted([fmri for fmri in fmris if fmriset in fmri])
+            cmd = ' '.join((script, args))
+            cmd += ' --teardown'
             cmd += ' --tasklist ' + ','.join(fmrilist)
-
-        log_dir = self._get_log_dir()
-        out_log = os.path.join(log_dir, self.__class__.__name__ + '_teardown.out')
-        err_log = os.path.join(log_dir, self.__class__.__name__ + '_teardown.err')
-        result = self.call(cmd, out_log, err_log)
-
-        super(__class__, self).teardown(result)
+            out_log = os.path.join(log_dir, '%s_teardown_%s.out' % (
+                self.__class__.__name__, fmriset))
+            err_log = os.path.join(log_dir, '%s_teardown_%s.err' % (
+                self.__class__.__name__, fmriset))
+            cmdlist.append((cmd, out_log, err_log))
+        return cmdlist
 
     @property
     def args(self):
-        for fmri in self.config.get_bids('func'):
-            self.kwargs['fmriname'] = get_fmriname(fmri)
+        for run in self.config.get_runs():
+            self.kwargs['fmriname'] = run.fmriname
             yield self.spec.format(**self.kwargs)
 
     def cmdline(self):
@@ -968,6 +2038,8 @@ class DiffusionPreprocessing(Stage):
 
     script = '{HCPPIPEDIR}/DiffusionPreprocessing/DiffPreprocPipeline.sh'
 
+    depends_on = ('PostFreeSurfer',)
+
     spec = ' --path={path}' \
            ' --subject={subject}' \
            ' --posData={dwi_positive}' \
@@ -988,6 +2060,8 @@ class ExecutiveSummary(Stage):
 
     script = '{EXECSUMDIR}/ExecutiveSummary.py'
 
+    depends_on = ('PostFreeSurfer', 'DCANBOLDProcessing')
+
     spec = ' --bids-input={unproc}' \
            ' --output-dir={path}' \
            ' --participant-label={subject}' \
@@ -1005,7 +2079,13 @@ class ExecutiveSummary(Stage):
 
 class CustomClean(Stage):
 
-    script = '{CUSTOMCLEANDIR}/cleaning_script.py'
+    # clean with clean.py, which takes the same arguments, instead of the
+    # DCAN cleaning script.
+    native = False
+
+    # removes files, so waits for every stage which may read them
+    depends_on = ('PostFreeSurfer', 'FMRISurface', 'DCANBOLDProcessing',
+                  'ExecutiveSummary', 'ABCDTask')
 
     spec = ' --dir={path}' \
            ' --json={input_json}'
@@ -1014,21 +2094,760 @@ class CustomClean(Stage):
         super(__class__, self).__init__(config)
         self.kwargs['input_json'] = input_json
 
+    @classmethod
+    def activate_native_clean(cls):
+        cls.native = True
+
+    @property
+    def script(self):
+        if self.native:
+            return os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'clean.py')
+        return '{CUSTOMCLEANDIR}/cleaning_script.py'
+
     @property
     def args(self):
         return self.spec.format(**self.kwargs)
 
 
-def _call(cmd, out_log, err_log, num_threads=1):
+class Archive(Stage):
+
+    script = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                          'archive.py')
+
+    depends_on = ('PostFreeSurfer', 'DCANBOLDProcessing', 'ExecutiveSummary',
+                  'ABCDTask', 'CustomClean')
+
+    spec = ' --files={path}' \
+           ' --logs={logs}' \
+           ' --target={archive_target}' \
+           ' --name={archive_name}' \
+           ' --split={archive_split}' \
+           ' --exclude={archive_log_dir}'
+
+    def __init__(self, config, target, split='none'):
+        super(__class__, self).__init__(config)
+        self.kwargs['archive_target'] = target
+        self.kwargs['archive_split'] = split
+        self.kwargs['archive_name'] = 'sub-%s_ses-%s' % (
+            self.kwargs['subject'], self.kwargs['session'])
+        # the logs of this stage are still being written
+        self.kwargs['archive_log_dir'] = self._get_log_dir()
+
+    def get_conditional_expected_outputs(self):
+        return [os.path.join(self.kwargs['archive_target'],
+                             self.kwargs['archive_name'] + '.sha256')]
+
+    @property
+    def args(self):
+        return self.spec.format(**self.kwargs)
+
+
+class RetentionPolicy(object):
+    """
+    Removes intermediate files of a session once they are no longer needed.
+    The policy maps each producing stage to the stage names which consume
+    its intermediates and to the intermediate path specs, formatted like
+    pipeline_expected_outputs.json.  Per run paths may use {fmriname}.
+    Intermediates are removed only when the producer and every consumer
+    have succeeded, and never when they contain an expected output.
+    """
+
+    def __init__(self, config, policy_json=None):
+        """
+        :param config: instance of ParameterSettings
+        :param policy_json: optional path to a retention policy, default is
+        pipeline_retention_policy.json
+        """
+        self.config = config
+        self.kwargs = dict(config.get_params())
+        here = os.path.dirname(os.path.realpath(__file__))
+        if policy_json is None:
+            policy_json = os.path.join(here, 'pipeline_retention_policy.json')
+        with open(policy_json) as fd:
+            self.policy = json.load(fd)
+        self.expected_outputs_spec = get_expected_outputs_table()
+
+    def _succeeded(self, stage_name):
+        # reads status.json directly, so no log folder is made for stages
+        # which this session never runs.
+        status_file = os.path.join(self.kwargs['logs'], stage_name,
+                                   Status.name)
+        if not os.path.exists(status_file):
+            return False
+        with open(status_file) as fd:
+            node_status = json.load(fd)['node_status']
+        return node_status in (Status.states['succeeded'],
+                               Status.states['unchecked'])
+
+    def prune(self):
+        """
+        removes intermediates of every stage whose consumers all succeeded.
+        :return: list of removed paths
+        """
+        runs = self.config.get_runs()
+        protected = _format_paths(
+            [p for specs in self.expected_outputs_spec.values()
+             for p in specs], self.kwargs, runs)
+        removed = []
+        for stage_name, rule in self.policy.items():
+            if not all(self._succeeded(name) for name in
+                       [stage_name] + rule['consumers']):
+                continue
+            for path in _format_paths(rule['remove'], self.kwargs, runs):
+                if not os.path.lexists(path):
+                    continue
+                if any(p == path or p.startswith(path + os.sep)
+                       for p in protected):
+                    print('WARNING: not pruning %s, it contains expected '
+                          'outputs' % path)
+                    continue
+                print('pruning intermediate %s' % path)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                removed.append(path)
+        return removed
+
+
+class CostModel(object):
+    """
+    Projects the output size, peak memory and core-hours of a session's
+    stages from the dimensions of its input images, read from their nifti
+    headers.  The model maps each stage name to linear coefficients of the
+    session's features, see pipeline_cost_model.json.  Stages which process
+    BOLD runs concurrently are modeled per run, from the run's features.
+    """
+    metrics = ('disk_gb', 'memory_gb', 'core_hours')
+
+    def __init__(self, config, model_json=None):
+        """
+        :param config: instance of ParameterSettings
+        :param model_json: optional path to a cost model, default is
+        pipeline_cost_model.json
+        """
+        self.config = config
+        if model_json is None:
+            here = os.path.dirname(os.path.realpath(__file__))
+            model_json = os.path.join(here, 'pipeline_cost_model.json')
+        with open(model_json) as fd:
+            self.model = json.load(fd)
+        self.runs = [self._image_features(f)
+                     for f in self.config.get_bids('func')]
+        anat = [self._image_features(f) for f in
+                self.config.get_bids('t1w') + self.config.get_bids('t2w')]
+        self.features = {
+            'anat_mvox': sum(x['gsamples'] for x in anat) * 1000,
+            'bold_runs': len(self.runs),
+            'frames': sum(x['frames'] for x in self.runs),
+            'gsamples': sum(x['gsamples'] for x in self.runs)
+        }
+
+    @staticmethod
+    def _image_features(filename):
+        try:
+            header = nifti_header(filename)
+        except (OSError, EOFError):
+            header = None
+        if header is None:
+            print('WARNING: could not read nifti header of %s' % filename)
+            return {'frames': 0, 'gsamples': 0.}
+        dim = header[0]
+        samples = 1
+        for d in dim[1:dim[0] + 1]:
+            samples *= d
+        return {'frames': dim[4] if dim[0] >= 4 else 1,
+                'gsamples': samples / 1e9}
+
+    @staticmethod
+    def _linear(coefficients, features):
+        return coefficients.get('base', 0.) + sum(
+            value * features[name] for name, value in coefficients.items()
+            if name != 'base')
+
+    def estimate(self, stage_names, ncpus=1):
+        """
+        :param stage_names: class names of the stages to run.
+        :param ncpus: number of cores, i.e. concurrent BOLD runs.
+        :return: dict of stage name to dict of projected disk_gb, peak
+        memory_gb and core_hours.
+        """
+        projection = {}
+        for name in stage_names:
+            rule = self.model.get(name, {})
+            if rule.get('per_run'):
+                per_run = {m: [self._linear(rule.get(m, {}), x)
+                               for x in self.runs] for m in self.metrics}
+                concurrent = sorted(per_run['memory_gb'], reverse=True)[
+                    :max(1, ncpus)]
+                projection[name] = {
+                    'disk_gb': sum(per_run['disk_gb']),
+                    'memory_gb': sum(concurrent),
+                    'core_hours': sum(per_run['core_hours'])
+                }
+            else:
+                projection[name] = {m: self._linear(rule.get(m, {}),
+                                                    self.features)
+                                    for m in self.metrics}
+        return projection
+
+    def total(self, stage_names, ncpus=1, projection=None):
+        """
+        :param stage_names: class names of the stages to run.
+        :param ncpus: number of cores.
+        :param projection: optional result of estimate for the stages.
+        :return: dict of the session's total disk_gb and core_hours, and of
+        its peak memory_gb.
+        """
+        if projection is None:
+            projection = self.estimate(stage_names, ncpus)
+        return {
+            'disk_gb': sum(x['disk_gb'] for x in projection.values()),
+            'memory_gb': max([x['memory_gb'] for x in projection.values()]
+                             or [0.]),
+            'core_hours': sum(x['core_hours'] for x in projection.values())
+        }
+
+    def report(self, stage_names, ncpus=1):
+        """
+        prints the projection per stage and for the session.
+        :param stage_names: class names of the stages to run.
+        :param ncpus: number of cores.
+        :return: see total
+        """
+        projection = self.estimate(stage_names, ncpus)
+        row = '%-20s %10s %10s %10s'
+        print(row % ('stage', 'disk (GB)', 'mem (GB)', 'core-hours'))
+        for name in stage_names:
+            print(row % ((name,) + tuple(
+                '%.1f' % projection[name][m] for m in self.metrics)))
+        total = self.total(stage_names, ncpus, projection)
+        print(row % (('session',) + tuple(
+            '%.1f' % total[m] for m in self.metrics)))
+        return total
+
+
+def run_stages(stages, ncpus=1, before=None, after=None, idle=None):
+    """
+    runs stages as their dependencies complete, concurrently with the other
+    stages which are ready.  A stage starts with a share of the free cores,
+    at least one, and returns them once it completes; ready stages wait
+    while no core is free.  Dependencies which are not among the stages are
+    considered complete.
+    :param stages: list of Stage instances, in their preferred order.
+    :param ncpus: number of available cores.
+    :param before: optional function called with each stage as it starts.
+    :param after: optional function called with each stage which succeeded.
+    :param idle: optional function called whenever no stage is running
+    before further stages start, e.g. to sync outputs which no stage is
+    writing.
+    :return: None
+    """
+    names = {stage.__class__.__name__ for stage in stages}
+    pending = list(stages)
+    done = set()
+    running = {}
+    error = None
+    # with cpu pinning, stages own disjoint sets of the free cpus
+    pinned = any(stage.pin_cpus for stage in stages)
+    free_cpus = allowed_cpus(ncpus) if pinned else []
+    free = len(free_cpus) if pinned else max(1, ncpus)
+    with ThreadPoolExecutor(max_workers=max(1, len(stages))) as pool:
+        while pending or running:
+            ready = [] if error else [
+                stage for stage in pending if all(
+                    name in done or name not in names
+                    for name in stage.depends_on)]
+            # at least one core each
+            ready = ready[:free]
+            if pinned and ready:
+                sets = partition(free_cpus, len(ready))
+                free_cpus = []
+            for i, stage in enumerate(ready):
+                pending.remove(stage)
+                if before:
+                    before(stage)
+                if pinned:
+                    stage.cpus = sets[i]
+                    stage_ncpus = len(stage.cpus)
+                else:
+                    stage_ncpus = free // (len(ready) - i)
+                free -= stage_ncpus
+                running[pool.submit(stage.run, stage_ncpus)] = \
+                    (stage, stage_ncpus)
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, stage_ncpus = running.pop(future)
+                free += stage_ncpus
+                if pinned:
+                    free_cpus += stage.cpus
+                if future.exception() is not None:
+                    # let running stages finish, but start no others
+                    error = error or future.exception()
+                    continue
+                done.add(stage.__class__.__name__)
+                if after:
+                    after(stage)
+            if idle and not running and pending and not error:
+                idle()
+    if error:
+        raise error
+    if pending:
+        raise Exception('unresolved stage dependencies: %s' % ', '.join(
+            stage.__class__.__name__ for stage in pending))
+
+
+class CommandGraph(object):
+    """
+    Dependency graph of the commands of the stages of one or more sessions,
+    for execution with make or another runner.  The setup commands of a
+    stage precede its main commands, which precede its teardown commands,
+    and the first commands of a stage follow the last commands of the
+    stages it depends on, as in run_stages.  Commands of a stage which are
+    run concurrently are independent nodes, unless one requires another,
+    see Stage.get_jobs.  Commands run through the wrapper scripts of their
+    stage, see Stage.make_wrappers, and the images of a stage run with an
+    FSLOUTPUTTYPE of NIFTI are recompressed by a command between its main
+    and teardown commands.  A node is complete once its stamp file, next to
+    its logs, exists.
+    """
+
+    # bids data holding input images
+    input_keys = ('t1w', 't2w', 'func', 'fmap', 'dwi')
+
+    def __init__(self):
+        self.nodes = []
+
+    def add_stages(self, stages, ncpus=1):
+        """
+        adds the commands of the stages of a session.
+        :param stages: list of Stage instances, in the order they are run.
+        :param ncpus: number of cores, used by stages which run a single
+        multithreaded main command.
+        :return: None
+        """
+        names = {stage.__class__.__name__ for stage in stages}
+        exits = {}
+        session_nodes = []
+        for stage in stages:
+            name = stage.__class__.__name__
+            missing = [x for x in stage.depends_on
+                       if x in names and x not in exits]
+            if missing:
+                raise Exception('%s is ordered before its dependencies: %s'
+                                % (name, ', '.join(missing)))
+            prefix = 'sub-%s/ses-%s/%s' % (stage.kwargs['subject'],
+                                           stage.kwargs['session'], name)
+            depends = [node for x in stage.depends_on if x in exits
+                       for node in exits[x]]
+            stage.ncpus = ncpus
+            stage.make_wrappers()
+            outputs = stage.get_expected_outputs()
+            log_dir = stage._get_log_dir()
+            jobs = stage.get_jobs()
+            threads = 1 if len(jobs) > 1 or inspect.isgeneratorfunction(
+                stage.cmdline) else ncpus
+            main = [(job['cmd'], os.path.join(log_dir, job['name'] + '.out'),
+                     os.path.join(log_dir, job['name'] + '.err'))
+                    for job in jobs]
+            start, recompress = self._recompress_commands(stage, ncpus)
+            stage_nodes = []
+            for phase, cmdlist, num_threads in (
+                    ('start', start, 1),
+                    ('setup', stage.setup_commands(), 1),
+                    ('main', main, threads),
+                    ('recompress', recompress, ncpus),
+                    ('teardown', stage.teardown_commands(), 1)):
+                if not cmdlist:
+                    continue
+                nodes = [self._node(stage, prefix, phase, cmd, num_threads,
+                                    depends) for cmd in cmdlist]
+                if phase == 'main':
+                    ids = {job['name']: node['id']
+                           for job, node in zip(jobs, nodes)}
+                    for job, node in zip(jobs, nodes):
+                        node['depends'] += [ids[x] for x in job['requires']]
+                depends = [node['id'] for node in nodes]
+                stage_nodes += nodes
+            # per run outputs belong to the command of the run, the others
+            # to the last commands of the stage
+            claimed = set()
+            for node in stage_nodes:
+                if node['phase'] == 'main' and len(main) > 1:
+                    run = os.path.basename(node['out_log'])[:-len('.out')]
+                    node['outputs'] = [p for p in outputs
+                                       if run in p.split(os.sep)]
+                    claimed.update(node['outputs'])
+            for node in stage_nodes:
+                if node['id'] in depends:
+                    node['outputs'] += [p for p in outputs
+                                        if p not in claimed]
+            session_nodes += stage_nodes
+            exits[name] = depends
+        # inputs are the outputs of the nodes each node depends on, or the
+        # session's images for the first nodes
+        images = self._input_images(stages[0].config) if stages else []
+        ids = {node['id']: node for node in session_nodes}
+        for node in session_nodes:
+            if node['depends']:
+                node['inputs'] = sorted(set(
+                    p for x in node['depends'] for p in ids[x]['outputs']))
+            else:
+                node['inputs'] = images
+        self.nodes += session_nodes
+
+    def _recompress_commands(self, stage, ncpus):
+        """
+        :param stage: Stage instance.
+        :param ncpus: number of compression threads.
+        :return: lists of command, out log, err log of the stage's start,
+        which creates the file by which images count as written by the
+        stage, and of the recompression of its images, see
+        Stage.recompress_outputs.  Empty unless the stage runs with an
+        FSLOUTPUTTYPE of NIFTI.
+        """
+        if stage._get_fsloutputtype() != 'NIFTI':
+            return [], []
+        name = stage.__class__.__name__
+        log_dir = stage._get_log_dir()
+        start_file = os.path.join(log_dir, name + '_recompress.start')
+        script = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                              'recompress.py')
+        cmd = [sys.executable, script, '--newer', start_file,
+               '--level', str(stage.recompress_level),
+               '--workers', str(ncpus)]
+        for folder in stage.get_image_dirs():
+            cmd += ['--folder', folder]
+        cmd += [p for p in stage.get_expected_outputs()
+                if p.endswith(('.nii', '.nii.gz'))]
+        start = ('touch %s' % shlex.quote(start_file),
+                 os.path.join(log_dir, name + '_recompress_start.out'),
+                 os.path.join(log_dir, name + '_recompress_start.err'))
+        recompress = (' '.join(shlex.quote(x) for x in cmd),
+                      os.path.join(log_dir, name + '_recompress.out'),
+                      os.path.join(log_dir, name + '_recompress.err'))
+        return [start], [recompress]
+
+    def _node(self, stage, prefix, phase, cmd, threads, depends):
+        command, out_log, err_log = cmd
+        env = {}
+        if threads > 1:
+            env['OMP_NUM_THREADS'] = str(threads)
+            env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(threads)
+        if stage._get_fsloutputtype():
+            env['FSLOUTPUTTYPE'] = stage._get_fsloutputtype()
+        env.update(stage.env)
+        name = os.path.basename(out_log)[:-len('.out')]
+        return {'id': '%s/%s' % (prefix, name),
+                'stage': stage.__class__.__name__, 'phase': phase,
+                'command': command, 'out_log': out_log,
+                'err_log': err_log, 'threads': threads, 'env': env,
+                'depends': list(depends), 'inputs': [], 'outputs': [],
+                'stamp': os.path.join(os.path.dirname(out_log),
+                                      name + '.done')}
+
+    def _input_images(self, config):
+        images = []
+
+        def collect(value):
+            if isinstance(value, str):
+                images.append(value)
+            elif isinstance(value, dict):
+                for v in value.values():
+                    collect(v)
+            elif isinstance(value, (list, tuple)):
+                for v in value:
+                    collect(v)
+
+        for key in self.input_keys:
+            collect(config.bids_data.get(key))
+        return sorted(set(images))
+
+    def write_json(self, filename):
+        """
+        writes the graph as JSON, a list of nodes with their id, stage,
+        command line, logs, threads, environment, ids of the nodes they depend on,
+        input and output files and stamp file.
+        :param filename: output file.
+        :return: None
+        """
+        with open(filename, 'w') as fd:
+            json.dump({'nodes': self.nodes}, fd, indent=2)
+
+    def write_makefile(self, filename):
+        """
+        writes the graph as a GNU Makefile with a rule per node, targeting
+        its stamp file, to be run with make -j.  Command lines are written
+        as they are, with "$" escaped for make.
+        :param filename: output file.
+        :return: None
+        """
+        def quote(value):
+            return shlex.quote(value).replace('$', '$$')
+
+        stamps = {node['id']: node['stamp'] for node in self.nodes}
+        with open(filename, 'w') as fd:
+            fd.write('# abcd-hcp-pipeline commands, run with: make -j N -f %s'
+                     '\n\n' % os.path.basename(filename))
+            fd.write('.PHONY: all\nall: %s\n' % ' '.join(
+                quote(node['stamp']) for node in self.nodes))
+            for node in self.nodes:
+                fd.write('\n# %s, %s thread(s)\n' % (node['id'],
+                                                       node['threads']))
+                fd.write('%s: %s\n' % (quote(node['stamp']), ' '.join(
+                    quote(stamps[x]) for x in node['depends'])))
+                env = ' '.join('%s=%s' % (k, quote(v))
+                               for k, v in sorted(node['env'].items()))
+                fd.write('\t%s%s > %s 2> %s\n' % (
+                    'env %s ' % env if env else '',
+                    node['command'].replace('$', '$$'),
+                    quote(node['out_log']), quote(node['err_log'])))
+                fd.write('\ttouch $@\n')
+
+
+# pipeline_expected_outputs.json, read once per process
+_expected_outputs_table = None
+
+
+def get_expected_outputs_table():
+    """
+    :return: dict of stage name to expected output specs, shared by all
+    stages, which must not modify it.
+    """
+    global _expected_outputs_table
+    if _expected_outputs_table is None:
+        here = os.path.dirname(os.path.realpath(__file__))
+        with open(os.path.join(here, 'pipeline_expected_outputs.json')) as fd:
+            _expected_outputs_table = json.load(fd)
+    return _expected_outputs_table
+
+
+def _write_record(filename, value):
+    # writes value as json unless the file already holds it
+    contents = json.dumps(value, indent=2, sort_keys=True, default=str)
+    if os.path.exists(filename):
+        with open(filename) as fd:
+            if fd.read() == contents:
+                return
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename + '.tmp', 'w') as fd:
+        fd.write(contents)
+    os.replace(filename + '.tmp', filename)
+
+
+def _format_paths(specs, kwargs, runs):
+    """
+    formats path specs, once per fmri run where {fmriname} is used.
+    :param specs: list of formattable paths.
+    :param kwargs: formatting parameters, see ParameterSettings.get_params.
+    :param runs: list of BoldRun, see ParameterSettings.get_runs.
+    :return: list of paths
+    """
+    paths = []
+    for spec in specs:
+        if '{fmriname}' in spec:
+            paths += [spec.format(**dict(kwargs, fmriname=run.fmriname))
+                      for run in runs]
+        else:
+            paths.append(spec.format(**kwargs))
+    return paths
+
+
+def _regexp(pattern, value):
+    # sqlite REGEXP implementation for StatusIndex
+    return re.search(pattern, value or '') is not None
+
+
+# serializes journal appends of concurrent stages, see StatusIndex
+_journal_lock = threading.Lock()
+
+
+class LogPump(object):
+    """
+    Copies a subprocess output stream to a log file, prefixing each line
+    with a timestamp.  Past max_bytes the log is rotated to numbered
+    segments, <log>.1, <log>.2, ..., which are compressed in the background
+    and of which the newest "backups" are kept.  Logs of the previous run
+    are kept as <log>.prev.
+    """
+    max_bytes = 100 * 1024 ** 2
+    backups = 10
+
+    def __init__(self, stream, path):
+        """
+        :param stream: binary file object, e.g. Popen.stdout.
+        :param path: log file.
+        """
+        self.stream = stream
+        self.path = path
+        self.segment = 0
+        self.compressors = {}
+        self._keep_previous()
+        self.thread = threading.Thread(target=self._pump)
+        self.thread.start()
+
+    def _segments(self, path):
+        # rotated segments of a log, ordered oldest first
+        segments = glob.glob(glob.escape(path) + '.[0-9]*')
+        return sorted(segments, key=lambda x: int(
+            x[len(path) + 1:].split('.')[0]))
+
+    def _keep_previous(self):
+        previous = self.path + '.prev'
+        for old in glob.glob(glob.escape(previous) + '*'):
+            os.remove(old)
+        for segment in self._segments(self.path):
+            os.rename(segment, previous + segment[len(self.path):])
+        if os.path.exists(self.path):
+            os.rename(self.path, previous)
+
+    def _pump(self):
+        # stamps whole chunks at once, so the pump keeps up with any rate
+        # of output and never holds back the subprocess.
+        out = open(self.path, 'wb')
+        size = 0
+        second = None
+        line_start = True
+        for chunk in iter(lambda: self.stream.read1(1 << 16), b''):
+            now = time.time()
+            if int(now) != second:
+                # format the date once per second
+                second = int(now)
+                date = time.strftime('%Y-%m-%d %H:%M:%S',
+                                     time.localtime(second)).encode()
+            stamp = b'%s.%03d ' % (date, int((now - second) * 1000))
+            body = chunk.replace(b'\n', b'\n' + stamp)
+            if chunk.endswith(b'\n'):
+                body = body[:-len(stamp)]
+            if line_start:
+                body = stamp + body
+            line_start = chunk.endswith(b'\n')
+            out.write(body)
+            size += len(body)
+            if size >= self.max_bytes and line_start:
+                out.close()
+                self._rotate()
+                out = open(self.path, 'wb')
+                size = 0
+        out.close()
+        self.stream.close()
+
+    def _rotate(self):
+        self.segment += 1
+        segment = '%s.%s' % (self.path, self.segment)
+        os.rename(self.path, segment)
+        compressor = threading.Thread(target=compress_file, args=(segment,))
+        compressor.start()
+        self.compressors[self.segment] = compressor
+        expired = self.segment - self.backups
+        if expired in self.compressors:
+            self.compressors.pop(expired).join()
+            old = '%s.%s' % (self.path, expired)
+            for name in [old] + glob.glob(glob.escape(old) + '.*'):
+                if os.path.exists(name):
+                    os.remove(name)
+
+    def join(self):
+        """
+        waits for the stream to close and for rotated logs to be compressed.
+        :return: None
+        """
+        self.thread.join()
+        for compressor in self.compressors.values():
+            compressor.join()
+
+
+# process pools of stages, which run in threads, see run_stages.  A fork
+# of a threaded process may copy locks held by other threads, so workers
+# are forked from a single threaded server instead.  Workers import this
+# module afresh, so the runtime settings are passed on, see
+# _runtime_settings.
+_mp_context = mp.get_context('forkserver')
+_mp_context.set_forkserver_preload(['pipelines'])
+
+# class attributes set by the activate_ and deactivate_ classmethods of the
+# stages, and by the command line of run.py
+RUNTIME_SETTINGS = ('call_active', 'check_expected_outputs_active',
+                    'remove_expected_outputs_active',
+                    'ignore_expected_outputs', 'check_output_integrity',
+                    'fast_rerun', 'pin_cpus', 'parallel_recon', 'native')
+
+# cpus of a pinned pool worker, see Stage._pool
+_worker_cpus = None
+
+
+def _runtime_settings():
+    """
+    :return: list of class, attribute, value of the runtime settings of
+    Stage and its subclasses, and of LogPump.max_bytes.
+    """
+    settings = [(LogPump, 'max_bytes', LogPump.max_bytes)]
+    classes = [Stage]
+    while classes:
+        cls = classes.pop()
+        classes += cls.__subclasses__()
+        settings += [(cls, name, value) for name, value in vars(cls).items()
+                     if name in RUNTIME_SETTINGS]
+    return settings
+
+
+def _init_worker(settings, sets=None):
+    """
+    initializes a pool worker of a stage, see Stage._pool.
+    :param settings: runtime settings, see _runtime_settings.
+    :param sets: queue of cpu sets, one of which the worker is pinned to.
+    :return: None
+    """
+    for cls, name, value in settings:
+        setattr(cls, name, value)
+    if sets is not None:
+        _pin_worker(sets)
+
+
+def _pin_worker(sets):
+    global _worker_cpus
+    _worker_cpus = sets.get()
+    os.sched_setaffinity(0, _worker_cpus)
+
+
+def _call(cmd, out_log, err_log, num_threads=1, fsloutputtype=None,
+          extra_env=None, cpus=None, limits=None, tmp_root=None):
+    if cpus:
+        # as many threads as cpus the command is pinned to
+        num_threads = len(cpus)
     env = os.environ.copy()
     if num_threads > 1:
         # set parallel environment variables
         env['OMP_NUM_THREADS'] = str(num_threads)
         env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(num_threads)
-    with open(out_log, 'w') as out, open(err_log, 'w') as err:
-        result = subprocess.call(cmd.split(), stdout=out, stderr=err, env=env)
-        if type(result) is list:
-            if all(v == 0 for v in result):
-                result = 0
-    return result
+    if fsloutputtype:
+        env['FSLOUTPUTTYPE'] = fsloutputtype
+    if extra_env:
+        env.update(extra_env)
+    args = cmd.split()
+    taskset = shutil.which('taskset') if cpus else None
+    if taskset:
+        # pinned from exec on, along with everything the command starts
+        args = [taskset, '-c', ','.join(map(str, cpus))] + args
+    with CommandLimits(tmp_root=tmp_root, **(limits or {})) as limiter:
+        env.update(limiter.env)
+        if limiter:
+            args = limiter.wrap(args)
+        proc = subprocess.Popen(
+            args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        if cpus and not taskset:
+            # processes the command started meanwhile are not pinned
+            try:
+                os.sched_setaffinity(proc.pid, cpus)
+            except ProcessLookupError:
+                pass
+        pumps = [LogPump(proc.stdout, out_log),
+                 LogPump(proc.stderr, err_log)]
+        result = proc.wait()
+        for pump in pumps:
+            pump.join()
+        return limiter.check(result, err_log)
 
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+__doc__ = \
+"""Gzips the nifti images written uncompressed by a pipeline stage run with
+an FSLOUTPUTTYPE of NIFTI, as the pipeline does once the stage's commands
+complete.  Used by exported command graphs, see --export-dag.
+"""
+
+import os
+
+import cli
+
+from storage import recompress_images
+
+
+def _cli(argv=None):
+    """
+    command line interface
+    :param argv: optional list of arguments, default is sys.argv.
+    :return:
+    """
+    return cli.run(generate_parser, recompress, argv, errors=(OSError,))
+
+
+def generate_parser(parser=None):
+    """
+    Generates the command line parser for this program.
+    :param parser: optional subparser for wrapping this program as a submodule.
+    :return: ArgumentParser for this script/module
+    """
+    parser = cli.make_parser(__doc__, parser)
+    parser.add_argument(
+        'expected', nargs='*',
+        help='Expected outputs of the stage.  The .nii counterparts of '
+             'missing .nii.gz outputs are compressed, .nii outputs are not.'
+    )
+    parser.add_argument(
+        '--folder', action='append', dest='folders', default=[],
+        help='Folder searched for uncompressed images modified since the '
+             'stage started.  May be given more than once.'
+    )
+    parser.add_argument(
+        '--newer', metavar='FILE',
+        help='File created when the stage started.  Folders are searched '
+             'only if it is given.'
+    )
+    parser.add_argument(
+        '--level', type=int, default=None,
+        help='gzip level from 1 (fastest) to 9.'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='Number of compression threads.'
+    )
+
+    return parser
+
+
+def recompress(expected, folders=(), newer=None, level=None, workers=1):
+    """
+    :param expected: expected outputs of the stage.
+    :param folders: folders searched for uncompressed images.
+    :param newer: file whose modification time is the start of the stage.
+    :param level: gzip level.
+    :param workers: number of compression threads.
+    :return: None
+    """
+    since = os.stat(newer).st_mtime if newer else None
+    compressed = recompress_images(expected, folders, since, workers, level)
+    for filename in compressed:
+        print('compressed %s' % filename)
+
+
+if __name__ == '__main__':
+    _cli()
@@ -28,14 +28,26 @@ Neuroinform. 2014 Apr 28;8:44. doi: 10.3389/fninf.2014.00044. eCollection 2014.
 __version__ = "0.1.6"
 
 import argparse
+import contextlib
 import os
+import re
+import shutil
+import sys
+import time
 
-from helpers import read_bids_dataset, validate_config, validate_license
+import dedupe
+from helpers import (read_bids_dataset, share_anatomicals, validate_config,
+                     validate_license)
 from pipelines import (ParameterSettings, PreFreeSurfer, FreeSurfer,
                        PostFreeSurfer, FMRIVolume, FMRISurface,
                        DCANBOLDProcessing, ExecutiveSummary, CustomClean,
-                       DiffusionPreprocessing)
+                       Archive, CommandGraph, CostModel,
+                       DiffusionPreprocessing, LogPump, RetentionPolicy,
+                       SHARED_ANAT_FOLDERS, SHARED_ANAT_MARKER, Status,
+                       StatusIndex, run_stages)
 from extra_pipelines import ABCDTask
+from limits import parse_limits
+from storage import DiskBudget, ScratchSpace, link_tree
 
 
 def _cli():
@@ -43,8 +55,17 @@ def _cli():
     command line interface
     :return:
     """
+    if sys.argv[1:2] and sys.argv[1] in COMMANDS:
+        args = vars(generate_command_parser().parse_args())
+        del args['command']
+        return args.pop('func')(**args)
+
     parser = generate_parser()
     args = parser.parse_args()
+    if args.export_dag and args.min_usable_frames:
+        # runs are excluded once FMRIVolume ran, after the graph is written
+        parser.error('--export-dag cannot exclude runs by '
+                     '--min-usable-frames')
 
     kwargs = {
         'bids_dir': args.bids_dir,
@@ -55,20 +76,170 @@ def _cli():
         'ncpus': args.ncpus,
         'stages': args.stages,
         'bandstop_params': args.bandstop,
+        'min_usable_frames': args.min_usable_frames,
         'check_only': args.check_outputs_only,
+        'estimate': args.estimate,
         'run_abcd_task': args.abcd_task,
         'study_template': args.study_template,
         'cleaning_json': args.cleaning_json,
+        'custom_clean_native': args.custom_clean_native,
+        'archive_target': args.archive,
+        'archive_split': args.archive_split,
+        'anat_from_session': args.anat_from_session,
         'print_commands': args.print,
+        'export_dag': args.export_dag,
         'ignore_expected_outputs': args.ignore_expected_outputs,
+        'check_output_integrity': args.check_output_integrity,
+        'fast_rerun': args.fast_rerun,
+        'freesurfer_parallel': args.freesurfer_parallel,
+        'cpu_affinity': args.cpu_affinity,
+        'log_max_mb': args.log_max_mb,
         'ignore_modalities': args.ignore,
         'freesurfer_license': args.freesurfer_license,
-        'dcmethod': args.dcmethod
+        'dcmethod': args.dcmethod,
+        'scratch_dir': args.scratch_dir,
+        'scratch_keep': args.scratch_keep,
+        'scratch_sync': args.scratch_sync,
+        'input_cache': args.input_cache,
+        'input_cache_gb': args.input_cache_gb,
+        'retention_policy': args.prune_intermediates,
+        'max_disk_gb': args.max_disk_gb,
+        'fsloutputtypes': args.fsl_output_type,
+        'resource_limits': args.limits
     }
 
     return interface(**kwargs)
 
 
+# commands which act on a whole output directory, see generate_command_parser
+COMMANDS = ('status', 'dedupe')
+
+
+def generate_command_parser():
+    """
+    Generates the command line parser of the commands, each a subparser.
+    :return: ArgumentParser whose arguments hold the function of the command
+    in "func" and its keyword arguments.
+    """
+    parser = argparse.ArgumentParser(prog='abcd-hcp-pipeline')
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND',
+                                     required=True)
+    status = commands.add_parser(
+        'status', help='Summarize the progress of every session.',
+        description='Summarize the progress of every session in an output '
+                    'directory from its status index.',
+        usage='abcd-hcp-pipeline status output_dir [OPTIONS]'
+    )
+    generate_status_parser(status)
+    status.set_defaults(func=status_report)
+    dedupe_parser = commands.add_parser(
+        'dedupe', help='Link identical files across sessions.',
+        description=dedupe.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        usage='abcd-hcp-pipeline dedupe output_dir [OPTIONS]'
+    )
+    dedupe.generate_parser(dedupe_parser)
+    dedupe_parser.set_defaults(func=dedupe.dedupe)
+    return parser
+
+
+def generate_status_parser(parser=None):
+    """
+    Generates the command line parser for the status query command.
+    :param parser: optional subparser for wrapping this program as a submodule.
+    :return: ArgumentParser for the status command
+    """
+    if not parser:
+        parser = argparse.ArgumentParser(
+            prog='abcd-hcp-pipeline status',
+            description='Summarize the progress of every session in an '
+                        'output directory from its status index.',
+            usage='%(prog)s output_dir [OPTIONS]'
+        )
+    parser.add_argument(
+        'output_dir',
+        help='Path to the output directory given to the pipeline runs.'
+    )
+    parser.add_argument(
+        '--participant-label', dest='subject_list', metavar='ID', nargs='+',
+        help='Optional list of participant IDs to report on. The '
+             'participant label does not include the "sub-" prefix'
+    )
+    parser.add_argument(
+        '--session-id', dest='session_list', metavar='LABEL', nargs='+',
+        help='Optional list of session ids to report on. A session id does '
+             'not include "ses-"'
+    )
+    parser.add_argument(
+        '--failed-matching', metavar='PATTERN', dest='failure_pattern',
+        type=_regular_expression,
+        help='List sessions whose last failure comment matches the given '
+             'regular expression. Use "." to list every failure.'
+    )
+    parser.add_argument(
+        '--rebuild', action='store_true',
+        help='Record every status.json under output_dir in the index, '
+             'e.g. for sessions run before the index existed.'
+    )
+
+    return parser
+
+
+def _regular_expression(pattern):
+    # argparse type of --failed-matching
+    try:
+        re.compile(pattern)
+    except re.error as e:
+        raise argparse.ArgumentTypeError(
+            'invalid regular expression "%s": %s' % (pattern, e))
+    return pattern
+
+
+def status_report(output_dir, subject_list=None, session_list=None,
+                  failure_pattern=None, rebuild=False):
+    """
+    prints per stage counts, running stages and optionally matching failures
+    :param output_dir: output folder shared by all sessions.
+    :param subject_list: participant labels to filter on.
+    :param session_list: session labels to filter on.
+    :param failure_pattern: regular expression for last failure comments.
+    :param rebuild: rescan all status.json files into the index first.
+    :return:
+    """
+    assert os.path.isdir(output_dir), output_dir + ' is not a directory!'
+    index = StatusIndex(os.path.join(output_dir, StatusIndex.name))
+    if rebuild:
+        print('indexed %s status files' % index.rebuild(output_dir))
+    filters = {'subjects': subject_list, 'sessions': session_list}
+    state_names = {v: k for k, v in Status.states.items()}
+    columns = ['succeeded', 'failed', 'incomplete', 'not_started',
+               'unchecked']
+
+    counts = {}
+    for stage, node_status, count in index.stage_counts(**filters):
+        counts.setdefault(stage, {})[state_names.get(node_status)] = count
+    print('%-24s' % 'stage' + ''.join('%12s' % c for c in columns))
+    for stage in sorted(counts):
+        print('%-24s' % stage +
+              ''.join('%12s' % counts[stage].get(c, 0) for c in columns))
+
+    running = index.running(**filters)
+    print('\n%s running' % len(running))
+    for subject, session, stage, host, updated in running:
+        print('sub-%s ses-%s %s on %s since %s' % (
+            subject, session, stage, host,
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(updated))))
+
+    if failure_pattern is not None:
+        failures = index.failures(failure_pattern, **filters)
+        print('\n%s failures matching "%s"' % (len(failures),
+                                                failure_pattern))
+        for subject, session, stage, node_status, comment in failures:
+            print('sub-%s ses-%s %s (%s): %s' % (
+                subject, session, stage, state_names.get(node_status),
+                comment))
+
+
 def generate_parser(parser=None):
     """
     Generates the command line parser for this program.
@@ -82,7 +253,8 @@ def generate_parser(parser=None):
             formatter_class=argparse.RawDescriptionHelpFormatter,
             epilog=__references__,
             usage='%(prog)s bids_dir output_dir --freesurfer-license=<LICENSE>'
-                  ' [OPTIONS]'
+                  ' [OPTIONS]\n       %(prog)s status output_dir [OPTIONS]'
+                  '\n       %(prog)s dedupe output_dir [OPTIONS]'
         )
     parser.add_argument(
         'bids_dir',
@@ -170,7 +342,8 @@ def generate_parser(parser=None):
              'no --stage argument. '
              'Valid stage names: '
              'PreFreeSurfer, FreeSurfer, PostFreeSurfer, FMRIVolume, '
-             'FMRISurface, DCANBOLDProcessing, ExecutiveSummary, CustomClean'
+             'FMRISurface, DCANBOLDProcessing, ExecutiveSummary, CustomClean, '
+             'Archive'
     )
     parser.add_argument(
         '--bandstop', type=float, nargs=2, metavar=('LOWER', 'UPPER'),
@@ -182,6 +355,14 @@ def generate_parser(parser=None):
              'frequency of greater than 1 Hz (TR less than 1 second). '
              'Default is no filter.'
     )
+    parser.add_argument(
+        '--min-usable-frames', type=int, metavar='FRAMES',
+        help='Skip BOLD runs with fewer usable frames, below the framewise '
+             'displacement threshold and in sequences of contiguous low '
+             'motion frames, in the stages following FMRIVolume. Frames '
+             'are counted from the motion correction parameters once '
+             'FMRIVolume completes. Default is to process every run.'
+    )
     extras = parser.add_argument_group(
         'Special pipeline options',
         description='Options which pertain to an alternative pipeline or an '
@@ -193,6 +374,36 @@ def generate_parser(parser=None):
              'in the optional CustomClean stage. Required if '
              'CustomClean is in the list of stages to be run. '
     )
+    extras.add_argument(
+        '--custom-clean-native', action='store_true',
+        help='Run CustomClean with the bundled cleaner, which walks and '
+             'cleans the top-level folders of the session concurrently, '
+             'instead of the DCAN cleaning script. It reads the same '
+             '--custom-clean template, see docs/usage.md.'
+    )
+    extras.add_argument(
+        '--archive', metavar='TARGET_DIR',
+        help='Adds an Archive stage to the end, which writes the session '
+             'files and logs folders to tar archives and a sha256 manifest '
+             'in TARGET_DIR. Archives are compressed with multi-threaded '
+             'zstd, and members which are already compressed are written to '
+             'a separate uncompressed tar.'
+    )
+    extras.add_argument(
+        '--archive-split', choices=['none', 'modality'], default='none',
+        help='Write one archive per session, or one per modality (anat, '
+             'func, summary, logs) concurrently. Default: none'
+    )
+    extras.add_argument(
+        '--anat-from-session', metavar='LABEL',
+        help='Runs the anatomical stages only for session LABEL of each '
+             'subject, and links its anatomical outputs into the other '
+             'sessions, which run the functional stages only. Sessions '
+             'without a T1w use the T1w of session LABEL. The linked outputs '
+             'are made read-only, so that a command writing to one fails '
+             'instead of modifying session LABEL, until the anatomical '
+             'stages of session LABEL run again.'
+    )
     extras.add_argument(
         '--abcd-task', action='store_true',
         help='Runs ABCD task data through task fMRI analysis, adding this '
@@ -220,24 +431,215 @@ def generate_parser(parser=None):
         help='Checks for the existence of outputs for each stage then exit. '
              'Useful for debugging.'
     )
+    runopts.add_argument(
+        '--estimate', action='store_true',
+        help='Reports the projected output size, peak memory and core-hours '
+             'of each stage and session, from the dimensions of the input '
+             'images, then exit. Sessions which do not fit in the free space '
+             'of output_dir are flagged. Coefficients are read from '
+             '/app/pipeline_cost_model.json.'
+    )
     runopts.add_argument(
         '--print-commands-only', action='store_true', dest='print',
         help='Print run commands for each stage to shell then exit.'
     )
+    runopts.add_argument(
+        '--export-dag', metavar='FILE',
+        help='Write the commands of every stage of the selected sessions, '
+             'including stage setup and teardown commands and the '
+             'recompression of NIFTI outputs, with their dependencies, logs, '
+             'thread counts, environment and input and output files, to FILE '
+             'then exit. Written as a JSON graph if FILE ends with ".json", '
+             'else as a GNU Makefile to run with "make -j". Cannot be used '
+             'with --min-usable-frames.'
+    )
     runopts.add_argument(
         '--ignore-expected-outputs', action='store_true',
         help='Continues pipeline even if some expected outputs are missing.'
     )
+    runopts.add_argument(
+        '--log-max-mb', type=float, metavar='MB',
+        default=LogPump.max_bytes / 1024 ** 2,
+        help='Size at which stage logs are rotated and compressed. The '
+             'newest %s rotated logs are kept, and logs of the previous run '
+             'are kept with a ".prev" suffix. Default: %%(default)s'
+             % LogPump.backups
+    )
+    runopts.add_argument(
+        '--fast-rerun', action='store_true',
+        help='When rerunning FreeSurfer or FMRIVolume, move the earlier '
+             'output directories to a trash folder and start the stage '
+             'immediately, deleting the trash in the background.'
+    )
+    runopts.add_argument(
+        '--freesurfer-parallel', action='store_true',
+        help='Run recon-all with both hemispheres in parallel, each using '
+             'half of --ncpus threads, by passing "-parallel -openmp N" to '
+             'the recon-all calls of FreeSurferPipeline.sh. Multithreaded '
+             'steps are not bitwise reproducible, so outputs may differ '
+             'slightly from the default, single threaded recon.'
+    )
+    runopts.add_argument(
+        '--cpu-affinity', action='store_true',
+        help='Pin each concurrently running command to its own set of the '
+             'cores this process may use, keeping each set within a NUMA '
+             'node where possible. Commands run with as many threads as '
+             'cores in their set.'
+    )
+    runopts.add_argument(
+        '--check-output-integrity', action='store_true',
+        help='Expected outputs must also be non-empty and, for nifti, cifti '
+             'and gifti files, have a valid header and not be truncated.'
+    )
+    runopts.add_argument(
+        '--prune-intermediates', metavar='POLICY_JSON', nargs='?',
+        const='default',
+        help='Delete intermediate files as soon as every stage which '
+             'consumes them has succeeded. Optionally give a retention '
+             'policy JSON, default is /app/pipeline_retention_policy.json. '
+             'Expected outputs are never deleted.'
+    )
+    runopts.add_argument(
+        '--max-disk-gb', type=float, metavar='GB',
+        help='Wait before starting each session until the file system '
+             'holding output_dir has room for its projected size within '
+             'this many GB of used space, not counting space used by this '
+             'run.'
+    )
+    runopts.add_argument(
+        '--fsl-output-type', metavar='STAGE=TYPE', action='append',
+        type=_stage_setting(parse_fsloutputtype),
+        help='FSLOUTPUTTYPE for one stage, one of NIFTI_GZ or NIFTI, e.g. '
+             '"FMRIVolume=NIFTI". With NIFTI, intermediates are written '
+             'uncompressed, which saves cpu time on fast scratch disks, and '
+             'once the stage completes every nifti image it wrote '
+             'uncompressed is gzipped in parallel at a fast compression '
+             'level. Images expected as .nii and cifti files stay '
+             'uncompressed. Option can be repeated. Default is the '
+             'FSLOUTPUTTYPE of the environment.'
+    )
+    runopts.add_argument(
+        '--limits', metavar='STAGE=LIMITS', action='append',
+        type=_stage_setting(parse_stage_limits),
+        help='Resource limits of each subprocess of one stage, or of every '
+             'stage with "all", as comma separated items of memory_gb:GB, '
+             'nice:N and private_tmp, e.g. '
+             '"FMRIVolume=memory_gb:16,nice:5,private_tmp". memory_gb caps '
+             'the memory of each command and its children, through a cgroup '
+             'of its own where the cgroup v2 cgroup of the pipeline is '
+             'delegated to it, else as an address space limit. private_tmp '
+             'runs each command with a TMPDIR of its own, next to the '
+             'session "files" folder or on scratch, which is removed when it '
+             'exits. Commands killed by a limit are reported as such in the '
+             'stage status. Option can be repeated.'
+    )
+    runopts.add_argument(
+        '--scratch-dir', metavar='DIR',
+        help='Node-local directory in which to run each session. Input '
+             'niftis and existing outputs are staged there, and outputs are '
+             'synced back to output_dir with checksum verification. Logs are '
+             'always written to output_dir.'
+    )
+    runopts.add_argument(
+        '--scratch-keep', metavar='PATTERN', action='append',
+        help='Glob pattern, relative to the session "files" folder, of '
+             'outputs to sync back from --scratch-dir, e.g. '
+             '"MNINonLinear/*". Option can be repeated. Default is all files.'
+    )
+    runopts.add_argument(
+        '--input-cache', metavar='DIR',
+        help='Directory, e.g. on node-local disk, holding uncompressed '
+             'copies of gzipped BOLD and field map inputs, which FMRIVolume '
+             'reads instead of decompressing the inputs again. Each version '
+             'of an input is decompressed once, and the cache may be shared '
+             'by concurrent jobs.'
+    )
+    runopts.add_argument(
+        '--input-cache-gb', type=float, default=50, metavar='GB',
+        help='Size of --input-cache, least recently used copies are evicted '
+             'beyond it, except copies which a running FMRIVolume stage '
+             'still reads. Default: %(default)s'
+    )
+    runopts.add_argument(
+        '--scratch-sync', choices=['stage', 'end'], default='stage',
+        help='Sync outputs back from --scratch-dir whenever a stage ends '
+             'with no other stage running, or only once the session ends. '
+             'Default: stage'
+    )
 
     return parser
 
 
+# stage names accepted by the STAGE=VALUE options
+STAGES = tuple(stage.__name__ for stage in (
+    PreFreeSurfer, FreeSurfer, PostFreeSurfer, FMRIVolume, FMRISurface,
+    DCANBOLDProcessing, ExecutiveSummary, ABCDTask, CustomClean, Archive))
+
+
+def split_stage_setting(item, names=STAGES):
+    """
+    :param item: "STAGE=VALUE" value of a per stage option.
+    :param names: accepted stage names.
+    :return: tuple of stage name and value.
+    """
+    stage_name, sep, value = item.partition('=')
+    if not sep or not value:
+        raise ValueError('"%s" is not of the form STAGE=VALUE' % item)
+    if stage_name not in names:
+        raise ValueError('"%s" is not a stage, use one of %s' %
+                         (stage_name, ', '.join(names)))
+    return stage_name, value
+
+
+def parse_fsloutputtype(item):
+    """
+    :param item: "STAGE=TYPE" value of --fsl-output-type.
+    :return: tuple of stage name and FSLOUTPUTTYPE.
+    """
+    stage_name, output_type = split_stage_setting(item)
+    if output_type not in ('NIFTI_GZ', 'NIFTI'):
+        raise ValueError('"%s" is not a supported FSLOUTPUTTYPE, use NIFTI_GZ '
+                         'or NIFTI' % output_type)
+    return stage_name, output_type
+
+
+def parse_stage_limits(item):
+    """
+    :param item: "STAGE=LIMITS" value of --limits, where STAGE may be "all".
+    :return: tuple of stage name and dict of limits, see parse_limits.
+    """
+    stage_name, limits = split_stage_setting(item, STAGES + ('all',))
+    return stage_name, parse_limits(limits)
+
+
+def _stage_setting(parse):
+    # argparse type which checks an option value with parse, see interface
+    def check(item):
+        try:
+            parse(item)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+        return item
+    return check
+
+
 def interface(bids_dir, output_dir, subject_list=None, collect=False, ncpus=1,
-              stages=None, bandstop_params=None, check_only=False,
+              stages=None, bandstop_params=None, min_usable_frames=None,
+              check_only=False, estimate=False,
               run_abcd_task=False, study_template=None, cleaning_json=None,
-              print_commands=False, ignore_expected_outputs=False,
+              custom_clean_native=False,
+              archive_target=None, archive_split='none',
+              anat_from_session=None,
+              print_commands=False, export_dag=None,
+              ignore_expected_outputs=False,
+              check_output_integrity=False, fast_rerun=False,
+              freesurfer_parallel=False, cpu_affinity=False,
+              log_max_mb=None,
               ignore_modalities=[], freesurfer_license=None, session_list=None,
-              dcmethod=None):
+              dcmethod=None, scratch_dir=None, scratch_keep=None,
+              scratch_sync='stage', input_cache=None, input_cache_gb=50,
+              retention_policy=None, max_disk_gb=None,
+              fsloutputtypes=None, resource_limits=None):
     """
     main application interface
     :param bids_dir: input bids dataset see "helpers.read_bids_dataset" for
@@ -250,15 +652,40 @@ def interface(bids_dir, output_dir, subject_list=None, collect=False, ncpus=1,
     :param ncpus: number of cores for parallelized processing.
     :param stages: only run a subset of stages.
     :param bandstop_params: tuple of lower and upper bound for stop-band filter
+    :param min_usable_frames: skip runs with fewer usable frames after
+    FMRIVolume
     :param check_only: check expected outputs for each stage then terminate
+    :param estimate: report projected disk, memory and core-hours then
+    terminate
     :param study_template: specified head and brain templates for intermediate registration
     :param cleaning_json: template JSON for use in optional CustomClean stage
+    :param custom_clean_native: clean with the bundled cleaner
+    :param archive_target: output directory of the optional Archive stage
+    :param archive_split: one archive per session ("none") or "modality"
+    :param anat_from_session: session whose anatomical outputs are shared by
+    the subject's other sessions
     :param print_commands: flag to print commands only, without running pipeline
+    :param export_dag: write the command graph to this Makefile or JSON file
     :param ignore_expected_outputs: continue processing even if expected intermediate outputs are missing
+    :param check_output_integrity: check expected output sizes and headers
+    :param fast_rerun: trash earlier output directories, deleting them in
+    the background
+    :param freesurfer_parallel: run recon-all hemispheres in parallel
+    :param cpu_affinity: pin concurrent commands to disjoint sets of cores
+    :param log_max_mb: size at which stage logs are rotated and compressed
     :param ignore_modalities: skip processing of specified modalities (func, dwi)
     :param freesurfer_license: FreeSurfer license file
     :param session_list: list of BIDS sessions, for filtering what input data to process
     :param dcmethod: override default fmap distortion correction method  
+    :param scratch_dir: node-local directory to run sessions in
+    :param scratch_keep: glob patterns of outputs to sync back from scratch
+    :param scratch_sync: sync back from scratch after each "stage" or at "end"
+    :param input_cache: directory for uncompressed copies of inputs
+    :param input_cache_gb: size of the input cache
+    :param retention_policy: prune intermediates, "default" or a policy json
+    :param max_disk_gb: disk budget for output_dir's file system
+    :param fsloutputtypes: list of "STAGE=TYPE" FSLOUTPUTTYPE overrides
+    :param resource_limits: list of "STAGE=LIMITS" subprocess limits
     :return:
     """
     if not check_only or not print_commands:
@@ -272,6 +699,27 @@ def interface(bids_dir, output_dir, subject_list=None, collect=False, ncpus=1,
         collect_on_subject=collect, session_list=session_list
     )
 
+    if log_max_mb:
+        LogPump.max_bytes = int(log_max_mb * 1024 ** 2)
+    disk_budget = None
+    # nothing is run or written to the session folders
+    preview = check_only or print_commands or estimate or export_dag
+    if max_disk_gb and not preview:
+        disk_budget = DiskBudget(output_dir, max_disk_gb)
+
+    estimate_total = {'disk_gb': 0., 'memory_gb': 0., 'core_hours': 0.}
+    graph = CommandGraph() if export_dag else None
+
+    anat_references = {}
+    if anat_from_session:
+        # process each subject's reference session first
+        session_generator = list(session_generator)
+        first = {}
+        for idx, session in enumerate(session_generator):
+            first.setdefault(session['subject'], idx)
+        session_generator.sort(key=lambda x: (
+            first[x['subject']], x['session'] != anat_from_session))
+
     # run each session in serial
     for session in session_generator:
         # setup session configuration
@@ -280,15 +728,31 @@ def interface(bids_dir, output_dir, subject_list=None, collect=False, ncpus=1,
             'sub-%s' % session['subject'],
             'ses-%s' % session['session']
         )
+        # share anatomical outputs of the reference session
+        anat_reference = None
+        if anat_from_session and session['session'] == anat_from_session:
+            anat_references[session['subject']] = session
+        elif anat_from_session and session['session'] is not None:
+            anat_reference = get_anat_reference(
+                bids_dir, output_dir, session['subject'], anat_from_session,
+                anat_references)
+            if anat_reference is None:
+                print('WARNING: anatomical outputs of ses-%s not found for '
+                      'sub-%s, running anatomical stages for ses-%s.' % (
+                          anat_from_session, session['subject'],
+                          session['session']))
+            elif 'T1w' not in session['types']:
+                session = share_anatomicals(session, anat_reference)
         # detect available data for pipeline stages
         validate_config(session, ignore_modalities)
         modes = session['types']
-        run_anat = 'T1w' in modes
+        run_anat = 'T1w' in modes and anat_reference is None
         run_func = 'bold' in modes and 'func' not in ignore_modalities
         run_dwi = 'dwi' in modes and 'dwi' not in ignore_modalities
         summary = True
 
         session_spec = ParameterSettings(session, out_dir)
+        session_spec.set_status_index(output_dir)
         if not run_func:
             anat_only = True
             session_spec.set_anat_only(anat_only)
@@ -298,7 +762,47 @@ def interface(bids_dir, output_dir, subject_list=None, collect=False, ncpus=1,
             session_spec.set_study_template(*study_template)
         if dcmethod is not None:
             session_spec.set_dcmethod(dcmethod)
-        
+        if min_usable_frames:
+            session_spec.set_min_usable_frames(min_usable_frames)
+        if input_cache:
+            session_spec.set_input_cache(input_cache, input_cache_gb)
+        for item in fsloutputtypes or []:
+            session_spec.set_fsloutputtype(*parse_fsloutputtype(item))
+        for item in resource_limits or []:
+            stage_name, limits = parse_stage_limits(item)
+            session_spec.set_resource_limits(stage_name, **limits)
+
+        if anat_reference and not preview:
+            ref_files = os.path.join(
+                output_dir, 'sub-%s' % session['subject'],
+                'ses-%s' % anat_from_session, 'files')
+            print('linking anatomical outputs of %s' % ref_files)
+            for folder in SHARED_ANAT_FOLDERS:
+                # per run results stay in each session.  The reference is
+                # read-only until its anatomical stages run again.
+                link_tree(os.path.join(ref_files, folder),
+                          os.path.join(out_dir, 'files', folder),
+                          exclude=('Results',), read_only=True)
+            marker = os.path.join(ref_files, SHARED_ANAT_MARKER)
+            linked = []
+            if os.path.exists(marker):
+                with open(marker) as fd:
+                    linked = fd.read().splitlines()
+            if out_dir not in linked:
+                with open(marker, 'a') as fd:
+                    fd.write(out_dir + '\n')
+
+        # stage session to node-local scratch
+        scratch = None
+        if scratch_dir and not preview:
+            scratch = ScratchSpace(
+                os.path.join(scratch_dir, os.path.relpath(out_dir, output_dir)),
+                out_dir, keep=scratch_keep, workers=max(4, ncpus)
+            )
+            print('staging session to %s' % scratch.root)
+            session_spec.set_scratch(
+                scratch.path, scratch.stage_inputs(session, bids_dir))
+            scratch.stage_outputs()
 
         # create pipelines
         order = []
@@ -332,6 +836,9 @@ def interface(bids_dir, output_dir, subject_list=None, collect=False, ncpus=1,
         if cleaning_json:
             cclean = CustomClean(session_spec, cleaning_json)
             order.append(cclean)
+        if archive_target:
+            archive = Archive(session_spec, archive_target, archive_split)
+            order.append(archive)
 
         if stages:
             # User can indicate start or end or both; default
@@ -369,30 +876,156 @@ def interface(bids_dir, output_dir, subject_list=None, collect=False, ncpus=1,
             order = order[start_idx:end_idx]
 
         # special runtime options
+        if check_output_integrity:
+            for stage in order:
+                stage.activate_check_output_integrity()
+        if fast_rerun:
+            for stage in order:
+                stage.activate_fast_rerun()
+        if freesurfer_parallel:
+            FreeSurfer.activate_parallel_recon()
+        if cpu_affinity:
+            for stage in order:
+                stage.activate_cpu_pinning()
+        if custom_clean_native:
+            CustomClean.activate_native_clean()
         if check_only:
             for stage in order:
                 print('checking outputs for %s' % stage.__class__.__name__)
                 try:
-                    stage.check_expected_outputs()
+                    stage.check_expected_outputs(record=False)
                 except AssertionError:
                     pass
             return
+        if export_dag:
+            graph.add_stages(order, ncpus)
+            continue
+        if not print_commands:
+            # projected needs of the session
+            names = [x.__class__.__name__ for x in order]
+            if estimate:
+                print('projected needs of sub-%s ses-%s:' % (
+                    session['subject'], session['session']))
+                need = CostModel(session_spec).report(names, ncpus)
+                for key in ('disk_gb', 'core_hours'):
+                    estimate_total[key] += need[key]
+                estimate_total['memory_gb'] = max(
+                    estimate_total['memory_gb'], need['memory_gb'])
+            else:
+                need = CostModel(session_spec).total(names, ncpus)
+            if disk_budget and not disk_budget.wait(need['disk_gb']):
+                print('Not starting sub-%s ses-%s.' % (
+                    session['subject'], session['session']))
+                if scratch:
+                    scratch.cleanup()
+                continue
+            free_gb = shutil.disk_usage(output_dir).free / 1024 ** 3
+            if need['disk_gb'] > free_gb:
+                print('ERROR: sub-%s ses-%s needs %.1f GB, but only %.1f GB '
+                      'are free in %s. Not starting this session.' % (
+                          session['subject'], session['session'],
+                          need['disk_gb'], free_gb, output_dir))
+                if scratch:
+                    scratch.cleanup()
+                continue
+            if estimate:
+                continue
         if print_commands:
             for stage in order:
                 stage.deactivate_runtime_calls()
                 stage.deactivate_check_expected_outputs()
                 stage.deactivate_remove_expected_outputs()
+        if run_func and vol not in order and not print_commands:
+            # runs excluded when FMRIVolume ran earlier
+            vol.exclude_high_motion_runs()
         if ignore_expected_outputs:
             print('ignoring checks for expected outputs.')
             for stage in order:
                 stage.activate_ignore_expected_outputs()
 
-        # run pipelines
-        for stage in order:
+        retention = None
+        if retention_policy and not print_commands:
+            retention = RetentionPolicy(
+                session_spec,
+                None if retention_policy == 'default' else retention_policy)
+
+        def before(stage):
             print('abcd-hcp-pipeline v%s' % __version__ )
             print('running %s' % stage.__class__.__name__)
             print(stage)
-            stage.run(ncpus)
+
+        def after(stage):
+            if retention:
+                retention.prune()
+
+        def idle():
+            # between stages, so that no stage writes while syncing
+            if scratch and scratch_sync == 'stage':
+                scratch.sync_back()
+
+        if not print_commands:
+            session_spec.record()
+
+        # run pipelines, independent stages concurrently
+        try:
+            with disk_budget.track() if disk_budget else \
+                    contextlib.nullcontext():
+                run_stages(order, ncpus, before=before, after=after,
+                           idle=idle)
+        except BaseException:
+            # keep outputs of a failed stage for debugging, without hiding
+            # its error behind one of the sync
+            if scratch:
+                try:
+                    scratch.sync_back()
+                except Exception as e:
+                    print('WARNING: could not sync %s back, leaving it in '
+                          'place: %s' % (scratch.root, e))
+                else:
+                    scratch.cleanup()
+            raise
+        if scratch:
+            scratch.sync_back()
+            scratch.cleanup()
+
+    if export_dag:
+        if export_dag.endswith('.json'):
+            graph.write_json(export_dag)
+        else:
+            graph.write_makefile(export_dag)
+        print('wrote %s commands to %s' % (len(graph.nodes), export_dag))
+
+    if estimate:
+        print('projected needs of all sessions: %.1f GB disk, %.1f GB peak '
+              'memory, %.1f core-hours' % (estimate_total['disk_gb'],
+                                           estimate_total['memory_gb'],
+                                           estimate_total['core_hours']))
+
+
+def get_anat_reference(bids_dir, output_dir, subject, label, references):
+    """
+    finds the reference session of a subject for --anat-from-session.
+    :param bids_dir: bids input folder.
+    :param output_dir: pipeline output folder.
+    :param subject: participant label.
+    :param label: reference session label.
+    :param references: dict of subject to reference session spec for the
+    sessions processed so far, updated with any session read here.
+    :return: reference session spec, or None if the reference session has
+    no anatomical outputs.
+    """
+    if subject not in references:
+        # reference session processed by an earlier run
+        ref_path = os.path.join(output_dir, 'sub-%s' % subject,
+                                'ses-%s' % label, 'files', 'T1w')
+        if not os.path.isdir(ref_path):
+            return None
+        reference = next(read_bids_dataset(
+            bids_dir, subject_list=[subject], session_list=[label]))
+        if reference['session'] != label:
+            return None
+        references[subject] = reference
+    return references[subject]
 
 
 if __name__ == '__main__':
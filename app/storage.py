@@ -0,0 +1,950 @@
+import contextlib
+import fcntl
+import fnmatch
+import gzip
+import hashlib
+import os
+import queue
+import shutil
+import stat
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def file_checksum(filename, blocksize=1 << 20):
+    """
+    :param filename: path to a regular file.
+    :return: hex digest of the file contents.
+    """
+    digest = hashlib.blake2b()
+    with open(filename, 'rb') as fd:
+        for block in iter(lambda: fd.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def copy_verified(src, dst, blocksize=1 << 20):
+    """
+    copies a file through a temporary name, checking the checksum of the
+    written copy against the source before moving it into place.
+    :param src: source file.
+    :param dst: destination file, replaced atomically.
+    :return: hex digest of the file contents.
+    """
+    tmp = '%s.sync-%s' % (dst, os.getpid())
+    digest = hashlib.blake2b()
+    with open(src, 'rb') as fin, open(tmp, 'wb') as fout:
+        for block in iter(lambda: fin.read(blocksize), b''):
+            digest.update(block)
+            fout.write(block)
+    shutil.copystat(src, tmp)
+    checksum = digest.hexdigest()
+    if file_checksum(tmp) != checksum:
+        os.remove(tmp)
+        raise IOError('checksum mismatch copying %s to %s' % (src, dst))
+    os.replace(tmp, dst)
+    return checksum
+
+
+def gzip_files(filenames, workers=1, level=None):
+    """
+    gzips files in place, replacing each with a ".gz" file.  Uses pigz
+    threads when it is installed, otherwise compresses files concurrently.
+    :param filenames: list of files to compress.
+    :param workers: number of threads.
+    :param level: compression level from 1 (fastest) to 9, default is 6
+    with pigz and 9 with the gzip module.
+    :return: None
+    """
+    pigz = shutil.which('pigz')
+
+    def compress(filename):
+        if pigz:
+            cmd = [pigz, '-f', '-p', str(workers)]
+            if level:
+                cmd.append('-%d' % level)
+            subprocess.check_call(cmd + [filename])
+            return
+        tmp = '%s.gz.tmp' % filename
+        with open(filename, 'rb') as fin, \
+                gzip.open(tmp, 'wb', compresslevel=level or 9) as fout:
+            shutil.copyfileobj(fin, fout, 1 << 20)
+        shutil.copystat(filename, tmp)
+        os.replace(tmp, filename + '.gz')
+        os.remove(filename)
+
+    if pigz:
+        for filename in filenames:
+            compress(filename)
+    else:
+        # zlib releases the GIL, so threads compress in parallel.
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(compress, filenames))
+
+
+def file_system_time(folder):
+    """
+    :param folder: existing folder.
+    :return: current time of the file system holding folder, by which the
+    modification times of its files are set.  Differs from time.time() on
+    network file systems whose server clock is skewed.
+    """
+    with tempfile.NamedTemporaryFile(prefix='.clock-', dir=folder) as fd:
+        return os.fstat(fd.fileno()).st_mtime
+
+
+def find_uncompressed(folders, since=None):
+    """
+    :param folders: folders searched recursively.
+    :param since: only files modified at or after this time, see
+    file_system_time.
+    :return: list of uncompressed nifti-1 images (.nii) in folders.
+    Symbolic links and nifti-2 images, i.e. cifti, which are read
+    uncompressed, are left out.
+    """
+    found = []
+    for folder in folders:
+        for root, _, files in os.walk(folder):
+            for name in files:
+                if not name.endswith('.nii'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(st.st_mode) or \
+                        (since is not None and st.st_mtime < since):
+                    continue
+                if _nifti_version(path) == 1:
+                    found.append(path)
+    return found
+
+
+def recompress_images(expected, folders=(), since=None, workers=1,
+                      level=None):
+    """
+    gzips the nifti images written uncompressed by commands run with an
+    FSLOUTPUTTYPE of NIFTI: the .nii counterparts of expected .nii.gz
+    images, and the images in folders modified since a time.  Images
+    expected as .nii stay uncompressed.
+    :param expected: expected outputs of the commands.
+    :param folders: folders searched for uncompressed images.
+    :param since: time the commands started, see file_system_time.  Folders
+    are not searched without it.
+    :param workers: number of compression threads.
+    :param level: gzip level, see gzip_files.
+    :return: list of compressed images, without their new ".gz" suffix.
+    """
+    uncompressed = {p[:-len('.gz')] for p in expected
+                    if p.endswith('.nii.gz') and not os.path.exists(p)}
+    uncompressed = {p for p in uncompressed if os.path.isfile(p)}
+    if since is not None:
+        uncompressed.update(find_uncompressed(folders, since))
+    uncompressed = sorted(uncompressed - set(expected))
+    gzip_files(uncompressed, workers=workers, level=level)
+    return uncompressed
+
+
+def _nifti_version(path):
+    # 1 or 2 by the header size, which is written in the image's byte order
+    try:
+        with open(path, 'rb') as fd:
+            head = fd.read(4)
+    except OSError:
+        return None
+    if len(head) < 4:
+        return None
+    for endian in '<>':
+        sizeof_hdr = struct.unpack(endian + 'i', head)[0]
+        if sizeof_hdr == 348:
+            return 1
+        if sizeof_hdr == 540:
+            return 2
+    return None
+
+
+def scan_paths(paths, workers=8):
+    """
+    looks up many paths with one os.scandir per directory, with directories
+    scanned concurrently.
+    :param paths: list of paths.
+    :param workers: number of concurrent directory scans.
+    :return: dictionary of path: os.DirEntry, or None where it does not
+    exist.  Broken symbolic links do not exist.
+    """
+    by_dir = defaultdict(list)
+    for path in paths:
+        by_dir[os.path.dirname(path)].append(path)
+
+    def scan(item):
+        dirname, members = item
+        try:
+            with os.scandir(dirname or '.') as it:
+                listing = {e.name: e for e in it}
+        except (FileNotFoundError, NotADirectoryError):
+            listing = {}
+        found = {}
+        for path in members:
+            entry = listing.get(os.path.basename(path))
+            if entry is not None and entry.is_symlink() and \
+                    not os.path.exists(path):
+                entry = None
+            found[path] = entry
+        return found
+
+    entries = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for found in pool.map(scan, by_dir.items()):
+            entries.update(found)
+    return entries
+
+
+def verify_files(paths, integrity=False, min_size=1, workers=8):
+    """
+    checks that paths exist and, optionally, that files are not smaller
+    than min_size and that nifti, cifti and gifti files have a valid header
+    and are not truncated.
+    :param paths: list of paths.
+    :param integrity: check sizes and headers, besides existence.
+    :param min_size: minimum size in bytes of a file for integrity checks.
+    :param workers: number of concurrent directory scans and file checks.
+    :return: report dictionary of the number of paths checked, and lists of
+    missing paths, paths under min_size and [path, reason] of invalid files.
+    """
+    entries = scan_paths(paths, workers=workers)
+    report = {
+        'checked': len(paths),
+        'missing': [p for p in paths if entries[p] is None],
+        'empty': [],
+        'invalid': []
+    }
+    if not integrity:
+        return report
+
+    def check(path):
+        entry = entries[path]
+        if entry.is_dir():
+            return path, None, None
+        size = entry.stat().st_size
+        if size < min_size:
+            return path, size, None
+        return path, size, _check_image(path, size)
+
+    existing = [p for p in paths if entries[p] is not None]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, size, reason in pool.map(check, existing):
+            if size is not None and size < min_size:
+                report['empty'].append(path)
+            elif reason:
+                report['invalid'].append([path, reason])
+    return report
+
+
+def _check_image(path, size):
+    """
+    :return: reason a nifti/cifti, mgz or gifti file is invalid, else None.
+    """
+    try:
+        if path.endswith(('.nii', '.nii.gz')):
+            return _check_nifti(path, size)
+        elif path.endswith('.mgz'):
+            with open(path, 'rb') as fd:
+                if fd.read(2) != b'\x1f\x8b':
+                    return 'not gzip compressed'
+        elif path.endswith('.gii'):
+            with open(path, 'rb') as fd:
+                head = fd.read(4096)
+                fd.seek(max(0, size - 256))
+                tail = fd.read()
+            if b'<GIFTI' not in head:
+                return 'no GIFTI element'
+            if b'</GIFTI>' not in tail:
+                return 'truncated'
+    except (OSError, EOFError) as e:
+        return 'unreadable: %s' % e
+    return None
+
+
+def nifti_header(path):
+    """
+    reads the dimensions of a nifti-1 or nifti-2 (cifti) image, only
+    decompressing the header of gzipped images.
+    :param path: .nii or .nii.gz file.
+    :return: tuple of dim, bitpix and vox_offset, or None if the header is
+    not valid.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as fd:
+        hdr = fd.read(540)
+    if len(hdr) < 348:
+        return None
+    for endian in '<>':
+        sizeof_hdr = struct.unpack(endian + 'i', hdr[:4])[0]
+        if sizeof_hdr == 348 and hdr[344:347] == b'n+1':
+            dim = struct.unpack(endian + '8h', hdr[40:56])
+            bitpix = struct.unpack(endian + 'h', hdr[72:74])[0]
+            vox_offset = int(struct.unpack(endian + 'f', hdr[108:112])[0])
+            return dim, bitpix, vox_offset
+        if sizeof_hdr == 540 and len(hdr) == 540 and hdr[4:7] == b'n+2':
+            dim = struct.unpack(endian + '8q', hdr[16:80])
+            bitpix = struct.unpack(endian + 'h', hdr[14:16])[0]
+            vox_offset = struct.unpack(endian + 'q', hdr[168:176])[0]
+            return dim, bitpix, vox_offset
+    return None
+
+
+def _check_nifti(path, size):
+    # nifti-1 and nifti-2 (cifti) headers, data size against file size or,
+    # for gzip, against the uncompressed size in the gzip trailer.
+    header = nifti_header(path)
+    if header is None:
+        return 'invalid nifti header'
+    dim, bitpix, vox_offset = header
+    if not 0 < dim[0] < 8:
+        return 'invalid nifti dimensions'
+    nvox = 1
+    for d in dim[1:dim[0] + 1]:
+        nvox *= d
+    expected = vox_offset + nvox * bitpix // 8
+    if path.endswith('.gz'):
+        with open(path, 'rb') as fd:
+            fd.seek(-4, os.SEEK_END)
+            isize = struct.unpack('<I', fd.read(4))[0]
+        if isize != expected % 2 ** 32:
+            return 'truncated'
+    elif size < expected:
+        return 'truncated'
+    return None
+
+
+def compress_file(filename):
+    """
+    compresses a file in place with zstd when it is installed, else gzip.
+    :param filename: file to compress.
+    :return: name of the compressed file.
+    """
+    zstd = shutil.which('zstd')
+    if zstd:
+        subprocess.check_call([zstd, '-q', '-f', '--rm', filename])
+        return filename + '.zst'
+    gzip_files([filename])
+    return filename + '.gz'
+
+
+def _is_current(src, dst):
+    # size and modification time match, as copystat preserves the latter.
+    try:
+        s, d = os.stat(src), os.stat(dst)
+    except FileNotFoundError:
+        return False
+    return s.st_size == d.st_size and s.st_mtime_ns == d.st_mtime_ns
+
+
+def _same_size(src, dst):
+    try:
+        return os.stat(src).st_size == os.stat(dst).st_size
+    except FileNotFoundError:
+        return False
+
+
+def sync_tree(src_root, dst_root, keep=None, verify=False, workers=4,
+              checksums=None):
+    """
+    one way sync of a directory tree, copying only new or modified files.
+    Symbolic links are recreated, with absolute links into src_root
+    redirected into dst_root.
+    :param src_root: source directory.
+    :param dst_root: destination directory, created if needed.
+    :param keep: optional list of glob patterns, relative to src_root, of
+    files to sync.  Default is every file.
+    :param verify: checksum each copied file, and tell modified files by
+    their checksum instead of their modification time.
+    :param workers: number of concurrent file copies.
+    :param checksums: optional dictionary of relative path: checksum of the
+    file as last synced, used with verify instead of reading the destination
+    file again, and updated with every file synced.
+    :return: number of files copied.
+    """
+    if not os.path.isdir(src_root):
+        return 0
+    if checksums is None:
+        checksums = {}
+    copies = []
+    for dirpath, dirnames, filenames in os.walk(src_root):
+        rel_dir = os.path.relpath(dirpath, src_root)
+        for name in filenames + [d for d in dirnames if os.path.islink(
+                os.path.join(dirpath, d))]:
+            rel = os.path.normpath(os.path.join(rel_dir, name))
+            if keep and not any(fnmatch.fnmatch(rel, k) for k in keep):
+                continue
+            src = os.path.join(src_root, rel)
+            dst = os.path.join(dst_root, rel)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if os.path.islink(src):
+                _sync_link(src, dst, src_root, dst_root)
+            elif verify or not _is_current(src, dst):
+                copies.append((rel, src, dst))
+
+    def copy(rel, src, dst):
+        if not verify:
+            shutil.copy2(src, dst)
+            return True
+        if _same_size(src, dst):
+            checksum = file_checksum(src)
+            if checksum == (checksums.get(rel) or file_checksum(dst)):
+                checksums[rel] = checksum
+                return False
+        checksums[rel] = copy_verified(src, dst)
+        return True
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # consume results so that copy errors are raised here
+        return sum(pool.map(lambda x: copy(*x), copies))
+
+
+def _sync_link(src, dst, src_root, dst_root):
+    target = os.readlink(src)
+    if os.path.isabs(target) and os.path.commonpath(
+            [target, src_root]) == src_root:
+        target = os.path.join(dst_root, os.path.relpath(target, src_root))
+    if os.path.lexists(dst):
+        if os.path.islink(dst) and os.readlink(dst) == target:
+            return
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        else:
+            os.remove(dst)
+    os.symlink(target, dst)
+
+
+def link_tree(src_root, dst_root, exclude=(), read_only=False):
+    """
+    mirrors a directory tree with real directories and symbolic links to
+    each file, so that files added under dst_root stay out of src_root.
+    :param src_root: source directory.
+    :param dst_root: destination directory, created if needed.
+    :param exclude: names of directories which are not mirrored.
+    :param read_only: remove the write permission of the linked files, so
+    that writing through a link fails instead of modifying src_root.
+    :return: number of files linked.
+    """
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(src_root):
+        dirnames[:] = [d for d in dirnames if d not in exclude]
+        rel_dir = os.path.relpath(dirpath, src_root)
+        dst_dir = os.path.normpath(os.path.join(dst_root, rel_dir))
+        os.makedirs(dst_dir, exist_ok=True)
+        for name in filenames + [d for d in dirnames if os.path.islink(
+                os.path.join(dirpath, d))]:
+            src = os.path.join(dirpath, name)
+            dst = os.path.join(dst_dir, name)
+            if read_only:
+                _set_writable(src, False)
+            if os.path.islink(dst) and os.readlink(dst) == src:
+                continue
+            tmp = '%s.link-%s' % (dst, os.getpid())
+            os.symlink(src, tmp)
+            os.replace(tmp, dst)
+            count += 1
+    return count
+
+
+def restore_writable(root, exclude=()):
+    """
+    gives the owner write permission to every file of a directory tree
+    again, see link_tree.
+    :param root: directory.
+    :param exclude: names of directories which are left as they are.
+    :return: None
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d not in exclude]
+        for name in filenames:
+            _set_writable(os.path.join(dirpath, name), True)
+
+
+def _set_writable(path, writable):
+    # regular files only, links are left to their targets
+    st = os.lstat(path)
+    if not stat.S_ISREG(st.st_mode):
+        return
+    if writable:
+        mode = st.st_mode | stat.S_IWUSR
+    else:
+        mode = st.st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+    if mode != st.st_mode:
+        os.chmod(path, stat.S_IMODE(mode))
+
+
+def write_script(filename, contents):
+    """
+    writes an executable script.
+    :param filename: path of the script.
+    :param contents: text of the script.
+    :return: None
+    """
+    with open(filename, 'w') as fd:
+        fd.write(contents)
+    os.chmod(filename, 0o755)
+
+
+def shadow_scripts(scripts_dir, shadow_dir, replace):
+    """
+    mirrors a folder of pipeline scripts, so that an environment variable
+    naming the folder can point to the mirror instead.  Every file is linked
+    to the original, except the scripts replaced by new contents.
+    :param scripts_dir: folder of the original scripts.
+    :param shadow_dir: mirror folder, cleared first.
+    :param replace: dictionary of script name: contents of its replacement.
+    :return: shadow_dir
+    """
+    shutil.rmtree(shadow_dir, ignore_errors=True)
+    os.makedirs(shadow_dir)
+    for name in os.listdir(scripts_dir):
+        filename = os.path.join(shadow_dir, name)
+        if name in replace:
+            write_script(filename, replace[name])
+        else:
+            os.symlink(os.path.join(scripts_dir, name), filename)
+    return shadow_dir
+
+
+class Reaper(object):
+    """
+    Moves directories aside with a rename and deletes them in a background
+    thread, so that a stage can be rerun without waiting on deletes.  The
+    interpreter waits for scheduled deletions before exiting, and trash left
+    by an interrupted process is deleted on next use.
+    """
+
+    def __init__(self, workers=4):
+        """
+        :param workers: number of subdirectories deleted concurrently.
+        """
+        self.workers = workers
+        self.queue = queue.Queue()
+        self.known = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def trash(self, paths, trash_root):
+        """
+        renames paths into trash_root and schedules their deletion.
+        trash_root must be on the same file system as the paths.
+        :param paths: list of files or directories, missing ones are skipped.
+        :param trash_root: directory for trash.
+        :return: list of trashed paths
+        """
+        os.makedirs(trash_root, exist_ok=True)
+        with self.lock:
+            batch = tempfile.mkdtemp(prefix='trash-', dir=trash_root)
+            # batches of concurrent calls are known, and still being filled
+            self.known.add(batch)
+        # reap what an earlier, interrupted process left behind
+        for name in os.listdir(trash_root):
+            self._schedule(os.path.join(trash_root, name))
+        trashed = []
+        for i, path in enumerate(paths):
+            if os.path.lexists(path):
+                print('moving %s to trash' % path)
+                os.rename(path, os.path.join(batch, '%s-%s' % (
+                    i, os.path.basename(path))))
+                trashed.append(path)
+        with self.lock:
+            self._put(batch)
+        return trashed
+
+    def join(self):
+        """
+        blocks until all scheduled deletions have finished.
+        :return: None
+        """
+        self.queue.join()
+
+    def _schedule(self, path):
+        with self.lock:
+            if path in self.known:
+                return
+            self.known.add(path)
+            self._put(path)
+
+    def _put(self, path):
+        # queues a deletion, called with the lock held
+        self.queue.put(path)
+        if self.thread is None:
+            # not a daemon, so that exit waits for pending deletions
+            self.thread = threading.Thread(target=self._reap)
+            self.thread.start()
+
+    def _reap(self):
+        while True:
+            with self.lock:
+                if self.queue.empty():
+                    self.thread = None
+                    return
+                path = self.queue.get()
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    # delete second level subdirectories concurrently
+                    subdirs = []
+                    for top in os.scandir(path):
+                        if top.is_dir(follow_symlinks=False):
+                            subdirs += [e.path for e in os.scandir(top.path)
+                                        if e.is_dir(follow_symlinks=False)]
+                    _rmtrees(subdirs, self.workers)
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.lexists(path):
+                    os.remove(path)
+            except OSError as e:
+                print('WARNING: could not delete trash %s: %s' % (path, e))
+            finally:
+                self.queue.task_done()
+
+
+def _rmtrees(paths, workers):
+    # plain threads, as executors refuse work once the interpreter exits.
+    pending = queue.Queue()
+    for path in paths:
+        pending.put(path)
+
+    def work():
+        while True:
+            try:
+                path = pending.get_nowait()
+            except queue.Empty:
+                return
+            shutil.rmtree(path, ignore_errors=True)
+
+    threads = [threading.Thread(target=work)
+               for _ in range(min(workers, len(paths)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+reaper = Reaper()
+
+
+class ScratchSpace(object):
+    """
+    Node-local working copy of a session.  Inputs and any existing outputs
+    are staged to scratch, stages write there, and files matching the keep
+    policy are synced back to the session output directory in bulk.
+    """
+
+    def __init__(self, scratch_dir, output_dir, keep=None, workers=4):
+        """
+        :param scratch_dir: node-local directory for this session.
+        :param output_dir: session output directory on shared storage.
+        :param keep: list of glob patterns, relative to the "files" folder,
+        of outputs to sync back.  Default is every file.
+        :param workers: number of concurrent file copies.
+        """
+        self.root = scratch_dir
+        self.path = os.path.join(scratch_dir, 'files')
+        self.inputs = os.path.join(scratch_dir, 'inputs')
+        self.output_path = os.path.join(output_dir, 'files')
+        self.keep = keep
+        self.workers = workers
+        # checksums of the synced outputs, see sync_tree
+        self.checksums = {}
+
+    def stage_inputs(self, bids_data, bids_dir):
+        """
+        copies the session's input niftis into scratch, keeping their path
+        relative to the bids root so that IntendedFor fields still match.
+        :param bids_data: spec yielded from read_bids_dataset.
+        :param bids_dir: bids dataset root.
+        :return: copy of bids_data pointing at the staged inputs.
+        """
+        copies = []
+
+        def relocate(value):
+            if isinstance(value, dict):
+                return {k: relocate(v) for k, v in value.items()}
+            if isinstance(value, list):
+                return [relocate(v) for v in value]
+            rel = os.path.relpath(value, bids_dir)
+            dst = os.path.join(self.inputs, rel)
+            copies.append((value, dst))
+            return dst
+
+        staged = dict(bids_data)
+        for key in ('t1w', 't2w', 'func', 'fmap'):
+            if staged.get(key):
+                staged[key] = relocate(staged[key])
+        for src, dst in copies:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(lambda x: None if _is_current(*x) else
+                          shutil.copy2(*x), copies))
+        return staged
+
+    def stage_outputs(self):
+        """
+        copies outputs of earlier runs into scratch, e.g. to resume a
+        session from a later stage.
+        :return: number of files copied.
+        """
+        return sync_tree(self.output_path, self.path, verify=True,
+                         workers=self.workers, checksums=self.checksums)
+
+    def sync_back(self):
+        """
+        checksum verified copy of new or modified outputs matching the keep
+        policy back to the session output directory.
+        :return: number of files copied.
+        """
+        print('syncing %s to %s' % (self.path, self.output_path))
+        return sync_tree(self.path, self.output_path, keep=self.keep,
+                         verify=True, workers=self.workers,
+                         checksums=self.checksums)
+
+    def cleanup(self):
+        """
+        removes the scratch copy of the session.
+        :return: None
+        """
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class InputCache(object):
+    """
+    Uncompressed copies of gzipped input images, which tools can read and
+    memory map without decompressing them again.  Copies are keyed by source
+    path and modification time, so that each version of a source is
+    decompressed once, and may be shared by concurrent sessions.  Each copy
+    has a lock file, shared by the sessions reading it until they release
+    the cache.  The least recently used copies which no session holds are
+    evicted once the cache exceeds its size.
+    """
+
+    def __init__(self, cache_dir, max_gb=50, workers=4):
+        """
+        :param cache_dir: cache directory, created if needed.
+        :param max_gb: size of the cache (GB).
+        :param workers: number of concurrent decompressions.
+        """
+        self.root = cache_dir
+        self.max_bytes = max_gb * 1024 ** 3
+        self.workers = workers
+        # shared locks of the copies in use, see release
+        self.held = []
+        os.makedirs(self.root, exist_ok=True)
+
+    def __getstate__(self):
+        # locks stay with the process holding them
+        return dict(self.__dict__, held=[])
+
+    def _entry(self, path):
+        st = os.stat(path)
+        key = hashlib.sha1(('%s\0%s\0%s' % (
+            os.path.realpath(path), st.st_mtime_ns, st.st_size)).encode())
+        return os.path.join(self.root, '%s_%s' % (
+            key.hexdigest()[:16], os.path.basename(path)[:-len('.gz')]))
+
+    def get(self, path):
+        """
+        decompresses an input unless it is cached, and holds its copy until
+        release.
+        :param path: input image.
+        :return: path to an uncompressed copy of a gzipped image, else path.
+        """
+        if not path.endswith('.nii.gz'):
+            return path
+        entry = self._entry(path)
+        while True:
+            lock = open(entry + '.lock', 'a')
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if _same_file(lock, entry + '.lock'):
+                break
+            # evicted while waiting, the lock file is a new one
+            lock.close()
+        try:
+            if os.path.exists(entry):
+                # marks the copy as recently used
+                os.utime(entry)
+            else:
+                tmp = '%s.tmp-%s' % (entry, os.getpid())
+                with open(tmp, 'wb') as fout:
+                    if shutil.which('pigz'):
+                        subprocess.check_call(['pigz', '-dc', path],
+                                              stdout=fout)
+                    else:
+                        with gzip.open(path, 'rb') as fin:
+                            shutil.copyfileobj(fin, fout, 1 << 20)
+                os.replace(tmp, entry)
+            fcntl.flock(lock, fcntl.LOCK_SH)
+        except BaseException:
+            lock.close()
+            raise
+        self.held.append(lock)
+        return entry
+
+    def get_all(self, paths):
+        """
+        decompresses inputs concurrently, then evicts old copies.
+        :param paths: input images.
+        :return: dict of input path to path of its copy.
+        """
+        paths = sorted(set(paths))
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            cached = dict(zip(paths, pool.map(self.get, paths)))
+        self.evict()
+        return cached
+
+    def release(self):
+        """
+        lets the copies returned by get be evicted.
+        :return: None
+        """
+        while self.held:
+            self.held.pop().close()
+
+    def evict(self):
+        """
+        removes least recently used copies which are not in use until the
+        cache fits its size, and lock files left without a copy.
+        :return: list of removed copies.
+        """
+        entries = []
+        locks = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith('.nii'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                elif entry.name.endswith('.nii.lock'):
+                    locks.append(entry.path)
+        copies = {path for _, _, path in entries}
+        for lock_path in locks:
+            if lock_path[:-len('.lock')] not in copies:
+                # an interrupted decompression, unless one is running
+                self._remove(lock_path[:-len('.lock')], None)
+        total = sum(x[1] for x in entries)
+        removed = []
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if self._remove(path, mtime):
+                total -= size
+                removed.append(path)
+        if total > self.max_bytes:
+            print('WARNING: input cache %s exceeds its size, the remaining '
+                  'copies are in use' % self.root)
+        return removed
+
+    def _remove(self, path, mtime):
+        """
+        :param path: copy, which may not exist.
+        :param mtime: modification time of the copy when the cache was
+        scanned, or None if it did not exist.
+        :return: True if the copy and its lock file were removed, False if
+        a session holds it or used it since the scan.
+        """
+        lock_path = path + '.lock'
+        with open(lock_path, 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            if not _same_file(lock, lock_path):
+                return False
+            try:
+                if mtime is None:
+                    if os.path.exists(path):
+                        return False
+                elif os.path.getmtime(path) != mtime:
+                    return False
+                else:
+                    os.remove(path)
+                os.remove(lock_path)
+            except FileNotFoundError:
+                return False
+        return True
+
+
+def _same_file(fd, path):
+    # fd is still open on path, which was not removed and created again
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    fst = os.fstat(fd.fileno())
+    return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+
+class DiskBudget(object):
+    """
+    Holds back new sessions while the file system holding the outputs is
+    too full to fit another one within the budget.  Space this process has
+    already used is left out of the wait: only other users of the file
+    system can free space, so waiting on the pipeline's own outputs would
+    never end.
+    """
+    # seconds between checks while paused
+    interval = 60
+
+    def __init__(self, path, max_gb):
+        """
+        :param path: any path on the file system to budget, e.g. output_dir.
+        :param max_gb: maximum used space (GB).
+        """
+        self.path = path
+        self.max_bytes = max_gb * 1024 ** 3
+        # growth of the used space while sessions of this process ran
+        self.own_bytes = 0
+
+    def usage(self):
+        """
+        :return: used bytes of the file system holding path.
+        """
+        return shutil.disk_usage(self.path).used
+
+    @contextlib.contextmanager
+    def track(self):
+        """
+        counts the growth of the used space while a session runs as space
+        used by this process.
+        """
+        before = self.usage()
+        try:
+            yield
+        finally:
+            self.own_bytes += max(0, self.usage() - before)
+
+    def wait(self, need_gb):
+        """
+        blocks until the projected need of a session fits in the budget
+        next to the space used by others.
+        :param need_gb: projected footprint of the session, see CostModel.
+        :return: False if the session can never fit, since the space used
+        by this process and its need alone exceed the budget, else True.
+        """
+        need = need_gb * 1024 ** 3
+        if self.own_bytes + need > self.max_bytes:
+            print('ERROR: %.1f GB used by this run and %.1f GB needed '
+                  'exceed the budget of %.1f GB' % (
+                      self.own_bytes / 1024 ** 3, need_gb,
+                      self.max_bytes / 1024 ** 3))
+            return False
+        paused = False
+        while self.usage() - self.own_bytes + need > self.max_bytes:
+            if not paused:
+                print('pausing: %.1f GB used by others, %.1f GB needed, '
+                      'budget is %.1f GB' % (
+                          (self.usage() - self.own_bytes) / 1024 ** 3,
+                          need_gb, self.max_bytes / 1024 ** 3))
+                paused = True
+            time.sleep(self.interval)
+        if paused:
+            print('resuming: disk usage is within budget')
+        return True
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+__doc__ = \
+"""Runs FSL topup through a cache shared by the BOLD runs of a session.  Runs
+which use the same spin echo pair, readout parameters and configuration give
+topup identical inputs, so the field is estimated once, by whichever run gets
+there first, and its outputs are copied to every other run.  Concurrent runs
+wait for an estimation in progress instead of repeating it.
+"""
+
+import argparse
+import fcntl
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+
+import cli
+
+# topup options naming outputs, any other option is part of the cache key
+OUTPUT_OPTIONS = ('--out', '--iout', '--fout', '--dfout', '--rbmout',
+                  '--jacout', '--logout')
+# topup options naming input files, which are keyed by content
+INPUT_OPTIONS = ('--imain', '--datain', '--config')
+
+
+def _cli(argv=None):
+    """
+    command line interface
+    :param argv: optional list of arguments, default is sys.argv.
+    :return:
+    """
+    return cli.run(generate_parser, run_topup, argv)
+
+
+def generate_parser(parser=None):
+    """
+    Generates the command line parser for this program.
+    :param parser: optional subparser for wrapping this program as a submodule.
+    :return: ArgumentParser for this script/module
+    """
+    parser = cli.make_parser(__doc__, parser)
+    parser.add_argument(
+        '--cache', required=True,
+        help='Directory holding estimated fields.'
+    )
+    parser.add_argument(
+        'command', nargs=argparse.REMAINDER,
+        help='topup command and arguments, options given as --name=value.'
+    )
+
+    return parser
+
+
+def cache_key(command):
+    """
+    :param command: list of topup command and arguments.
+    :return: identifier of the estimation, from the contents of the input
+    files and all other options.
+    """
+    digest = hashlib.sha256()
+    for arg in command[1:]:
+        option, _, value = arg.partition('=')
+        if option in OUTPUT_OPTIONS:
+            continue
+        digest.update(option.encode() + b'\0')
+        filename = _find_input(value) if option in INPUT_OPTIONS else None
+        if filename:
+            with open(filename, 'rb') as fd:
+                for block in iter(lambda: fd.read(1 << 20), b''):
+                    digest.update(block)
+        else:
+            digest.update(value.encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _find_input(value):
+    # topup accepts images without their extension
+    for filename in (value, value + '.nii.gz', value + '.nii'):
+        if os.path.isfile(filename):
+            return filename
+    return None
+
+
+def run_topup(cache, command):
+    """
+    copies the outputs of an earlier identical estimation, else runs topup
+    with its outputs written to the cache, then copies them.
+    :param cache: cache directory.
+    :param command: list of topup command and arguments.
+    :return: exit status of topup, 0 if it was cached.
+    """
+    if command and command[0] == '--':
+        command = command[1:]
+    outputs = {}
+    for arg in command[1:]:
+        option, _, value = arg.partition('=')
+        if option in OUTPUT_OPTIONS:
+            outputs[option] = value
+
+    os.makedirs(cache, exist_ok=True)
+    key = cache_key(command)
+    entry = os.path.join(cache, key)
+    with open(entry + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.isdir(entry):
+            print('topup: using field estimated for an identical run: %s' %
+                  entry)
+            sys.stdout.flush()
+        else:
+            partial = entry + '.partial'
+            shutil.rmtree(partial, ignore_errors=True)
+            cached = [command[0]]
+            for arg in command[1:]:
+                option, _, value = arg.partition('=')
+                if option in outputs:
+                    folder = os.path.join(partial, option.lstrip('-'))
+                    os.makedirs(folder, exist_ok=True)
+                    arg = '%s=%s' % (option, os.path.join(
+                        folder, os.path.basename(value)))
+                cached.append(arg)
+            result = subprocess.call(cached)
+            if result != 0:
+                shutil.rmtree(partial, ignore_errors=True)
+                return result
+            os.rename(partial, entry)
+        for option, value in outputs.items():
+            folder = os.path.join(entry, option.lstrip('-'))
+            for name in os.listdir(folder):
+                shutil.copy2(os.path.join(folder, name),
+                             os.path.join(os.path.dirname(value), name))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_cli())
@@ -0,0 +1,58 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'app'))
+
+
+def _metadata(**kwargs):
+    metadata = {'Manufacturer': 'Siemens', 'PixelBandwidth': 240,
+                'AcquisitionMatrixPE': 256,
+                'ImageOrientationPatientDICOM': [1, 0, 0, 0, 1, 0],
+                'InPlanePhaseEncodingDirectionDICOM': 'COL'}
+    metadata.update(kwargs)
+    return metadata
+
+
+@pytest.fixture
+def bids_data(tmp_path):
+    """
+    bids data struct of a session with a T1w, a T2w, a spin echo pair and
+    three BOLD runs, whose input files do not exist.
+    """
+    session = tmp_path / 'bids' / 'sub-01' / 'ses-01'
+    func = [str(session / 'func' / ('sub-01_ses-01_task-%s_bold.nii.gz' % x))
+            for x in ('rest_run-01', 'rest_run-02', 'nback_run-01')]
+    sefm = {direction: [str(session / 'fmap' / (
+        'sub-01_ses-01_dir-%s_epi.nii.gz' % name))]
+            for direction, name in (('positive', 'AP'), ('negative', 'PA'))}
+    intended = [os.path.relpath(x, str(session.parent)) for x in func]
+    return {
+        'subject': 'sub-01', 'session': 'ses-01',
+        'types': ['T1w', 'T2w', 'bold', 'epi'],
+        't1w': [str(session / 'anat' / 'sub-01_ses-01_T1w.nii.gz')],
+        't1w_metadata': _metadata(),
+        't2w': [str(session / 'anat' / 'sub-01_ses-01_T2w.nii.gz')],
+        't2w_metadata': _metadata(),
+        'func': func,
+        'func_metadata': [_metadata(PhaseEncodingDirection='j-',
+                                    RepetitionTime=0.8) for _ in func],
+        'fmap': sefm,
+        'fmap_metadata': {
+            direction: [{'EffectiveEchoSpacing': 0.00051,
+                         'PhaseEncodingDirection': pe_dir,
+                         'IntendedFor': intended}]
+            for direction, pe_dir in (('positive', 'j-'),
+                                      ('negative', 'j'))},
+    }
+
+
+@pytest.fixture
+def session_spec(bids_data, tmp_path, monkeypatch):
+    for name in ('HCPPIPEDIR_Config', 'HCPPIPEDIR_Templates',
+                 'DCANBOLDPROCVER'):
+        monkeypatch.setenv(name, name)
+    from pipelines import ParameterSettings
+    return ParameterSettings(bids_data, str(tmp_path / 'out'))
@@ -0,0 +1,17 @@
+from affinity import parse_cpulist, partition
+
+
+def test_parse_cpulist():
+    assert parse_cpulist('0-3,8-9,12\n') == [0, 1, 2, 3, 8, 9, 12]
+    assert parse_cpulist('5') == [5]
+    assert parse_cpulist('\n') == []
+
+
+def test_partition_near_equal_contiguous_sets():
+    assert partition(list(range(10)), 3) == [[0, 1, 2, 3], [4, 5, 6],
+                                             [7, 8, 9]]
+    assert partition([0, 1, 2, 3], 1) == [[0, 1, 2, 3]]
+
+
+def test_partition_shares_cpus_round_robin():
+    assert partition([4, 5], 5) == [[4], [5], [4], [5], [4]]
@@ -0,0 +1,40 @@
+from clean import _translate, compile_patterns
+
+
+def test_compile_patterns_matches_any_pattern():
+    regex = compile_patterns(['MNINonLinear/*.nii.gz', 'T1w/xfms/'])
+    assert regex.match('MNINonLinear/T1w.nii.gz')
+    assert regex.match('T1w/xfms')
+    assert not regex.match('MNINonLinear/Results/rest/rest.nii.gz')
+    assert not regex.match('T1w/xfms/acpc.mat')
+
+
+def test_compile_patterns_without_patterns_matches_nothing():
+    regex = compile_patterns([])
+    assert not regex.match('')
+    assert not regex.match('T1w')
+
+
+def test_translate_wildcards_stay_within_a_component():
+    regex = compile_patterns(['T1w/*/brain?.nii'])
+    assert regex.match('T1w/xfms/brain1.nii')
+    assert not regex.match('T1w/xfms/sub/brain1.nii')
+    assert not regex.match('T1w/xfms/brain10.nii')
+
+
+def test_translate_leading_wildcard_skips_hidden_names():
+    regex = compile_patterns(['*'])
+    assert regex.match('T1w')
+    assert not regex.match('.anat_shared')
+
+
+def test_translate_character_classes():
+    regex = compile_patterns(['run-[12].txt', 'run-[!12].log'])
+    assert regex.match('run-1.txt')
+    assert not regex.match('run-3.txt')
+    assert regex.match('run-3.log')
+    assert not regex.match('run-1.log')
+
+
+def test_translate_escapes_literals_and_strips_prefix():
+    assert _translate('./a+b.(1)') == r'a\+b\.\(1\)\Z'
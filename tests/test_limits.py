@@ -0,0 +1,24 @@
+import pytest
+
+from limits import CommandLimits, parse_limits
+
+
+def test_parse_limits():
+    assert parse_limits('memory_gb:8, nice:10,private_tmp') == {
+        'memory_gb': 8.0, 'nice': 10, 'private_tmp': True}
+    assert parse_limits('private_tmp:no') == {'private_tmp': False}
+
+
+@pytest.mark.parametrize('text', ['memory:8', 'memory_gb:eight', 'nice:',
+                                  ''])
+def test_parse_limits_rejects(text):
+    with pytest.raises(ValueError):
+        parse_limits(text)
+
+
+def test_wrap_applies_limits_in_a_shell():
+    limits = CommandLimits(memory_gb=1, nice=5)
+    args = limits.wrap(['echo', 'a b'])
+    assert args[:2] == ['sh', '-c']
+    assert args[2] == 'ulimit -v 1048576 && exec nice -n 5 "$@"'
+    assert args[3:] == ['sh', 'echo', 'a b']
@@ -0,0 +1,23 @@
+import numpy as np
+
+from motion import count_usable_frames, framewise_displacement
+
+
+def test_framewise_displacement(tmp_path):
+    regressors = tmp_path / 'Movement_Regressors.txt'
+    # translations in mm, rotations in degrees, then derivatives
+    np.savetxt(str(regressors), [[0, 0, 0, 0, 0, 0] + [9] * 6,
+                                 [1, -1, 0, 0, 0, 0] + [9] * 6,
+                                 [1, -1, 0, 0, 0, 180 / np.pi] + [9] * 6])
+    fd = framewise_displacement(str(regressors), brain_radius=50.)
+    np.testing.assert_allclose(fd, [0, 2, 50])
+
+
+def test_count_usable_frames():
+    fd = np.array([0, .1, .1, .1, .9, .1, .1, .1, .1, .1, .1, .9, .1])
+    assert count_usable_frames(fd, .3, contiguous_frames=3) == 10
+    # the sequences before and after the high motion frames are too short
+    assert count_usable_frames(fd, .3, contiguous_frames=6) == 6
+    assert count_usable_frames(fd, .3, skip_frames=2,
+                               contiguous_frames=3) == 6
+    assert count_usable_frames(fd, 1., contiguous_frames=20) == 0
@@ -0,0 +1,161 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from pipelines import (CommandGraph, DCANBOLDProcessing, FMRISurface,
+                       FMRIVolume, PreFreeSurfer, Stage, _format_paths)
+from extra_pipelines import ABCDTask
+
+RUNS = ['ses-01_task-rest_run-01', 'ses-01_task-rest_run-02',
+        'ses-01_task-nback_run-01']
+
+
+@pytest.fixture
+def hcp_env(monkeypatch):
+    for name in ('HCPPIPEDIR', 'ABCDTASKPREPDIR', 'DCANBOLDPROCDIR'):
+        monkeypatch.setenv(name, '/opt/' + name)
+    for name in ('HCPPIPEDIR_Global', 'HCPPIPEDIR_tfMRIAnalysis'):
+        monkeypatch.delenv(name, raising=False)
+
+
+def test_get_runs(session_spec):
+    runs = session_spec.get_runs()
+    assert [run.fmriname for run in runs] == RUNS
+    assert [run.task for run in runs] == ['task-rest', 'task-rest',
+                                          'task-nback']
+    assert all(run.pe_dir == 'y-' and run.tr == 0.8 for run in runs)
+    assert all(run.sefmaps == (0, 0) for run in runs)
+    # the inputs do not exist
+    assert all(run.frames is None for run in runs)
+    assert session_spec.get_runs() is runs
+
+
+def test_format_paths(session_spec):
+    kwargs = session_spec.get_params()
+    paths = _format_paths(['{path}/T1w', '{path}/{fmriname}/x.nii.gz'],
+                          kwargs, session_spec.get_runs())
+    assert paths == [os.path.join(kwargs['path'], 'T1w')] + [
+        os.path.join(kwargs['path'], run, 'x.nii.gz') for run in RUNS]
+
+
+def test_command_graph_orders_stages(session_spec, hcp_env):
+    graph = CommandGraph()
+    graph.add_stages([FMRIVolume(session_spec), FMRISurface(session_spec)],
+                     ncpus=4)
+    ids = {node['id']: node for node in graph.nodes}
+    volume = ['sub-sub-01/ses-ses-01/FMRIVolume/%s' % x for x in RUNS]
+    surface = ['sub-sub-01/ses-ses-01/FMRISurface/%s' % x for x in RUNS]
+    assert sorted(ids) == sorted(volume + surface)
+    for x in volume:
+        assert ids[x]['depends'] == [] and ids[x]['threads'] == 1
+        assert ids[x]['command'].startswith(
+            '/opt/HCPPIPEDIR/fMRIVolume/GenericfMRIVolumeProcessingPipeline'
+            '.sh ')
+        assert os.path.basename(ids[x]['inputs'][0]).startswith('sub-01')
+    for x in surface:
+        assert ids[x]['depends'] == volume
+
+
+def test_command_graph_single_command_uses_all_cores(session_spec, hcp_env):
+    graph = CommandGraph()
+    graph.add_stages([PreFreeSurfer(session_spec)], ncpus=4)
+    node, = graph.nodes
+    assert node['threads'] == 4
+    assert node['env']['OMP_NUM_THREADS'] == '4'
+
+
+def test_command_graph_recompresses_nifti_stages(session_spec, hcp_env):
+    session_spec.set_fsloutputtype('FMRIVolume', 'NIFTI')
+    graph = CommandGraph()
+    graph.add_stages([FMRIVolume(session_spec)], ncpus=2)
+    phases = [node['phase'] for node in graph.nodes]
+    assert phases == ['start'] + ['main'] * 3 + ['recompress']
+    start, recompress = graph.nodes[0], graph.nodes[-1]
+    assert start['command'].startswith('touch ')
+    assert [x.rsplit('/', 1)[1] for x in recompress['depends']] == RUNS
+    assert 'recompress.py --newer %s' % start['command'][len('touch '):] \
+        in recompress['command']
+
+
+def test_command_graph_splits_abcd_task_levels(session_spec, hcp_env,
+                                                tmp_path, monkeypatch):
+    task_scripts = tmp_path / 'tfMRIAnalysis'
+    task_scripts.mkdir()
+    (task_scripts / ABCDTask.level1_script).write_text('#!/bin/sh\n')
+    monkeypatch.setenv('HCPPIPEDIR_tfMRIAnalysis', str(task_scripts))
+    graph = CommandGraph()
+    graph.add_stages([ABCDTask(session_spec)])
+    ids = {node['id'].rsplit('/', 1)[1]: node for node in graph.nodes}
+    assert sorted(ids) == sorted([
+        'ABCDTask_setup', 'ses-01_task-nback_run-01_s2', 'task-nback_s2',
+        'ses-01_task-nback_run-01_s5', 'task-nback_s5'])
+    level2 = ids['task-nback_s2']
+    assert [x.rsplit('/', 1)[1] for x in level2['depends']] == [
+        'ABCDTask_setup', 'ses-01_task-nback_run-01_s2']
+    # level 1 analyses run through the checkpoint wrapper
+    assert level2['env']['HCPPIPEDIR_tfMRIAnalysis'] != str(task_scripts)
+
+
+def test_command_graph_writes_commands_verbatim(session_spec, hcp_env,
+                                                tmp_path):
+    graph = CommandGraph()
+    graph.add_stages([PreFreeSurfer(session_spec)])
+    graph.nodes[0]['command'] = "script --name='a b' --path=$HOME"
+    makefile = tmp_path / 'Makefile'
+    graph.write_makefile(str(makefile))
+    assert "\tenv OMP_NUM_THREADS" not in makefile.read_text()
+    assert "script --name='a b' --path=$$HOME > " in makefile.read_text()
+    graph.write_json(str(tmp_path / 'graph.json'))
+    with open(str(tmp_path / 'graph.json')) as fd:
+        assert json.load(fd)['nodes'][0]['command'] == \
+            "script --name='a b' --path=$HOME"
+
+
+def test_excluded_run_leaves_following_stages(session_spec, hcp_env):
+    session_spec.set_min_usable_frames(50)
+    # stages are made before FMRIVolume runs, as in run.py
+    volume = FMRIVolume(session_spec)
+    surface = FMRISurface(session_spec)
+    bold = DCANBOLDProcessing(session_spec)
+    path = volume.kwargs['path']
+    for idx, run in enumerate(RUNS):
+        regressors = os.path.join(path, 'MNINonLinear', 'Results', run,
+                                  'Movement_Regressors.txt')
+        os.makedirs(os.path.dirname(regressors))
+        motion = np.zeros((100, 12))
+        if idx == 1:
+            # 2 mm back and forth each frame
+            motion[::2, 0] = 2
+        np.savetxt(regressors, motion)
+    volume.exclude_high_motion_runs()
+    kept = [RUNS[0], RUNS[2]]
+    assert [run.fmriname for run in session_spec.get_runs()] == kept
+    assert volume.status['excluded_runs'] == {RUNS[1]: 0}
+    assert [x for x in RUNS if any(
+        '--fmriname=%s ' % x in args + ' ' for args in surface.args)] == kept
+    assert [x for x in RUNS if any(
+        '--task=%s ' % x in args for args in bold.args)] == kept
+    assert RUNS[1] not in ' '.join(cmd for cmd, _, _ in
+                                   bold.teardown_commands())
+    assert _format_paths(['{path}/{fmriname}'], surface.kwargs,
+                         session_spec.get_runs()) == [
+        os.path.join(path, x) for x in kept]
+    assert surface.get_image_dirs() == [
+        os.path.join(path, x) for x in kept] + [
+        os.path.join(path, 'MNINonLinear', 'Results', x) for x in kept]
+
+
+def test_pooled_stage_without_runtime_calls_runs_nothing(
+        session_spec, tmp_path, monkeypatch):
+    # each command of the stage would leave a file named after its process
+    scripts = tmp_path / 'hcp' / 'fMRISurface'
+    scripts.mkdir(parents=True)
+    script = scripts / 'GenericfMRISurfaceProcessingPipeline.sh'
+    script.write_text('#!/bin/sh\ntouch %s/started-$$\n' % tmp_path)
+    script.chmod(0o755)
+    monkeypatch.setenv('HCPPIPEDIR', str(tmp_path / 'hcp'))
+    monkeypatch.setattr(Stage, 'call_active', False)
+    FMRISurface(session_spec).run(2)
+    assert not list(tmp_path.glob('started-*'))
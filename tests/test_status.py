@@ -0,0 +1,124 @@
+import json
+import os
+import re
+
+import pytest
+
+from pipelines import Status, StatusIndex
+
+SUCCEEDED = Status.states['succeeded']
+FAILED = Status.states['failed']
+INCOMPLETE = Status.states['incomplete']
+
+
+@pytest.fixture
+def index(tmp_path):
+    return StatusIndex(str(tmp_path / StatusIndex.name))
+
+
+def test_latest_update_of_each_stage(index):
+    index.update('01', 'a', 'FreeSurfer', INCOMPLETE, updated=1)
+    index.update('01', 'a', 'FreeSurfer', SUCCEEDED, updated=2)
+    index.update('01', 'b', 'FreeSurfer', INCOMPLETE, updated=3)
+    index.update('02', 'a', 'FMRIVolume', FAILED, comment='exit code 1',
+                 updated=4)
+    assert sorted(index.stage_counts()) == [
+        ('FMRIVolume', FAILED, 1), ('FreeSurfer', SUCCEEDED, 1),
+        ('FreeSurfer', INCOMPLETE, 1)]
+    assert [row[:3] for row in index.running()] == [('01', 'b', 'FreeSurfer')]
+    assert index.stage_counts(subjects=['01'], sessions=['a']) == [
+        ('FreeSurfer', SUCCEEDED, 1)]
+
+
+def test_failures_keep_the_last_failure_comment(index):
+    index.update('01', 'a', 'FMRIVolume', FAILED, comment='killed by memory',
+                 updated=1)
+    index.update('01', 'a', 'FMRIVolume', INCOMPLETE, updated=2)
+    index.update('02', 'a', 'FMRIVolume', FAILED, comment='exit code 1',
+                 updated=3)
+    assert index.failures('memory') == [
+        ('01', 'a', 'FMRIVolume', INCOMPLETE, 'killed by memory')]
+    assert len(index.failures('.')) == 2
+    with pytest.raises(re.error):
+        index.failures('(')
+
+
+def test_journals_merge_in_time_order(index):
+    # a process may append an update older than those of another process
+    journals = [os.path.join(index.folder_path, name)
+                for name in ('a-1.jsonl', 'b-2.jsonl')]
+    os.makedirs(index.folder_path)
+    for journal, node_status, updated, comment in (
+            (journals[0], SUCCEEDED, 5, ''), (journals[1], FAILED, 2, 'old'),
+            (journals[1], INCOMPLETE, 1, '')):
+        with open(journal, 'a') as fd:
+            fd.write(json.dumps({
+                'subject': '01', 'session': 'a', 'stage': 'FreeSurfer',
+                'node_status': node_status, 'comment': comment,
+                'updated': updated}) + '\n')
+    assert index.stage_counts() == [('FreeSurfer', SUCCEEDED, 1)]
+    assert index.failures('old')[0][-1] == 'old'
+
+
+def test_snapshot_is_updated_incrementally(index):
+    index.update('01', 'a', 'FreeSurfer', INCOMPLETE, updated=1)
+    assert index.stage_counts() == [('FreeSurfer', INCOMPLETE, 1)]
+    snapshot = os.path.join(index.folder_path, StatusIndex.snapshot)
+    assert os.path.exists(snapshot)
+    journal, = [os.path.join(index.folder_path, x)
+                for x in os.listdir(index.folder_path)
+                if x.endswith('.jsonl')]
+    with open(journal, 'a') as fd:
+        # a line being appended is left for the next query
+        fd.write('{"subject": "01", "session": "a", "stage": "Free')
+    assert StatusIndex(index.folder_path).stage_counts() == [
+        ('FreeSurfer', INCOMPLETE, 1)]
+    with open(journal, 'a') as fd:
+        fd.write('Surfer", "node_status": %s, "updated": 2}\n' % SUCCEEDED)
+    # journals are not read again from their start
+    with open(journal, 'r+') as fd:
+        fd.write(' ' * 10)
+    assert StatusIndex(index.folder_path).stage_counts() == [
+        ('FreeSurfer', SUCCEEDED, 1)]
+
+
+def test_snapshot_of_another_schema_is_rebuilt(index):
+    index.update('01', 'a', 'FreeSurfer', SUCCEEDED, updated=1)
+    os.makedirs(index.folder_path, exist_ok=True)
+    with open(os.path.join(index.folder_path, StatusIndex.snapshot),
+              'w') as fd:
+        fd.write('not a database')
+    assert index.stage_counts() == [('FreeSurfer', SUCCEEDED, 1)]
+
+
+def test_rebuild_indexes_status_files(tmp_path):
+    log_dir = tmp_path / 'sub-01' / 'ses-a' / 'logs' / 'FreeSurfer'
+    log_dir.mkdir(parents=True)
+    Status(str(log_dir)).update_success()
+    index = StatusIndex(str(tmp_path / StatusIndex.name))
+    assert index.rebuild(str(tmp_path)) == 1
+    assert index.stage_counts() == [('FreeSurfer', SUCCEEDED, 1)]
+
+
+def test_status_report(tmp_path, capsys):
+    from run import status_report
+    index = StatusIndex(str(tmp_path / StatusIndex.name))
+    index.update('01', 'a', 'FreeSurfer', SUCCEEDED, updated=1)
+    index.update('02', 'a', 'FreeSurfer', INCOMPLETE, host='node1',
+                 updated=2)
+    index.update('03', 'a', 'FreeSurfer', FAILED, comment='exit code 1',
+                 updated=3)
+    status_report(str(tmp_path), failure_pattern='exit')
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == ['stage', 'succeeded', 'failed',
+                                'incomplete', 'not_started', 'unchecked']
+    assert lines[1].split() == ['FreeSurfer', '1', '1', '1', '0', '0']
+    assert '1 running' in lines
+    assert any(x.startswith('sub-02 ses-a FreeSurfer on ') for x in lines)
+    assert '1 failures matching "exit"' in lines
+    assert 'sub-03 ses-a FreeSurfer (failed): exit code 1' in lines
+    capsys.readouterr()
+    status_report(str(tmp_path), subject_list=['01'])
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[1].split() == ['FreeSurfer', '1', '0', '0', '0', '0']
+    assert '0 running' in lines